@@ -0,0 +1,160 @@
+"""Deterministic stand-ins for the LLM, the vector index and the catalog, to benchmark the graph offline"""
+import json
+import re
+import zlib
+from typing import Any, AsyncIterator, Callable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from chatbots.vectorstore.preprocess_data import product_text_expr
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+from chatbots.vectorstore.local_index import LocalVectorIndex, build_ivf, normalize_embeddings
+
+BRANDS = ["Apple", "Samsung", "Sony", "Dell", "HP", "Lenovo", "LG", "Bose", "Canon", "Microsoft"]
+CATEGORIES = ["Computers & Tablets", "TV & Home Theater", "Audio", "Cameras", "Cell Phones", "Appliances",
+              "Video Games", "Smart Home"]
+PRODUCT_TYPES = ["laptop", "tablet", "tv", "soundbar", "headphones", "speaker", "camera", "lens", "phone",
+                 "charger", "case", "monitor", "keyboard", "mouse", "router", "console"]
+FEATURES = ["wireless", "4k", "noise cancelling", "lightweight", "waterproof", "fast charging", "bluetooth",
+            "oled", "touchscreen", "long battery life"]
+PREFERENCE_PATTERN = re.compile(r"(category|brand|budget|features): ([^;]+)")
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Chat model answering with respond(messages), streamed word by word with tool calls in the last chunk.
+    bind_tools returns the model itself, the scripted answers decide which tool is called.
+    """
+
+    respond: Callable[[List[BaseMessage]], AIMessage]
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> "ScriptedChatModel":
+        return self
+
+    def _usage(self, messages: List[BaseMessage], message: AIMessage) -> dict:
+        input_tokens = sum(len(str(m.content).split()) for m in messages)
+        tool_call_args = json.dumps([tool_call["args"] for tool_call in message.tool_calls])
+        output_tokens = len(message.content.split()) + len(tool_call_args.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self.respond(messages)
+        message = AIMessage(content=message.content, tool_calls=message.tool_calls,
+                            usage_metadata=self._usage(messages, message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        # answering is instant, stay on the event loop instead of the default executor hop
+        return self._generate(messages, stop=stop, **kwargs)
+
+    def _chunks(self, messages: List[BaseMessage]) -> Iterator[ChatGenerationChunk]:
+        message = self.respond(messages)
+        for token in re.findall(r"\S+\s*", message.content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        tool_call_chunks = [{"name": tool_call["name"], "args": json.dumps(tool_call["args"]), "id": tool_call["id"],
+                             "index": index} for index, tool_call in enumerate(message.tool_calls)]
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=tool_call_chunks,
+                                                         usage_metadata=self._usage(messages, message)))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._chunks(messages):
+            if run_manager and chunk.message.content:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        for chunk in self._chunks(messages):
+            if run_manager and chunk.message.content:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+def _stable_choice(options: Sequence[str], text: str, salt: int = 0) -> str:
+    return options[(zlib.crc32(text.encode("utf-8")) + salt) % len(options)]
+
+
+def respond_customer_preference(messages: List[BaseMessage]) -> AIMessage:
+    """Ask for missing preferences, or call CustomerPreference once the message gives "category: ...; brand: ..." """
+    text = str(messages[-1].content)
+    preference = dict(PREFERENCE_PATTERN.findall(text))
+    missing = [key for key in ("category", "brand", "budget", "features") if key not in preference]
+    if missing:
+        return AIMessage(content=f"Thanks! Could you tell me more about your {' and '.join(missing)} preferences?")
+    args = {"product_category": preference["category"].strip(), "brand": preference["brand"].strip(),
+            "budget": preference["budget"].strip(), "features": preference["features"].strip()}
+    summary = ", ".join(args.values())
+    return AIMessage(content=f"Here is a summary of your preferences: {summary}.",
+                     tool_calls=[{"name": "CustomerPreference", "args": args,
+                                  "id": f"call_{zlib.crc32(text.encode('utf-8'))}"}])
+
+
+def respond_related_product_preference(messages: List[BaseMessage]) -> AIMessage:
+    """Call RelatedProductPreference with three product types derived from the recommended product"""
+    text = str(messages[-1].content)
+    args = {f"product_category_{i}": f"{_stable_choice(PRODUCT_TYPES, text, i)} accessories" for i in range(1, 4)}
+    return AIMessage(content="", tool_calls=[{"name": "RelatedProductPreference", "args": args,
+                                              "id": f"call_{zlib.crc32(text.encode('utf-8'))}"}])
+
+
+def synthetic_catalog(n_products: int, seed: int = 0) -> pl.DataFrame:
+    """Catalog with the columns of the Best Buy dataset used by the chatbot, generated column-wise"""
+    rng = np.random.default_rng(seed)
+    brands = np.array(BRANDS)[rng.integers(len(BRANDS), size=n_products)]
+    product_types = np.array(PRODUCT_TYPES)[rng.integers(len(PRODUCT_TYPES), size=n_products)]
+    features = np.array(FEATURES)[rng.integers(len(FEATURES), size=n_products)]
+    catalog = pl.DataFrame({
+        "product_id": np.arange(1, n_products + 1, dtype=np.int64),
+        "brand": brands,
+        "product_type": product_types,
+        "feature": features,
+        "root_category": np.array(CATEGORIES)[rng.integers(len(CATEGORIES), size=n_products)],
+        "price": np.round(rng.lognormal(mean=5.5, sigma=1.0, size=n_products), 2),
+    })
+    return catalog.select(
+        "product_id",
+        pl.format("{} - {} {} model {}", "brand", "feature", "product_type", "product_id").alias("title"),
+        pl.format("${}", pl.col("price").round(2)).alias("final_price"),
+        "root_category",
+        pl.format("{} {} by {}", "feature", "product_type", "brand").alias("features_summary"),
+        pl.format("{}; {}", "feature", "product_type").alias("features"),
+        pl.lit(None, dtype=pl.String).alias("product_specifications"),
+    )
+
+
+def random_vector_index(catalog: pl.DataFrame, dimension: int = 128, seed: int = 0,
+                        n_lists: int = 0) -> LocalVectorIndex:
+    """Local index over random unit vectors, one per catalog product, queried with hashing embeddings"""
+    rng = np.random.default_rng(seed)
+    embeddings = normalize_embeddings(rng.standard_normal((catalog.height, dimension), dtype=np.float32))
+    return LocalVectorIndex(embeddings, catalog["product_id"].to_numpy().astype(np.int64),
+                            HashingEmbeddings(dimension),
+                            metadata=catalog.select("title", product_text_expr()),
+                            ivf=build_ivf(embeddings, n_lists) if n_lists else None)
+
+
+def scripted_conversation(conversation_id: int) -> List[str]:
+    """User turns of a conversation: a vague request, then all the preferences"""
+    product_type = _stable_choice(PRODUCT_TYPES, str(conversation_id))
+    brand = _stable_choice(BRANDS, str(conversation_id), 1)
+    feature = _stable_choice(FEATURES, str(conversation_id), 2)
+    budget = 100 * (1 + conversation_id % 20)
+    return [
+        f"Hi, I am looking for a {product_type}",
+        f"category: {product_type}; brand: {brand}; budget: under ${budget}; features: {feature}",
+    ]
@@ -0,0 +1,266 @@
+"""
+Load generator replaying a JSONL corpus of multi-turn shopping conversations at a configurable concurrency and
+arrival rate, against the shopping buddy in this process or a running Gradio app, to size worker counts.
+Reports throughput, latency percentiles per turn type and error rates.
+
+Each corpus line is a conversation: {"conversation_id": "...", "turns": [{"type": "opening", "message": "..."}]},
+a turn may also be a bare message string, typed by its position in the conversation.
+
+Usage:
+    python -m benchmarks.load_generator --write-corpus corpus.jsonl --conversations 1000
+    python -m benchmarks.load_generator --corpus corpus.jsonl --concurrency 64 --rate 20
+    python -m benchmarks.load_generator --serve --port 7860   # the Gradio app with the stub models, to load test it
+    python -m benchmarks.load_generator --corpus corpus.jsonl --gradio-url http://127.0.0.1:7860/ --concurrency 64
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import scripted_conversation
+from benchmarks.run_benchmark import _percentiles, setup_benchmark
+
+logger = logging.getLogger("chatbots")
+
+# types of the turns of scripted conversations, in order
+SCRIPTED_TURN_TYPES = ["opening", "preferences"]
+GRADIO_API_NAME = "/respond"
+
+
+def scripted_corpus(n_conversations: int) -> List[dict]:
+    """Conversations of the scripted benchmark: a vague request, answered with a question, then all the preferences"""
+    return [{"conversation_id": str(conversation_id),
+             "turns": [{"type": turn_type, "message": message}
+                       for turn_type, message in zip(SCRIPTED_TURN_TYPES, scripted_conversation(conversation_id))]}
+            for conversation_id in range(n_conversations)]
+
+
+def write_corpus(path: str, conversations: List[dict]):
+    with open(path, "w") as f:
+        for conversation in conversations:
+            f.write(json.dumps(conversation) + "\n")
+
+
+def read_corpus(path: str) -> List[dict]:
+    """Read a JSONL corpus, typing bare message turns as turn_<position>"""
+    conversations = []
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            conversation = json.loads(line)
+            turns = [turn if isinstance(turn, dict) else {"type": f"turn_{position}", "message": turn}
+                     for position, turn in enumerate(conversation["turns"])]
+            conversations.append({"conversation_id": str(conversation.get("conversation_id", line_number)),
+                                  "turns": turns})
+    return conversations
+
+
+class InProcessTarget:
+    """Play turns through astream_shopping_buddy, against the stub models and indexes installed by setup_benchmark"""
+
+    name = "in_process"
+
+    async def turn(self, thread_id: str, message: str) -> Optional[float]:
+        """Play a turn, returning the time to its first streamed chunk"""
+        start = time.perf_counter()
+        first_chunk_seconds = None
+        async for _ in shopping_buddy.astream_shopping_buddy(message, thread_id=thread_id):
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - start
+        return first_chunk_seconds
+
+    async def end(self, thread_id: str):
+        await shopping_buddy.aclear_thread(thread_id)
+
+
+class GradioTarget:
+    """
+    Play turns through the HTTP API of a running Gradio app, one client and so one session per conversation.
+    gradio_client is blocking, its calls run on a pool of one thread per conversation in flight.
+    """
+
+    name = "gradio"
+
+    def __init__(self, url: str, max_workers: int, api_name: str = GRADIO_API_NAME):
+        self.url = url
+        self.api_name = api_name
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gradio-client")
+        self.clients = {}
+        self.histories: Dict[str, list] = {}
+
+    def _turn(self, thread_id: str, message: str) -> Optional[float]:
+        from gradio_client import Client
+
+        client = self.clients.get(thread_id)
+        if client is None:
+            client = self.clients[thread_id] = Client(self.url, verbose=False)
+        history = self.histories.get(thread_id, [])
+        start = time.perf_counter()
+        first_chunk_seconds = None
+        job = client.submit(message, history, api_name=self.api_name)
+        for _, chat_history in job:
+            # the first output only echoes the customer message
+            if first_chunk_seconds is None and len(chat_history) > len(history) + 1:
+                first_chunk_seconds = time.perf_counter() - start
+        # raises the error of a failed turn
+        self.histories[thread_id] = job.result()[1]
+        return first_chunk_seconds
+
+    async def turn(self, thread_id: str, message: str) -> Optional[float]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._turn, thread_id, message)
+
+    async def end(self, thread_id: str):
+        # the app drops the session state when the client goes away
+        self.histories.pop(thread_id, None)
+        client = self.clients.pop(thread_id, None)
+        if client is not None and hasattr(client, "close"):
+            await asyncio.get_running_loop().run_in_executor(self.executor, client.close)
+
+
+class LoadStats:
+    """Latencies and errors of the turns played, by turn type"""
+
+    def __init__(self):
+        self.turn_seconds = defaultdict(list)
+        self.first_chunk_seconds = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.queue_seconds = []
+        self.turns = 0
+        self.completed_conversations = 0
+
+    def report(self, elapsed: float) -> dict:
+        turn_types = sorted(set(self.turn_seconds) | set(self.errors))
+        n_errors = sum(self.errors.values())
+        return {
+            "elapsed_seconds": elapsed,
+            "turns": self.turns,
+            "turns_per_second": (self.turns - n_errors) / elapsed,
+            "completed_conversations": self.completed_conversations,
+            "conversations_per_second": self.completed_conversations / elapsed,
+            "error_rate": n_errors / self.turns if self.turns else 0.0,
+            "turn_seconds": {turn_type: _percentiles(self.turn_seconds[turn_type]) for turn_type in turn_types},
+            "first_chunk_seconds": {turn_type: _percentiles(self.first_chunk_seconds[turn_type])
+                                    for turn_type in turn_types},
+            "error_rates": {turn_type: self.errors[turn_type] / (len(self.turn_seconds[turn_type])
+                                                                 + self.errors[turn_type])
+                            for turn_type in turn_types},
+            # wait of arriving conversations for a free slot, the backlog of an open-loop run
+            "queue_seconds": _percentiles(self.queue_seconds),
+        }
+
+
+async def play_conversation(target, conversation: dict, stats: LoadStats, think_seconds: float = 0.0):
+    """Play the turns of a conversation on a new thread, stopping at the first failed turn"""
+    thread_id = f"load-{conversation['conversation_id']}-{uuid.uuid4().hex[:8]}"
+    try:
+        for position, turn in enumerate(conversation["turns"]):
+            if position and think_seconds:
+                await asyncio.sleep(random.expovariate(1 / think_seconds))
+            stats.turns += 1
+            start = time.perf_counter()
+            try:
+                first_chunk_seconds = await target.turn(thread_id, turn["message"])
+            except Exception as e:
+                stats.errors[turn["type"]] += 1
+                logger.warning(f"turn {turn['type']} of conversation {conversation['conversation_id']} failed: {e}")
+                return
+            stats.turn_seconds[turn["type"]].append(time.perf_counter() - start)
+            if first_chunk_seconds is not None:
+                stats.first_chunk_seconds[turn["type"]].append(first_chunk_seconds)
+        stats.completed_conversations += 1
+    finally:
+        await target.end(thread_id)
+
+
+async def generate_load(target, conversations: List[dict], concurrency: int, rate: float = 0.0,
+                        think_seconds: float = 0.0) -> dict:
+    """
+    Replay the conversations with at most concurrency of them in flight. With a rate, conversations arrive as a
+    Poisson process of rate conversations per second whether or not the previous ones are done (open loop),
+    otherwise each one starts as soon as a slot is free (closed loop).
+    """
+    stats = LoadStats()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def arrive(conversation: dict):
+        arrived = time.perf_counter()
+        async with semaphore:
+            stats.queue_seconds.append(time.perf_counter() - arrived)
+            await play_conversation(target, conversation, stats, think_seconds)
+
+    start = time.perf_counter()
+    tasks = []
+    for conversation in conversations:
+        tasks.append(asyncio.create_task(arrive(conversation)))
+        if rate:
+            await asyncio.sleep(random.expovariate(rate))
+    await asyncio.gather(*tasks)
+    report = stats.report(time.perf_counter() - start)
+    report["config"] = {"target": target.name, "conversations": len(conversations), "concurrency": concurrency,
+                        "rate": rate, "think_seconds": think_seconds}
+    return report
+
+
+def serve(catalog_size: int, port: int, dimension: int = 128):
+    """Launch the Gradio app with the stub models and indexes, to be loaded over HTTP"""
+    from frontend.app import demo
+
+    setup_benchmark(catalog_size, dimension=dimension)
+    demo.launch(server_port=port)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay shopping conversations against the shopping buddy")
+    parser.add_argument("--corpus", help="JSONL corpus of conversations, scripted conversations when not given")
+    parser.add_argument("--write-corpus", help="write the scripted corpus of --conversations to this path and exit")
+    parser.add_argument("--conversations", type=int, default=100, help="scripted conversations, or corpus prefix")
+    parser.add_argument("--concurrency", type=int, default=16, help="conversations in flight")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="conversation arrivals per second, 0 starts them as fast as slots free up")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="mean pause of the customer between turns")
+    parser.add_argument("--gradio-url", help="load a running Gradio app instead of the graph in this process")
+    parser.add_argument("--serve", action="store_true", help="launch the Gradio app with the stub models")
+    parser.add_argument("--port", type=int, default=7860, help="port of the Gradio app launched by --serve")
+    parser.add_argument("--catalog-size", type=int, default=10_000, help="synthetic catalog rows of the stubs")
+    parser.add_argument("--dimension", type=int, default=128, help="embedding dimension of the local index")
+    parser.add_argument("--max-error-rate", type=float, help="exit with an error above this error rate")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    args = parser.parse_args(argv)
+
+    if args.write_corpus:
+        write_corpus(args.write_corpus, scripted_corpus(args.conversations))
+        return
+    if args.serve:
+        serve(args.catalog_size, args.port, dimension=args.dimension)
+        return
+
+    conversations = (read_corpus(args.corpus)[:args.conversations] if args.corpus
+                     else scripted_corpus(args.conversations))
+    if args.gradio_url:
+        target = GradioTarget(args.gradio_url, max_workers=args.concurrency)
+    else:
+        setup_benchmark(args.catalog_size, dimension=args.dimension)
+        target = InProcessTarget()
+    report = asyncio.run(generate_load(target, conversations, args.concurrency, rate=args.rate,
+                                       think_seconds=args.think_seconds))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        logger.error(f"error rate {report['error_rate']:.3f} > {args.max_error_rate}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Offline end-to-end benchmark of the shopping buddy graph: scripted multi-turn conversations against a scripted
+chat model, a local vector index over random embeddings and a synthetic catalog of configurable size.
+Reports setup time, throughput, turn latency percentiles, per-node latency and peak memory, and optionally
+fails when throughput regressed against a previous report.
+
+Usage: python -m benchmarks.run_benchmark --catalog-size 100000 --conversations 200 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+from typing import List, Optional
+
+import numpy as np
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import (
+    ScriptedChatModel,
+    random_vector_index,
+    respond_customer_preference,
+    respond_related_product_preference,
+    scripted_conversation,
+    synthetic_catalog,
+)
+from chatbots.metrics import LLMMetricsCallbackHandler, metrics
+from chatbots.recommend import ProductStore, set_product_store
+from chatbots.slot_filling import SlotExtractor, set_slot_extractor
+from chatbots.vectorstore.hybrid_search import ProductFilterIndex, set_product_filter_index
+from chatbots.vectorstore.vector_search import set_vector_index
+
+logger = logging.getLogger("chatbots")
+
+
+def setup_benchmark(catalog_size: int, dimension: int = 128, n_lists: int = 0, seed: int = 0) -> dict:
+    """
+    Install the synthetic catalog, the local index and the scripted chat models in place of the global ones,
+    returning setup timings. Tests get the previous ones back from the restore_globals fixture.
+    """
+    timings = {}
+    start = time.perf_counter()
+    catalog = synthetic_catalog(catalog_size, seed=seed)
+    timings["catalog_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    set_vector_index(random_vector_index(catalog, dimension=dimension, seed=seed, n_lists=n_lists))
+    timings["vector_index_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    set_product_store(ProductStore(catalog))
+    set_product_filter_index(ProductFilterIndex(catalog))
+    set_slot_extractor(SlotExtractor.from_catalog(catalog.lazy()))
+    timings["product_indexes_seconds"] = time.perf_counter() - start
+
+    callbacks = [LLMMetricsCallbackHandler()]
+    shopping_buddy.set_llms(ScriptedChatModel(respond=respond_customer_preference, callbacks=callbacks),
+                            ScriptedChatModel(respond=respond_related_product_preference, callbacks=callbacks))
+    shopping_buddy.get_related_product_cache().clear()
+    return timings
+
+
+async def run_conversation(conversation_id: int, turn_latencies: List[float]) -> int:
+    """Play a scripted conversation on its own thread, returning the number of streamed chunks"""
+    chunks = 0
+    thread_id = f"benchmark-{conversation_id}"
+    for user_message in scripted_conversation(conversation_id):
+        start = time.perf_counter()
+        async for _ in shopping_buddy.astream_shopping_buddy(user_message, thread_id=thread_id):
+            chunks += 1
+        turn_latencies.append(time.perf_counter() - start)
+    await shopping_buddy.aclear_thread(thread_id)
+    return chunks
+
+
+async def run_conversations(n_conversations: int, concurrency: int, turn_latencies: List[float]) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(conversation_id: int) -> int:
+        async with semaphore:
+            return await run_conversation(conversation_id, turn_latencies)
+
+    return sum(await asyncio.gather(*[bounded(conversation_id) for conversation_id in range(n_conversations)]))
+
+
+def _percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": float(np.mean(values)), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def run_benchmark(catalog_size: int = 10_000,
+                  n_conversations: int = 100,
+                  concurrency: int = 8,
+                  dimension: int = 128,
+                  n_lists: int = 0,
+                  trace_memory: bool = False,
+                  seed: int = 0) -> dict:
+    """Run the benchmark and return its report"""
+    if trace_memory:
+        tracemalloc.start()
+    setup = setup_benchmark(catalog_size, dimension=dimension, n_lists=n_lists, seed=seed)
+    metrics.reset()
+
+    turn_latencies = []
+    start = time.perf_counter()
+    chunks = asyncio.run(run_conversations(n_conversations, concurrency, turn_latencies))
+    elapsed = time.perf_counter() - start
+
+    summary = metrics.summary()
+    report = {
+        "config": {"catalog_size": catalog_size, "conversations": n_conversations, "concurrency": concurrency,
+                   "dimension": dimension, "n_lists": n_lists},
+        "setup": setup,
+        "elapsed_seconds": elapsed,
+        "conversations_per_second": n_conversations / elapsed,
+        "turns_per_second": len(turn_latencies) / elapsed,
+        "streamed_chunks": chunks,
+        "turn_seconds": _percentiles(turn_latencies),
+        "node_seconds": {labels.split("=", 1)[1]: stats for labels, stats in summary.get("node_seconds", {}).items()},
+        "vector_search_seconds": summary.get("vector_search_seconds", {}),
+        "product_lookup_seconds": summary.get("product_lookup_seconds", {}),
+        "vector_search_cache_lookups": summary.get("vector_search_cache_lookups", {}),
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin"
+                                                                             else 1024),
+    }
+    if trace_memory:
+        report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    return report
+
+
+def check_regression(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Throughput and p99 turn latency regressions beyond max_regression (a fraction) against a baseline report"""
+    regressions = []
+    if report["turns_per_second"] < baseline["turns_per_second"] * (1 - max_regression):
+        regressions.append(f"turns_per_second {report['turns_per_second']:.1f} < "
+                           f"baseline {baseline['turns_per_second']:.1f}")
+    if report["turn_seconds"]["p99"] > baseline["turn_seconds"]["p99"] * (1 + max_regression):
+        regressions.append(f"p99 turn latency {report['turn_seconds']['p99']:.4f}s > "
+                           f"baseline {baseline['turn_seconds']['p99']:.4f}s")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the shopping buddy graph offline")
+    parser.add_argument("--catalog-size", type=int, default=10_000, help="synthetic catalog rows, e.g. 10k to 1M")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="conversations played at once")
+    parser.add_argument("--dimension", type=int, default=128, help="embedding dimension of the local index")
+    parser.add_argument("--n-lists", type=int, default=0, help="number of IVF lists, 0 for brute-force search")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the peak of traced allocations")
+    parser.add_argument("--output", help="write the JSON report to this path")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="tolerated regression, as a fraction")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.catalog_size, args.conversations, args.concurrency, dimension=args.dimension,
+                           n_lists=args.n_lists, trace_memory=args.trace_memory)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check_regression(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            logger.error(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from chatbots.vectorstore.embeddings import embed_texts
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a time to live, counting hits and misses"""
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _get(self, key: Hashable):
+        """Get a live entry and mark it as recently used, without counting hits and misses"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry[1]):
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, stored_at: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (value, time.time() if stored_at is None else stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: Hashable):
+        del self._entries[key]
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove a live entry and return it, counting hits and misses"""
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._evict(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class SemanticCache(TTLCache):
+    """
+    Cache keyed on text: lookups try the exact key first, then the most similar cached key by embedding
+    cosine similarity, above a threshold. Entries can be persisted to a JSON file.
+    """
+
+    def __init__(self,
+                 embedding_function: Embeddings,
+                 similarity_threshold: float = 0.95,
+                 max_size: int = 1024,
+                 ttl_seconds: Optional[float] = None,
+                 path: Optional[str] = None,
+                 dumps: Callable[[Any], Any] = lambda value: value,
+                 loads: Callable[[Any], Any] = lambda value: value):
+        super().__init__(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.path = path
+        self.dumps = dumps
+        self.loads = loads
+        self._key_vectors = {}
+        if path is not None:
+            self.load()
+            atexit.register(self.save)
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = embed_texts(self.embedding_function, [text])[0]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get(key)
+            if value is None and self._key_vectors:
+                keys = list(self._key_vectors)
+                similarities = np.stack([self._key_vectors[k] for k in keys]) @ self._embed(key)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    value = self._get(keys[best])
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        with self._lock:
+            if key not in self._key_vectors:
+                self._key_vectors[key] = self._embed(key)
+            super().set(key, value, stored_at=stored_at)
+
+    def _evict(self, key: Hashable):
+        super()._evict(key)
+        self._key_vectors.pop(key, None)
+
+    def save(self):
+        with self._lock:
+            entries = [[key, self.dumps(value), stored_at] for key, (value, stored_at) in self._entries.items()
+                       if not self._is_expired(stored_at)]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            entries = json.load(f)
+        for key, value, stored_at in entries:
+            if not self._is_expired(stored_at):
+                self.set(key, self.loads(value), stored_at=stored_at)
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.memory import MemorySaver
+
+from chatbots.metrics import metrics
+from chatbots.utils.environment import (
+    CHECKPOINTER_BACKEND,
+    CHECKPOINT_DB_PATH,
+    CHECKPOINT_TTL_SECONDS,
+    CHECKPOINT_MAX_MESSAGES,
+)
+
+logger = logging.getLogger("chatbots")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    checkpoint_type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    value_type TEXT,
+    value BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS threads_updated_at ON threads (updated_at);
+"""
+
+
+class SQLiteConnectionPool:
+    """Fixed-size pool of SQLite connections in WAL mode, shareable across threads"""
+
+    def __init__(self, path: str, size: int = 4, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._connections = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(None)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection, committing on success and rolling back on error"""
+        conn = self._connections.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            with conn:
+                yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        while not self._connections.empty():
+            conn = self._connections.get_nowait()
+            if conn is not None:
+                conn.close()
+
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver[int]):
+    """
+    Checkpointer persisting conversation state to SQLite, shareable by worker processes on one host.
+    Storage stays bounded: only the latest checkpoints of a thread are kept, the stored message history
+    is capped, and threads idle for longer than the TTL are evicted.
+    """
+
+    def __init__(self,
+                 path: str,
+                 pool_size: int = 4,
+                 ttl_seconds: Optional[float] = None,
+                 max_messages: Optional[int] = None,
+                 max_checkpoints_per_thread: int = 2,
+                 eviction_interval_seconds: float = 60.0,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.pool = SQLiteConnectionPool(path, size=pool_size)
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self.max_checkpoints_per_thread = max_checkpoints_per_thread
+        self.eviction_interval_seconds = eviction_interval_seconds
+        self._last_eviction = time.monotonic()
+        self._eviction_lock = threading.Lock()
+        with self.pool.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _load_writes(self, conn, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list:
+        rows = conn.execute(
+            "SELECT task_id, channel, value_type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return [(task_id, channel, self.serde.loads_typed((value_type, value)))
+                for task_id, channel, value_type, value in rows]
+
+    def _to_tuple(self, conn, row) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, \
+            metadata_type, metadata = row
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((checkpoint_type, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id,
+            }} if parent_checkpoint_id else None,
+            pending_writes=self._load_writes(conn, thread_id, checkpoint_ns, checkpoint_id),
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = "SELECT * FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            params.append(checkpoint_id)
+        query += " ORDER BY checkpoint_id DESC LIMIT 1"
+        with self.pool.connection() as conn:
+            row = conn.execute(query, params).fetchone()
+            return self._to_tuple(conn, row) if row else None
+
+    def list(self,
+             config: Optional[RunnableConfig],
+             *,
+             filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None,
+             limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = "SELECT * FROM checkpoints WHERE 1 = 1"
+        params = []
+        if config:
+            query += " AND thread_id = ?"
+            params.append(str(config["configurable"]["thread_id"]))
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                query += " AND checkpoint_ns = ?"
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            params.append(before_checkpoint_id)
+        query += " ORDER BY checkpoint_id DESC"
+        with self.pool.connection() as conn:
+            checkpoint_tuples = []
+            for row in conn.execute(query, params).fetchall():
+                if limit is not None and len(checkpoint_tuples) >= limit:
+                    break
+                checkpoint_tuple = self._to_tuple(conn, row)
+                if filter and not all(checkpoint_tuple.metadata.get(key) == value for key, value in filter.items()):
+                    continue
+                checkpoint_tuples.append(checkpoint_tuple)
+        yield from checkpoint_tuples
+
+    def _cap_messages(self, thread_id: str, checkpoint: Checkpoint) -> Checkpoint:
+        messages = checkpoint["channel_values"].get("messages")
+        if self.max_messages is None or not messages or len(messages) <= self.max_messages:
+            return checkpoint
+        n_dropped = len(messages) - self.max_messages
+        logger.info(f"thread {thread_id}: dropped the {n_dropped} oldest messages from the stored checkpoint, "
+                    f"over the cap of {self.max_messages}")
+        metrics.increment("checkpoint_dropped_messages", n_dropped)
+        return {**checkpoint,
+                "channel_values": {**checkpoint["channel_values"], "messages": messages[-self.max_messages:]}}
+
+    def put(self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_type, checkpoint_blob = self.serde.dumps_typed(self._cap_messages(thread_id, checkpoint))
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 checkpoint_type, checkpoint_blob, metadata_type, metadata_blob),
+            )
+            conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?)", (thread_id, time.time()))
+            self._prune_thread(conn, thread_id, checkpoint_ns)
+        self._maybe_evict_idle_threads()
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+
+    def put_writes(self,
+                   config: RunnableConfig,
+                   writes: Sequence[tuple[str, Any]],
+                   task_id: str,
+                   task_path: str = "") -> None:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_blob = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, value_type, value_blob, task_path))
+        # special writes (errors, interrupts) may be overwritten, regular writes are only stored once
+        all_special = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        with self.pool.connection() as conn:
+            conn.executemany(
+                f"INSERT OR {'REPLACE' if all_special else 'IGNORE'} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _prune_thread(self, conn, thread_id: str, checkpoint_ns: str):
+        """Keep only the latest checkpoints of a thread and their writes"""
+        n_pruned = conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN "
+            "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT ?)",
+            (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.max_checkpoints_per_thread),
+        ).rowcount
+        if n_pruned:
+            logger.debug(f"thread {thread_id}: pruned {n_pruned} checkpoints older than the latest "
+                         f"{self.max_checkpoints_per_thread}")
+        conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN "
+            "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?)",
+            (thread_id, checkpoint_ns, thread_id, checkpoint_ns),
+        )
+
+    def _maybe_evict_idle_threads(self):
+        if self.ttl_seconds is None or time.monotonic() - self._last_eviction < self.eviction_interval_seconds:
+            return
+        if not self._eviction_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_eviction = time.monotonic()
+            self.evict_idle_threads()
+        finally:
+            self._eviction_lock.release()
+
+    def evict_idle_threads(self, ttl_seconds: Optional[float] = None) -> int:
+        """Delete the threads not updated within the TTL, return the number of evicted threads"""
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        cutoff = time.time() - ttl_seconds
+        with self.pool.connection() as conn:
+            thread_ids = [row[0] for row in
+                          conn.execute("SELECT thread_id FROM threads WHERE updated_at < ?", (cutoff,)).fetchall()]
+            for thread_id in thread_ids:
+                self._delete_thread(conn, thread_id)
+        if thread_ids:
+            logger.debug(f"evicted {len(thread_ids)} idle threads")
+        return len(thread_ids)
+
+    @staticmethod
+    def _delete_thread(conn, thread_id: str):
+        for table in ("checkpoints", "writes", "threads"):
+            conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.pool.connection() as conn:
+            self._delete_thread(conn, str(thread_id))
+
+    # SQLite calls block, run them off the event loop
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self,
+                    config: Optional[RunnableConfig],
+                    *,
+                    filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None,
+                    limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self,
+                   config: RunnableConfig,
+                   checkpoint: Checkpoint,
+                   metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self,
+                          config: RunnableConfig,
+                          writes: Sequence[tuple[str, Any]],
+                          task_id: str,
+                          task_path: str = "") -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def build_checkpointer(backend: str = CHECKPOINTER_BACKEND) -> BaseCheckpointSaver:
+    """
+    Build the conversation state checkpointer, "memory" or "sqlite".
+    "memory", the default, keeps every checkpoint of every thread in the process until the thread is cleared, it
+    suits development and single-process demos. Deployments opt in to the bounded "sqlite" saver, which caps the
+    stored messages and checkpoints per thread and evicts idle threads.
+    """
+    if backend == "memory":
+        logger.info("conversation state is kept in memory without bound, set CHECKPOINTER_BACKEND=sqlite to bound it")
+        return MemorySaver()
+    if backend == "sqlite":
+        return SQLiteCheckpointSaver(CHECKPOINT_DB_PATH,
+                                     ttl_seconds=CHECKPOINT_TTL_SECONDS,
+                                     max_messages=CHECKPOINT_MAX_MESSAGES)
+    raise ValueError(f"Unknown checkpointer backend: {backend}")
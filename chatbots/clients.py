@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import logging
+import random
+import re
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from chatbots.utils.environment import BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS
+
+logger = logging.getLogger("chatbots")
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# the vector search SDK raises a bare Exception with the status code in its message
+STATUS_CODE_PATTERN = re.compile(r"status_code (\d{3})")
+
+
+class _Waiter:
+    """A thread or a coroutine waiting for a slot of a ConcurrencyLimiter"""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.granted = False
+        self.event = threading.Event() if loop is None else None
+        self.future = None if loop is None else loop.create_future()
+
+    def grant(self) -> bool:
+        """Hand the waiter a slot, called under the limiter lock; False if it can no longer take it"""
+        if self.loop is None:
+            self.event.set()
+        else:
+            try:
+                self.loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                # its event loop is closed
+                return False
+        self.granted = True
+        return True
+
+    def _wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class ConcurrencyLimiter:
+    """
+    Bound the calls in flight to an endpoint, with `with limiter:` from threads and `async with limiter:` from
+    coroutines. Threads and coroutines of any event loop share the same limit slots, taken in arrival order.
+    Coroutines wait on the event loop rather than in a thread, so a slow endpoint does not tie up the worker
+    threads of callers queued behind it.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._in_flight = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def _take_free_slot(self) -> bool:
+        # called under the lock, free slots go to the waiters first
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take a slot, waiting at most timeout seconds for one; whether a slot was taken"""
+        with self._lock:
+            if self._take_free_slot():
+                return True
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+        if waiter.event.wait(timeout):
+            return True
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return False
+        # granted while timing out
+        return True
+
+    async def aacquire(self):
+        """Take a slot, waiting for one on the event loop"""
+        with self._lock:
+            if self._take_free_slot():
+                return
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                # pass on the slot granted while being cancelled
+                self.release()
+            raise
+
+    def release(self):
+        """Give back a slot, handing it over to the longest waiting thread or coroutine"""
+        with self._lock:
+            while self._waiters:
+                if self._waiters.popleft().grant():
+                    return
+            if self._in_flight <= 0:
+                raise ValueError("ConcurrencyLimiter released too many times")
+            self._in_flight -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Timeouts, connection errors, throttling and server errors"""
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is None:
+        match = STATUS_CODE_PATTERN.search(str(error))
+        status_code = int(match.group(1)) if match else None
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE_SECONDS, maximum: float = BACKOFF_MAX_SECONDS) -> float:
+    """Exponential backoff with full jitter, so that clients throttled together do not retry together"""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def call_with_retry(func: Callable[[], T], max_retries: int, limiter: Optional[ConcurrencyLimiter] = None,
+                    base: float = BACKOFF_BASE_SECONDS, maximum: float = BACKOFF_MAX_SECONDS) -> T:
+    """Call func, retrying retryable errors; the limiter is held during each attempt, not during the backoff"""
+    for attempt in range(max_retries + 1):
+        try:
+            if limiter is None:
+                return func()
+            with limiter:
+                return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, base, maximum)
+            logger.warning(f"retrying in {delay:.2f}s after attempt {attempt + 1} failed: {e}")
+            time.sleep(delay)
+
+
+async def acall_with_retry(func: Callable[[], Awaitable[T]], max_retries: int,
+                           limiter: Optional[ConcurrencyLimiter] = None,
+                           base: float = BACKOFF_BASE_SECONDS, maximum: float = BACKOFF_MAX_SECONDS) -> T:
+    """Async version of call_with_retry, func returns a new awaitable for each attempt"""
+    for attempt in range(max_retries + 1):
+        try:
+            if limiter is None:
+                return await func()
+            async with limiter:
+                return await func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, base, maximum)
+            logger.warning(f"retrying in {delay:.2f}s after attempt {attempt + 1} failed: {e}")
+            await asyncio.sleep(delay)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Pooled keep-alive connections with a default timeout for requests sent without one"""
+
+    def __init__(self, timeout: float, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def configure_session(session: requests.Session, timeout: float, pool_size: int):
+    """
+    Mount a pool of pool_size keep-alive connections with a default timeout on the session.
+    Its own retries are disabled, the callers retry with jittered backoff.
+    """
+    adapter = TimeoutHTTPAdapter(timeout, pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
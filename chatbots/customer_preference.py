@@ -1,3 +1,6 @@
+import re
+from typing import Optional
+
 from langchain_core.messages import SystemMessage, ToolMessage, HumanMessage
 from pydantic import BaseModel
 
@@ -16,9 +19,15 @@ After you are able to discern all the information,
 give the customer a summary of the gathered preference and call the gather_preference tool."""
 
 
-def get_customer_preference_prompt(messages):
-    """Get the prompt for gathering customer preference"""
-    return [SystemMessage(content=template)] + [[m for m in messages if isinstance(m, HumanMessage)][-1]]
+def get_customer_preference_prompt(messages, conversation_summary: Optional[str] = None,
+                                   known_preferences: Optional[SystemMessage] = None):
+    """Get the prompt for gathering customer preference, with the summary of earlier turns and known slots if any"""
+    prompt = [SystemMessage(content=template)]
+    if conversation_summary:
+        prompt.append(SystemMessage(content=f"Earlier in the conversation:\n{conversation_summary}"))
+    if known_preferences is not None:
+        prompt.append(known_preferences)
+    return prompt + [[m for m in messages if isinstance(m, HumanMessage)][-1]]
 
 
 class CustomerPreference(BaseModel):
@@ -46,3 +55,11 @@ def format_customer_preference(customer_preference: CustomerPreference) -> str:
               f"Features: {customer_preference.features}"
               f"Final Price: {customer_preference.budget}")
     return string
+
+
+def normalize_customer_preference(customer_preference: CustomerPreference) -> str:
+    """Normalize the given CustomerPreference into a canonical string, used as cache key"""
+    fields = [customer_preference.product_category, customer_preference.brand,
+              customer_preference.budget, customer_preference.features]
+    fields = [re.sub(r"(?<=\d),(?=\d)", "", field.lower()) for field in fields]
+    return " | ".join(" ".join(re.sub(r"[^\w$.\-]+", " ", field).split()) for field in fields)
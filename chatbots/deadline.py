@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from langchain_core.runnables import RunnableConfig
+
+from chatbots.clients import ConcurrencyLimiter
+from chatbots.metrics import metrics
+from chatbots.utils.environment import LLM_MAX_CONCURRENCY, TURN_DEADLINE_SECONDS, VECTOR_SEARCH_MAX_CONCURRENCY
+
+logger = logging.getLogger("chatbots")
+
+T = TypeVar("T")
+
+# configurable key of the graph config holding the time.monotonic() deadline of the turn
+DEADLINE_KEY = "turn_deadline"
+
+
+class DeadlineExceeded(TimeoutError):
+    """The turn ran out of its latency budget"""
+
+
+def turn_config(thread_id, budget_seconds: Optional[float] = TURN_DEADLINE_SECONDS) -> RunnableConfig:
+    """Graph config of a turn of the thread, with a deadline budget_seconds from now unless it is None or 0"""
+    configurable = {"thread_id": thread_id}
+    if budget_seconds:
+        configurable[DEADLINE_KEY] = time.monotonic() + budget_seconds
+    return {"configurable": configurable}
+
+
+def remaining_seconds(config: Optional[RunnableConfig]) -> Optional[float]:
+    """Time left before the deadline of the turn, 0 once it passed, None without deadline"""
+    deadline = ((config or {}).get("configurable") or {}).get(DEADLINE_KEY)
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def has_time(config: Optional[RunnableConfig], needed_seconds: float = 0.0) -> bool:
+    """Whether more than needed_seconds are left before the deadline of the turn"""
+    remaining = remaining_seconds(config)
+    return remaining is None or remaining > needed_seconds
+
+
+def fallback_reason(error: BaseException) -> str:
+    return "deadline" if isinstance(error, DeadlineExceeded) else "error"
+
+
+def observe_fallback(node: str, reason: str):
+    """Count a node answering from a fallback instead of the endpoints"""
+    logger.warning(f"{node}: falling back, {reason}")
+    metrics.increment("fallbacks", node=node, reason=reason)
+
+
+# blocking calls are waited for from here, so that the node can give up on them at the deadline
+_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY + VECTOR_SEARCH_MAX_CONCURRENCY,
+                               thread_name_prefix="deadline")
+
+
+class _Slot:
+    """A limiter slot released once, by the call returning or by the caller giving up on it at the deadline"""
+
+    def __init__(self, limiter: Optional[ConcurrencyLimiter]):
+        self.limiter = limiter
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            limiter, self.limiter = self.limiter, None
+        if limiter is not None:
+            limiter.release()
+
+
+def call_with_deadline(func: Callable[[], T], config: Optional[RunnableConfig],
+                       limiter: Optional[ConcurrencyLimiter] = None) -> T:
+    """
+    Call func holding a slot of the limiter, raising DeadlineExceeded when the turn deadline passes first, while
+    waiting for the slot or for the call. The call itself is not interrupted, it keeps its thread until it returns
+    or hits its own request timeout, but its slot is released at the deadline so that it does not hold up the
+    calls of the next turns. The limit then counts the calls that turns are waiting for: abandoned calls still
+    running come on top, at most as many as the threads of the deadline executor.
+    """
+    remaining = remaining_seconds(config)
+    if remaining is None:
+        if limiter is None:
+            return func()
+        with limiter:
+            return func()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    slot = _Slot(limiter)
+    if limiter is not None and not limiter.acquire(timeout=remaining):
+        raise DeadlineExceeded()
+
+    def call() -> T:
+        try:
+            return func()
+        finally:
+            slot.release()
+
+    # in the caller's context, so that the LLM call still reports to the graph's callbacks
+    future = _executor.submit(contextvars.copy_context().run, call)
+    try:
+        return future.result(timeout=remaining_seconds(config))
+    except TimeoutError:
+        if future.cancel() or not future.done():
+            slot.release()
+            raise DeadlineExceeded() from None
+        return future.result()
+
+
+async def acall_with_deadline(func: Callable[[], Awaitable[T]], config: Optional[RunnableConfig],
+                              limiter: Optional[ConcurrencyLimiter] = None) -> T:
+    """Async version of call_with_deadline, the awaited call is cancelled at the deadline, releasing its slot"""
+
+    async def call() -> T:
+        if limiter is None:
+            return await func()
+        async with limiter:
+            return await func()
+
+    remaining = remaining_seconds(config)
+    if remaining is None:
+        return await call()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(call(), timeout=remaining)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
@@ -1,6 +1,14 @@
 from langchain_core.messages import SystemMessage
 from pydantic import BaseModel
 
+from chatbots.cache import SemanticCache
+from chatbots.utils.environment import (
+    RELATED_PRODUCT_CACHE_PATH,
+    RELATED_PRODUCT_CACHE_SIMILARITY_THRESHOLD,
+    RELATED_PRODUCT_CACHE_TTL_SECONDS,
+)
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+
 template = """
 Task: Provide Product Categories Based on Customer Preferences
 
@@ -44,3 +52,15 @@ def format_related_product_preference(related_product_preference: RelatedProduct
                        f"Product Category 2: {related_product_preference.product_category_2}",
                        f"Product Category 3: {related_product_preference.product_category_3}"]
     return preference_list
+
+
+def build_related_product_cache() -> SemanticCache:
+    """Cache of RelatedProductPreference keyed on the normalized CustomerPreference"""
+    return SemanticCache(
+        HashingEmbeddings(),
+        similarity_threshold=RELATED_PRODUCT_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds=RELATED_PRODUCT_CACHE_TTL_SECONDS,
+        path=RELATED_PRODUCT_CACHE_PATH,
+        dumps=lambda related_product_preference: related_product_preference.model_dump(),
+        loads=lambda data: RelatedProductPreference(**data),
+    )
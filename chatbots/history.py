@@ -0,0 +1,48 @@
+from typing import List, Optional, Tuple
+
+from langchain_core.messages import AnyMessage, HumanMessage, RemoveMessage, ToolMessage
+
+from chatbots.recommend import RELATED_PRODUCTS_REQUEST
+from chatbots.utils.environment import HISTORY_SUMMARY_MAX_CHARS, HISTORY_WINDOW_MESSAGES
+
+
+def is_stale(message: AnyMessage) -> bool:
+    """Messages only needed within the turn that added them: tool results and the injected related-product request"""
+    return isinstance(message, ToolMessage) or (isinstance(message, HumanMessage)
+                                                and message.content == RELATED_PRODUCTS_REQUEST)
+
+
+def summarize_messages(messages: List[AnyMessage], summary: Optional[str] = None,
+                       max_chars: int = HISTORY_SUMMARY_MAX_CHARS) -> str:
+    """
+    Extend the running summary with what the customer said in the given messages, keeping the most recent
+    max_chars characters; the assistant messages are questions and recommendations that can be rebuilt
+    """
+    lines = [summary] if summary else []
+    lines += [f"Customer: {message.content}" for message in messages
+              if isinstance(message, HumanMessage) and not is_stale(message)]
+    text = "\n".join(lines)
+    if len(text) > max_chars:
+        text = text[-max_chars:]
+        if "\n" in text:
+            # start at a line boundary
+            text = text.split("\n", 1)[1]
+    return text
+
+
+def compact_messages(messages: List[AnyMessage],
+                     summary: Optional[str] = None,
+                     window: int = HISTORY_WINDOW_MESSAGES,
+                     max_chars: int = HISTORY_SUMMARY_MAX_CHARS) -> Tuple[List[RemoveMessage], Optional[str]]:
+    """
+    Compact the conversation at the start of a turn: stale messages of previous turns are dropped, and messages
+    older than the last `window` ones are folded into the summary.
+    :return: RemoveMessage updates for the add_messages reducer, and the new summary
+    """
+    # the last message is the new user input, which is never stale
+    stale = [message for message in messages[:-1] if is_stale(message)]
+    kept = [message for message in messages[:-1] if not is_stale(message)] + messages[-1:]
+    older = kept[:-window] if window > 0 and len(kept) > window else []
+    if older:
+        summary = summarize_messages(older, summary, max_chars=max_chars)
+    return [RemoveMessage(id=message.id) for message in stale + older], summary
@@ -1,16 +1,21 @@
 from langchain_core.language_models import BaseChatModel
-from langchain_databricks import ChatDatabricks
 
-from chatbots.utils.environment import IS_DATABRICKS
+from chatbots.clients import ConcurrencyLimiter
+from chatbots.metrics import LLMMetricsCallbackHandler
+from chatbots.utils.environment import LLM_MAX_CONCURRENCY
 
-if not IS_DATABRICKS:
-    from langchain_ollama import ChatOllama
+# bounds the LLM calls in flight from this worker, the others wait for a slot
+llm_limiter = ConcurrencyLimiter(LLM_MAX_CONCURRENCY)
 
 
 def build_llm(model_name="databricks-dbrx-instruct") -> BaseChatModel:
+    # imported here, the client and its mlflow dependency take longer to import than the rest of the chatbot
+    from langchain_databricks import ChatDatabricks
+
     llm = ChatDatabricks(
         target_uri="databricks",
         endpoint=model_name,
         temperature=0,
+        callbacks=[LLMMetricsCallbackHandler()],
     )
     return llm
@@ -0,0 +1,279 @@
+import bisect
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import RunnableLambda
+
+from chatbots.utils.environment import METRICS_HOST
+
+logger = logging.getLogger("chatbots")
+
+# histograms named *_seconds use latency buckets, the others count things, e.g. tokens or search results
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+METRIC_PREFIX = "shopping_buddy_"
+HISTOGRAM_HELP = {
+    "node_seconds": "Wall time of each graph node",
+    "llm_seconds": "Wall time of each LLM call",
+    "llm_time_to_first_token_seconds": "Time to the first streamed token of each LLM call",
+    "llm_tokens": "Tokens of each LLM call, by token type",
+    "vector_search_seconds": "Wall time of each vector search call",
+    "vector_search_results": "Results returned by each vector search query",
+    "product_lookup_seconds": "Wall time of product attribute lookups",
+    "speculative_search_wait_seconds": "Wait for the speculative search in match_products, by whether it was reused",
+}
+COUNTER_HELP = {
+    "fallbacks": "Nodes answering from a local fallback, by node and reason",
+    "vector_search_cache_lookups": "Vector search cache lookups, by whether they hit",
+    "checkpoint_dropped_messages": "Oldest messages dropped from stored checkpoints over CHECKPOINT_MAX_MESSAGES",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as exposed by Prometheus, with quantiles estimated from the buckets"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket containing the q-quantile, None without observations"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Thread-safe histograms and counters keyed by name and labels"""
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        buckets = LATENCY_BUCKETS if name.endswith("_seconds") else COUNT_BUCKETS
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str):
+        """Observe the wall time of the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def summary(self) -> dict:
+        """Count, mean and p50/p95/p99 of each histogram and the value of each counter, keyed by name then labels"""
+        summary = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                summary.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = value
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                summary.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                }
+        return summary
+
+    def render_prometheus(self) -> str:
+        """Histograms and counters in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            described = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = METRIC_PREFIX + name + "_total"
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {metric} {COUNTER_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {metric} counter")
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{metric}{suffix} {value}")
+            items = sorted(self._histograms.items())
+            described = set()
+            for (name, labels), histogram in items:
+                metric = METRIC_PREFIX + name
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {metric} {HISTOGRAM_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {metric} histogram")
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    bucket_labels = f'{label_text},le="{le}"' if label_text else f'le="{le}"'
+                    lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{metric}_sum{suffix} {histogram.sum}")
+                lines.append(f"{metric}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# global registry
+metrics = MetricsRegistry()
+
+
+def instrument_node(name: str, func: Callable, afunc: Optional[Callable] = None) -> RunnableLambda:
+    """Wrap a graph node so that each run observes its wall time in node_seconds"""
+
+    # the wrappers have the signature of the node, so that it gets the graph config if it takes a config argument
+    @functools.wraps(func)
+    def timed_func(state, **kwargs):
+        with metrics.timer("node_seconds", node=name):
+            return func(state, **kwargs)
+
+    if afunc is None:
+        return RunnableLambda(timed_func, name=name)
+
+    @functools.wraps(afunc)
+    async def timed_afunc(state, **kwargs):
+        with metrics.timer("node_seconds", node=name):
+            return await afunc(state, **kwargs)
+
+    return RunnableLambda(timed_func, afunc=timed_afunc, name=name)
+
+
+def timed(name: str, **labels: str):
+    """Decorator observing the wall time of a function, sync or async, in the given histogram"""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.timer(name, **labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class LLMMetricsCallbackHandler(BaseCallbackHandler):
+    """Observe latency, time to first token and token usage of each LLM call, labeled by graph node"""
+
+    def __init__(self):
+        self._runs: Dict[UUID, list] = {}  # run_id -> [start time, node, first token seen]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._runs[run_id] = [time.perf_counter(), (metadata or {}).get("langgraph_node", "none"), False]
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._runs[run_id] = [time.perf_counter(), (metadata or {}).get("langgraph_node", "none"), False]
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and not run[2]:
+            run[2] = True
+            metrics.observe("llm_time_to_first_token_seconds", time.perf_counter() - run[0], node=run[1])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        start, node, _ = run
+        metrics.observe("llm_seconds", time.perf_counter() - start, node=node)
+        input_tokens, output_tokens = _token_usage(response)
+        if input_tokens is not None:
+            metrics.observe("llm_tokens", input_tokens, node=node, type="input")
+        if output_tokens is not None:
+            metrics.observe("llm_tokens", output_tokens, node=node, type="output")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            metrics.observe("llm_seconds", time.perf_counter() - run[0], node=run[1], status="error")
+
+
+def _token_usage(response: LLMResult) -> Tuple[Optional[int], Optional[int]]:
+    """Input and output token counts, from the message usage metadata or the provider token_usage"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serve /metrics in the Prometheus text format and /metrics.json as a JSON summary"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.summary()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_metrics_server(port: int, host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """Serve the metrics endpoints from a daemon thread, on the loopback interface unless another host is given"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
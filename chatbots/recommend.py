@@ -1,12 +1,17 @@
-from typing import List
+from typing import List, Sequence
 
+import numpy as np
 from pydantic import BaseModel
 import polars as pl
 
+from chatbots.metrics import timed
 from chatbots.utils.environment import read_dataset
 
 NO_RECOMMENDATION_MESSAGE = "I'm sorry, but I couldn't find any recommendations based on your preferences."
-product_data = read_dataset()
+# customer message added by the graph before the related products are shown
+RELATED_PRODUCTS_REQUEST = "Show me related Products"
+# product attributes shown in recommendation messages
+PRODUCT_STORE_COLUMNS = ("title", "final_price")
 
 
 class Recommendation(BaseModel):
@@ -14,15 +19,66 @@ class Recommendation(BaseModel):
     score: List[float]
 
 
+class ProductStore:
+    """
+    Product attributes indexed by product_id, built once at load time for O(k log n) lookups of k products.
+    Ids and columns are kept in a few numpy and polars buffers rather than millions of Python objects, so that
+    they load fast and stay shared between forked workers instead of being copied as the GC touches them.
+    """
+
+    def __init__(self, product_data: pl.DataFrame, columns: Sequence[str] = PRODUCT_STORE_COLUMNS):
+        self.columns = {column: product_data[column] for column in columns}
+        # sorted ids, with the first row of duplicated product ids
+        self.product_ids, self.rows = np.unique(product_data["product_id"].to_numpy(), return_index=True)
+
+    def _rows(self, product_ids: Sequence[int]) -> np.ndarray:
+        """Row of each product id, -1 for unknown ids"""
+        product_ids = np.asarray(product_ids, dtype=self.product_ids.dtype)
+        if not len(self.product_ids):
+            return np.full(len(product_ids), -1)
+        positions = np.searchsorted(self.product_ids, product_ids).clip(max=len(self.product_ids) - 1)
+        found = self.product_ids[positions] == product_ids
+        return np.where(found, self.rows[positions], -1)
+
+    def __contains__(self, product_id) -> bool:
+        return bool(self._rows([product_id])[0] >= 0)
+
+    def lookup(self, product_ids: Sequence[int]) -> dict:
+        """Get the stored columns of the given products, in the given order, skipping unknown ids"""
+        rows = self._rows(product_ids)
+        known = rows >= 0
+        data = {"product_id": [product_id for product_id, is_known in zip(product_ids, known) if is_known]}
+        for column, values in self.columns.items():
+            data[column] = values.gather(rows[known]).to_list()
+        return data
+
+
+_product_store = None
+
+
+def get_product_store() -> ProductStore:
+    """Get the product store, loading the needed dataset columns on first use"""
+    global _product_store
+    if _product_store is None:
+        _product_store = ProductStore(read_dataset(columns=["product_id", *PRODUCT_STORE_COLUMNS]))
+    return _product_store
+
+
+def set_product_store(product_store: ProductStore):
+    """Replace the product store, e.g. with one built from an in-memory catalog"""
+    global _product_store
+    _product_store = product_store
+
+
+@timed("product_lookup_seconds")
 def retrieve_recommended_product_data(recommendation: Recommendation) -> dict:
-    """Get product attributes from Recommendation object"""
-    score_df = pl.DataFrame({
-        "product_id": recommendation.product_ids,
-        "score": recommendation.score
-    })
-    recommended_df = product_data.filter(pl.col("product_id").is_in(recommendation.product_ids))
-    result_df = recommended_df.join(score_df, on="product_id", how="inner").sort("score", descending=True)
-    return result_df.to_dict(as_series=False)
+    """Get product attributes from Recommendation object, ordered by descending score"""
+    product_store = get_product_store()
+    ranked = sorted(zip(recommendation.product_ids, recommendation.score), key=lambda pair: pair[1], reverse=True)
+    result = product_store.lookup([product_id for product_id, _ in ranked])
+    known = set(result["product_id"])
+    result["score"] = [score for product_id, score in ranked if product_id in known]
+    return result
 
 
 def format_recommendation_message(recommended_product_data: dict) -> str:
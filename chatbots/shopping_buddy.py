@@ -1,34 +1,85 @@
+import gc
 import logging
-from typing import Annotated, Optional
+from typing import Annotated, AsyncIterator, List, Optional, Tuple
 
+from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import AnyMessage, AIMessage, ToolMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
 from langgraph.constants import END
 from typing_extensions import TypedDict
 
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, START, add_messages
 
+from chatbots.cache import SemanticCache
+from chatbots.checkpoint import build_checkpointer
 from chatbots.get_related_product import (
     RelatedProductPreference,
     get_related_product_preference,
     parse_related_product_preference,
     format_related_product_preference,
+    build_related_product_cache,
+)
+from chatbots.deadline import (
+    acall_with_deadline,
+    call_with_deadline,
+    fallback_reason,
+    has_time,
+    observe_fallback,
+    remaining_seconds,
+    turn_config,
 )
 from chatbots.customer_preference import (
     CustomerPreference,
     get_customer_preference_prompt,
     parse_customer_preference,
     format_customer_preference,
+    normalize_customer_preference,
 )
-from chatbots.llm import build_llm
+from chatbots.history import compact_messages
+from chatbots.llm import build_llm, llm_limiter
+from chatbots.metrics import instrument_node
 from chatbots.recommend import (
     Recommendation,
     NO_RECOMMENDATION_MESSAGE,
+    RELATED_PRODUCTS_REQUEST,
     retrieve_recommended_product_data,
     format_recommendation_message,
     format_relate_product_message,
+    get_product_store,
+)
+from chatbots.slot_filling import (
+    fill_slots,
+    get_slot_extractor,
+    known_slots_prompt,
+    merge_tool_call_slots,
+    missing_slots,
+    preference_message,
+)
+from chatbots.speculative_search import (
+    aspeculative_search_result,
+    get_speculative_searches,
+    partial_customer_preference,
+    speculative_search_result,
+)
+from chatbots.utils.environment import HYBRID_SEARCH, SPECULATIVE_SEARCH
+from chatbots.vectorstore.hybrid_search import (
+    hybrid_search_products,
+    ahybrid_search_products,
+    local_search_products,
+    local_search_products_batch,
+    get_product_filter_index,
+)
+from chatbots.vectorstore.related_graph import get_related_product_graph
+from chatbots.vectorstore.vector_search import (
+    vector_search_product,
+    vector_search_products_batch,
+    avector_search_product,
+    avector_search_products_batch,
+    process_search_result,
+    select_unique_top_products,
+    get_vector_index,
 )
-from chatbots.vectorstore.vector_search import vector_search_product, process_search_result
 
 logger = logging.getLogger("chatbots")
 
@@ -45,17 +96,37 @@ Feel free to share as much or as little as you like, and I’ll do my best to re
 """)
 
 
+BUSY_MESSAGE = "I'm sorry, I'm taking longer than usual to answer. Could you send your message again?"
+
+# nodes whose LLM replies are shown to the customer, streamed token by token
+STREAMED_NODES = {"gather_preference"}
+# state keys of the products shown, reset before each search
+RESULT_KEYS = ("recommendation", "recommended_product_data", "related_product_recommendation", "related_product_data")
+# columns of the product searches
+SEARCH_COLUMNS = ["product_id", "title", "text"]
+# time left in the turn below which the related-product branch does not ask the LLM
+RELATED_PRODUCTS_MIN_SECONDS = 2.0
+
+
 class State(TypedDict):
     current_user_input: Optional[str]
     messages: Annotated[list[AnyMessage], add_messages]
+    # customer messages that left the message window
+    conversation_summary: Optional[str]
+    # CustomerPreference fields gathered so far, and the only missing one when it was just asked
+    preference_slots: dict
+    pending_slot: Optional[str]
+    # key of the vector search started from the slots, picked up by match_products
+    speculative_search: Optional[str]
 
     customer_preference: CustomerPreference
-    recommendation: Recommendation
-    recommended_product_data: dict
+    # results of the last search, None when it found nothing or was skipped
+    recommendation: Optional[Recommendation]
+    recommended_product_data: Optional[dict]
 
     related_product_preference: RelatedProductPreference
-    related_product_recommendation: Recommendation
-    related_product_data: dict
+    related_product_recommendation: Optional[Recommendation]
+    related_product_data: Optional[dict]
 
 
 def manage_state(state: State) -> State:
@@ -66,6 +137,11 @@ def manage_state(state: State) -> State:
         state["current_user_input"] = None
     elif len(state["messages"]) > 1:
         state["current_user_input"] = state["messages"][-1].content
+        # keep the checkpoint and the prompts bounded over long conversations
+        removals, state["conversation_summary"] = compact_messages(state["messages"],
+                                                                   state.get("conversation_summary"))
+        if removals:
+            state["messages"] = removals
     return state
 
 
@@ -91,11 +167,76 @@ def greeting(state: State) -> State:
     return state
 
 
-def gather_preference(state: State) -> State:
-    """Get user preference"""
+def _fill_preference_slots(state: State) -> bool:
+    """
+    Add the slots given by the last customer message to the state, and start a speculative search from them
+    when they changed; return whether any slot is new
+    """
+    slots = state.get("preference_slots") or {}
+    text = [m for m in state["messages"] if isinstance(m, HumanMessage)][-1].content
+    new_slots = fill_slots(slots, text, get_slot_extractor(), state.get("pending_slot"))
+    state["preference_slots"] = {**slots, **new_slots}
+    logger.debug(f"preference slots: {state['preference_slots']}")
+    if new_slots and SPECULATIVE_SEARCH:
+        # search from what is known already, while the LLM answers or the customer types
+        customer_preference = partial_customer_preference(state["preference_slots"])
+        if customer_preference is not None:
+            state["speculative_search"] = get_speculative_searches().start(customer_preference,
+                                                                           replaces=state.get("speculative_search"))
+    return bool(new_slots)
+
+
+def _update_preference_slots(state: State, response: AIMessage):
+    """Complete the LLM tool call with the known slots, or remember the slot asked when only one is missing"""
+    state["preference_slots"] = {**state["preference_slots"],
+                                 **merge_tool_call_slots(response, state["preference_slots"])}
+    missing = missing_slots(state["preference_slots"])
+    state["pending_slot"] = missing[0] if not response.tool_calls and len(missing) == 1 else None
+
+
+def _busy(state: State, error: Exception) -> State:
+    """Ask the customer to send their message again when the LLM did not answer in time, keeping the slots filled"""
+    observe_fallback("gather_preference", fallback_reason(error))
+    state["messages"] = add_messages(state["messages"], [AIMessage(content=BUSY_MESSAGE)])
+    return state
+
+
+def gather_preference(state: State, config: Optional[RunnableConfig] = None) -> State:
+    """Get user preference, asking the LLM only when the rule-based slot filling is not enough"""
     logger.debug("----------gather_preference----------")
-    system_messages = get_customer_preference_prompt(state["messages"])
-    response = llm_with_preference_tools.invoke(system_messages)
+    if _fill_preference_slots(state) and not missing_slots(state["preference_slots"]):
+        state["pending_slot"] = None
+        state["messages"] = add_messages(state["messages"], [preference_message(state["preference_slots"])])
+        return state
+    system_messages = get_customer_preference_prompt(state["messages"], state.get("conversation_summary"),
+                                                     known_slots_prompt(state["preference_slots"]))
+
+    try:
+        response = call_with_deadline(lambda: get_llm_with_preference_tools().invoke(system_messages), config,
+                                      limiter=llm_limiter)
+    except Exception as e:
+        return _busy(state, e)
+    _update_preference_slots(state, response)
+    state["messages"] = add_messages(state["messages"], [response])
+    return state
+
+
+async def agather_preference(state: State, config: Optional[RunnableConfig] = None) -> State:
+    """Get user preference, async version of gather_preference"""
+    logger.debug("----------gather_preference----------")
+    if _fill_preference_slots(state) and not missing_slots(state["preference_slots"]):
+        state["pending_slot"] = None
+        state["messages"] = add_messages(state["messages"], [preference_message(state["preference_slots"])])
+        return state
+    system_messages = get_customer_preference_prompt(state["messages"], state.get("conversation_summary"),
+                                                     known_slots_prompt(state["preference_slots"]))
+
+    try:
+        response = await acall_with_deadline(lambda: get_llm_with_preference_tools().ainvoke(system_messages), config,
+                                             limiter=llm_limiter)
+    except Exception as e:
+        return _busy(state, e)
+    _update_preference_slots(state, response)
     state["messages"] = add_messages(state["messages"], [response])
     return state
 
@@ -110,6 +251,12 @@ def parse_preference(state: State):
             tool_call_id=state["messages"][-1].tool_calls[0]["id"],
         )
     ])
+    # results of a previous search, not to be shown again when this one finds nothing or is skipped
+    for key in RESULT_KEYS:
+        state[key] = None
+    # the preferences are used up, the next request of the customer starts from no known slot
+    state["preference_slots"] = {}
+    state["pending_slot"] = None
     return state
 
 
@@ -126,83 +273,225 @@ def preference_router(state):
     return "gather_preference"
 
 
-def match_products(state: State):
-    """Match products to user preference"""
-    logger.debug("----------match_product----------")
+def matching_router(state: State) -> list:
+    """Conditional edge after parse_preference, starting the related-product branch unless it needs matched products"""
+    if get_related_product_graph() is None:
+        return ["match_products", "find_related_products"]
+    return ["match_products"]
+
+
+def matched_router(state: State) -> list:
+    """Conditional edge after match_products, starting the related-product branch if it needs matched products"""
+    if get_related_product_graph() is None:
+        return ["recommend"]
+    return ["recommend", "find_related_products"]
+
+
+# match_products, recommend and find_related_products run in parallel branches,
+# so they return only the state keys they update to avoid conflicting writes
+
+
+def _update_recommendation(search_result: dict) -> dict:
+    update = {}
+    product_ids, similarity = process_search_result(search_result)
+    if product_ids:
+        update["recommendation"] = Recommendation(product_ids=product_ids, score=similarity)
+        logger.debug(f"recommendations: {update['recommendation']}")
+    return update
+
+
+def _search_products(customer_preference: CustomerPreference) -> dict:
+    if HYBRID_SEARCH:
+        # budget, brand and category pre-filtering, with lexical and vector rankings fused
+        return hybrid_search_products(customer_preference, columns=SEARCH_COLUMNS)
     # format customer_preference
-    query_text = format_customer_preference(state["customer_preference"])
+    query_text = format_customer_preference(customer_preference)
     # vector search
-    search_result = vector_search_product(query_text, columns=["product_id", "title", "text"])
-    product_ids, similarity = process_search_result(search_result)
-    if len(product_ids):
-        state["recommendation"] = Recommendation(product_ids=product_ids, score=similarity)
-        logger.debug(f"recommendations: {state['recommendation']}")
-    return state
+    return vector_search_product(query_text, columns=SEARCH_COLUMNS)
 
 
-def recommend(state: State):
+async def _asearch_products(customer_preference: CustomerPreference) -> dict:
+    if HYBRID_SEARCH:
+        return await ahybrid_search_products(customer_preference, columns=SEARCH_COLUMNS)
+    query_text = format_customer_preference(customer_preference)
+    return await avector_search_product(query_text, columns=SEARCH_COLUMNS)
+
+
+def _fallback_recommendation(customer_preference: CustomerPreference, error: Exception) -> dict:
+    """Recommendation from the in-memory filter index when the vector search failed or ran out of time"""
+    observe_fallback("match_products", fallback_reason(error))
+    if not HYBRID_SEARCH:
+        return {}
+    return _update_recommendation(local_search_products(customer_preference, columns=SEARCH_COLUMNS))
+
+
+def match_products(state: State, config: Optional[RunnableConfig] = None) -> dict:
+    """Match products to user preference"""
+    logger.debug("----------match_product----------")
+    search_result = speculative_search_result(state.get("speculative_search"), state["customer_preference"],
+                                              columns=SEARCH_COLUMNS, timeout=remaining_seconds(config))
+    if search_result is not None:
+        return _update_recommendation(search_result)
+    try:
+        search_result = call_with_deadline(lambda: _search_products(state["customer_preference"]), config)
+    except Exception as e:
+        return _fallback_recommendation(state["customer_preference"], e)
+    return _update_recommendation(search_result)
+
+
+async def amatch_products(state: State, config: Optional[RunnableConfig] = None) -> dict:
+    """Match products to user preference, async version of match_products"""
+    logger.debug("----------match_product----------")
+    search_result = await aspeculative_search_result(state.get("speculative_search"), state["customer_preference"],
+                                                     columns=SEARCH_COLUMNS, timeout=remaining_seconds(config))
+    if search_result is not None:
+        return _update_recommendation(search_result)
+    try:
+        search_result = await acall_with_deadline(lambda: _asearch_products(state["customer_preference"]), config)
+    except Exception as e:
+        return _fallback_recommendation(state["customer_preference"], e)
+    return _update_recommendation(search_result)
+
+
+def recommend(state: State) -> dict:
     """Display recommendations"""
     logger.debug("----------recommend----------")
-    if "recommendation" not in state:
+    if state.get("recommendation") is None:
         # no recommendation
-        state["messages"] = add_messages(state["messages"], AIMessage(content=NO_RECOMMENDATION_MESSAGE))
+        return {"messages": [AIMessage(content=NO_RECOMMENDATION_MESSAGE)]}
     # retrieve data for matched items
-    state["recommended_product_data"] = retrieve_recommended_product_data(state["recommendation"])
-    state["messages"] = add_messages(state["messages"],
-                                     AIMessage(
-                                         content=format_recommendation_message(state["recommended_product_data"])))
-    return state
-
-
-def related_router(state: State) -> str:
-    if state["recommended_product_data"] is None:
-        logger.debug("ROUTER: to the end")
-        return END
+    recommended_product_data = retrieve_recommended_product_data(state["recommendation"])
+    return {"recommended_product_data": recommended_product_data,
+            "messages": [AIMessage(content=format_recommendation_message(recommended_product_data))]}
+
+
+def _update_related_product_preference(response: AIMessage) -> dict:
+    """Parse the related product categories from the LLM response"""
+    return {
+        "related_product_preference": parse_related_product_preference(response.tool_calls[0]["args"]),
+        "messages": [
+            ToolMessage(
+                content="Related Product Preference gathered",
+                tool_call_id=response.tool_calls[0]["id"],
+            )
+        ],
+    }
+
+
+def _update_related_product_recommendation(update: dict, search_results: list) -> dict:
+    product_id_list, similarity_list = select_unique_top_products(search_results)
+    if len(product_id_list):
+        update["related_product_recommendation"] = Recommendation(product_ids=product_id_list, score=similarity_list)
+        logger.debug(f"related product recommendations: {update['related_product_recommendation']}")
+    return update
+
+
+def _related_products_from_graph(state: State) -> Optional[dict]:
+    """Look up products related to the recommended ones in the precomputed graph, None if there are none"""
+    related_product_graph = get_related_product_graph()
+    if related_product_graph is None or state.get("recommendation") is None:
+        return None
+    product_ids, scores = related_product_graph.related_products(state["recommendation"].product_ids)
+    if not product_ids:
+        return None
+    recommendation = Recommendation(product_ids=product_ids, score=scores)
+    logger.debug(f"related product recommendations from graph: {recommendation}")
+    return {"related_product_recommendation": recommendation}
+
+
+def _related_products_too_late(config: Optional[RunnableConfig]) -> bool:
+    """Whether too little time is left in the turn to ask the LLM, the turn then goes on without related products"""
+    if has_time(config, RELATED_PRODUCTS_MIN_SECONDS):
+        return False
+    observe_fallback("find_related_products", "deadline")
+    return True
+
+
+def _fallback_related_product_search(queries: List[str], error: Exception) -> List[dict]:
+    """Search the related categories in the in-memory filter index when the vector search failed or ran out of time"""
+    observe_fallback("find_related_products", fallback_reason(error))
+    if not HYBRID_SEARCH:
+        return []
+    return local_search_products_batch(queries, columns=SEARCH_COLUMNS, num_results=5)
+
+
+def find_related_products(state: State, config: Optional[RunnableConfig] = None) -> dict:
+    """
+    Find products related to the customer preference, concurrently with match_products and recommend.
+    The branch is skipped when the turn runs out of time, it never delays the recommendation.
+    """
+    logger.debug("----------find_related_products----------")
+    update = _related_products_from_graph(state)
+    if update is not None:
+        return update
+    # similar customer preferences share their related product categories, skip the LLM on a cache hit
+    cache_key = normalize_customer_preference(state["customer_preference"])
+    related_product_preference = get_related_product_cache().get(cache_key)
+    if related_product_preference is not None:
+        update = {"related_product_preference": related_product_preference}
+    elif _related_products_too_late(config):
+        return {}
     else:
-        logger.debug("ROUTER: find_related_products")
-        return "find_related_products"
-
-
-def find_related_products(state: State) -> State:
+        system_messages = get_related_product_preference(state["customer_preference"])
+        try:
+            response = call_with_deadline(lambda: get_llm_with_product_tools().invoke(system_messages), config,
+                                          limiter=llm_limiter)
+        except Exception as e:
+            observe_fallback("find_related_products", fallback_reason(e))
+            return {}
+        update = _update_related_product_preference(response)
+        get_related_product_cache().set(cache_key, update["related_product_preference"])
+    related_product_preference = format_related_product_preference(update["related_product_preference"])
+    # vector search, one batched call for all related categories
+    try:
+        search_results = call_with_deadline(
+            lambda: vector_search_products_batch(related_product_preference, columns=SEARCH_COLUMNS, num_results=5),
+            config)
+    except Exception as e:
+        search_results = _fallback_related_product_search(related_product_preference, e)
+    return _update_related_product_recommendation(update, search_results)
+
+
+async def afind_related_products(state: State, config: Optional[RunnableConfig] = None) -> dict:
+    """Async version of find_related_products"""
     logger.debug("----------find_related_products----------")
-    system_messages = get_related_product_preference(state["customer_preference"])
-    response = llm_with_product_tools.invoke(system_messages)
-    # state["messages"] = add_messages(state["messages"], [response])
-    state["related_product_preference"] = parse_related_product_preference(response.tool_calls[0]["args"])
-    state["messages"] = add_messages(state["messages"], [
-        ToolMessage(
-            content="Related Product Preference gathered",
-            tool_call_id=response.tool_calls[0]["id"],
-        )
-    ])
-    related_product_preference = format_related_product_preference(state["related_product_preference"])
-    # vector search
-    product_id_list = []
-    similarity_list = []
-    for product in related_product_preference:
-        search_result = vector_search_product(product, columns=["product_id", "title", "text"], num_results=5)
-        product_ids, similarities = process_search_result(search_result)
-        for product_id, similarity in zip(product_ids, similarities):
-            if product_id in product_id_list:
-                continue
-            else:
-                product_id_list.append(product_id)
-                similarity_list.append(similarity)
-                break
-    if len(product_ids):
-        state["related_product_recommendation"] = Recommendation(product_ids=product_id_list, score=similarity_list)
-        logger.debug(f"related product recommendations: {state['related_product_recommendation']}")
-
-    return state
+    update = _related_products_from_graph(state)
+    if update is not None:
+        return update
+    cache_key = normalize_customer_preference(state["customer_preference"])
+    related_product_preference = get_related_product_cache().get(cache_key)
+    if related_product_preference is not None:
+        update = {"related_product_preference": related_product_preference}
+    elif _related_products_too_late(config):
+        return {}
+    else:
+        system_messages = get_related_product_preference(state["customer_preference"])
+        try:
+            response = await acall_with_deadline(lambda: get_llm_with_product_tools().ainvoke(system_messages),
+                                                 config, limiter=llm_limiter)
+        except Exception as e:
+            observe_fallback("find_related_products", fallback_reason(e))
+            return {}
+        update = _update_related_product_preference(response)
+        get_related_product_cache().set(cache_key, update["related_product_preference"])
+    related_product_preference = format_related_product_preference(update["related_product_preference"])
+    try:
+        search_results = await acall_with_deadline(
+            lambda: avector_search_products_batch(related_product_preference, columns=SEARCH_COLUMNS, num_results=5),
+            config)
+    except Exception as e:
+        search_results = _fallback_related_product_search(related_product_preference, e)
+    return _update_related_product_recommendation(update, search_results)
 
 
 def recommend_related_products(state: State) -> State:
+    """Display related products, once both the recommendation and the related-product branches are done"""
     logger.debug("----------recommend_related_products---------")
-    if "related_product_recommendation" in state:
+    if state.get("related_product_recommendation") is not None:
         state["related_product_data"] = retrieve_recommended_product_data(state["related_product_recommendation"])
         state["messages"] = add_messages(state["messages"],
                                          HumanMessage(
-                                             content="Show me related Products"))
+                                             content=RELATED_PRODUCTS_REQUEST))
         state["messages"] = add_messages(state["messages"],
                                          AIMessage(
                                              content=format_relate_product_message(state["related_product_data"])))
@@ -211,41 +500,117 @@ def recommend_related_products(state: State) -> State:
 
 def shopping_buddy_graph_builder():
     builder = StateGraph(State)
-    builder.add_node("gather_preference", gather_preference)
-    builder.add_node("manage_state", manage_state)
-    builder.add_node("greeting", lambda state: greeting(state))
-    builder.add_node("parse_preference", parse_preference)
-    builder.add_node("match_products", match_products)
-    builder.add_node("recommend", recommend)
-    builder.add_node("find_related_products", find_related_products)
-    builder.add_node("recommend_related_products", recommend_related_products)
+    builder.add_node("gather_preference", instrument_node("gather_preference", gather_preference, agather_preference))
+    builder.add_node("manage_state", instrument_node("manage_state", manage_state))
+    builder.add_node("greeting", instrument_node("greeting", greeting))
+    builder.add_node("parse_preference", instrument_node("parse_preference", parse_preference))
+    builder.add_node("match_products", instrument_node("match_products", match_products, amatch_products))
+    builder.add_node("recommend", instrument_node("recommend", recommend))
+    builder.add_node("find_related_products",
+                     instrument_node("find_related_products", find_related_products, afind_related_products))
+    builder.add_node("recommend_related_products",
+                     instrument_node("recommend_related_products", recommend_related_products))
 
     builder.add_edge(START, "manage_state")
     builder.add_edge("manage_state", "greeting")
     builder.add_conditional_edges("greeting", greeting_router, [END, "gather_preference"])
     builder.add_conditional_edges("gather_preference", preference_router,
                                   ["parse_preference", "gather_preference", END])
-    builder.add_edge("parse_preference", "match_products")
-    builder.add_edge("match_products", "recommend")
-    builder.add_conditional_edges("recommend", related_router, ["find_related_products", END])
-    builder.add_edge("find_related_products", "recommend_related_products")
+    # the related-product branch runs in parallel to the recommendation: right after parse_preference when it
+    # asks the LLM, after match_products when it looks up the neighbors of the recommended products
+    builder.add_conditional_edges("parse_preference", matching_router, ["match_products", "find_related_products"])
+    builder.add_conditional_edges("match_products", matched_router, ["recommend", "find_related_products"])
+    builder.add_edge(["recommend", "find_related_products"], "recommend_related_products")
     builder.add_edge("recommend_related_products", END)
     return builder
 
 
-def shopping_buddy_graph(builder):
-    # adding thread-level persistence
-    memory = MemorySaver()
-    graph = builder.compile(checkpointer=memory)
+def shopping_buddy_graph(builder, checkpointer: Optional[BaseCheckpointSaver] = None):
+    # adding thread-level persistence, in memory unless configured otherwise
+    if checkpointer is None:
+        checkpointer = build_checkpointer()
+    graph = builder.compile(checkpointer=checkpointer)
     return graph
 
 
-# global object
-llm = build_llm()
-llm_with_preference_tools = llm.bind_tools([CustomerPreference])
-llm_with_product_tools = llm.bind_tools([RelatedProductPreference])
-builder = shopping_buddy_graph_builder()
-graph = shopping_buddy_graph(builder)
+# global objects, built on first use so that importing this module starts no client and loads no data
+_llm = None
+_llm_with_preference_tools = None
+_llm_with_product_tools = None
+_related_product_cache = None
+_graph = None
+
+
+def get_llm() -> BaseChatModel:
+    """Get the chat model, one client shared by the tool-bound models"""
+    global _llm
+    if _llm is None:
+        _llm = build_llm()
+    return _llm
+
+
+def get_llm_with_preference_tools() -> BaseChatModel:
+    global _llm_with_preference_tools
+    if _llm_with_preference_tools is None:
+        _llm_with_preference_tools = get_llm().bind_tools([CustomerPreference])
+    return _llm_with_preference_tools
+
+
+def get_llm_with_product_tools() -> BaseChatModel:
+    global _llm_with_product_tools
+    if _llm_with_product_tools is None:
+        _llm_with_product_tools = get_llm().bind_tools([RelatedProductPreference])
+    return _llm_with_product_tools
+
+
+def set_llms(llm_with_preference_tools: Optional[BaseChatModel] = None,
+             llm_with_product_tools: Optional[BaseChatModel] = None):
+    """Replace the chat models with tools bound, e.g. with fakes; None builds them again on first use"""
+    global _llm_with_preference_tools, _llm_with_product_tools
+    _llm_with_preference_tools = llm_with_preference_tools
+    _llm_with_product_tools = llm_with_product_tools
+
+
+def get_related_product_cache() -> SemanticCache:
+    global _related_product_cache
+    if _related_product_cache is None:
+        _related_product_cache = build_related_product_cache()
+    return _related_product_cache
+
+
+def get_graph():
+    """Get the compiled graph, built with the configured checkpointer on first use"""
+    global _graph
+    if _graph is None:
+        _graph = shopping_buddy_graph(shopping_buddy_graph_builder())
+    return _graph
+
+
+def set_graph(graph):
+    """Replace the compiled graph, e.g. with one using another checkpointer"""
+    global _graph
+    _graph = graph
+
+
+def warmup(freeze: bool = False):
+    """
+    Build the chat models and the graph and load the catalog indexes ahead of the first conversation.
+    In a server forking workers, call it with freeze=True in the parent before forking: the objects are moved to
+    the permanent GC generation, so the workers share their memory pages instead of copying them on collection.
+    """
+    get_llm_with_preference_tools()
+    get_llm_with_product_tools()
+    get_related_product_cache()
+    get_graph()
+    get_product_store()
+    get_vector_index()
+    get_slot_extractor()
+    get_related_product_graph()
+    if HYBRID_SEARCH:
+        get_product_filter_index()
+    if freeze:
+        gc.collect()
+        gc.freeze()
 
 
 # for frontend
@@ -257,27 +622,95 @@ def shopping_buddy(user_message: str, thread_id: int = 1) -> str:
     :param thread_id: int (default 1), update thread_id to clear memory
     :yield: (str) chatbot response
     """
-    config = {"configurable": {"thread_id": thread_id}}
+    config = turn_config(thread_id)
 
     # empty input for involving greeting
     empty_input = []
-    for event in graph.stream({"messages": empty_input}, config=config):
+    for event in get_graph().stream({"messages": empty_input}, config=config):
         for value in event.values():
-            if len(value["messages"]) > 0 and isinstance(value["messages"][-1], AIMessage):
+            if value and value.get("messages") and isinstance(value["messages"][-1], AIMessage):
                 yield value["messages"][-1].content
 
-    for event in graph.stream({"messages": [("user", user_message)]}, config=config):
+    for event in get_graph().stream({"messages": [("user", user_message)]}, config=config):
         for value in event.values():
-            if len(value["messages"]) > 0 and isinstance(value["messages"][-1], AIMessage):
+            if value and value.get("messages") and isinstance(value["messages"][-1], AIMessage):
                 yield value["messages"][-1].content
 
 
+async def ashopping_buddy(user_message: str, thread_id: int = 1) -> AsyncIterator[str]:
+    """
+    Async generator function that yields chatbot response based on user message, see shopping_buddy.
+    LLM and vector search calls are awaited, so one event loop can serve many conversations concurrently.
+    :param user_message: str
+    :param thread_id: int (default 1), update thread_id to clear memory
+    :yield: (str) chatbot response
+    """
+    config = turn_config(thread_id)
+
+    # empty input for involving greeting
+    empty_input = []
+    async for event in get_graph().astream({"messages": empty_input}, config=config):
+        for value in event.values():
+            if value and value.get("messages") and isinstance(value["messages"][-1], AIMessage):
+                yield value["messages"][-1].content
+
+    async for event in get_graph().astream({"messages": [("user", user_message)]}, config=config):
+        for value in event.values():
+            if value and value.get("messages") and isinstance(value["messages"][-1], AIMessage):
+                yield value["messages"][-1].content
+
+
+async def astream_shopping_buddy(user_message: str, thread_id: int = 1) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Async generator function that streams the chatbot response token by token.
+    LLM replies are streamed as they are generated, messages built by other nodes are yielded whole.
+    A new thread starts with the greeting message.
+    :param user_message: str
+    :param thread_id: int (default 1), update thread_id to clear memory
+    :yield: (message_id, text), text is appended to the message with the given id
+    """
+    config = turn_config(thread_id)
+
+    inputs = [{"messages": [("user", user_message)]}]
+    snapshot = await get_graph().aget_state(config)
+    if not snapshot.values.get("messages"):
+        # empty input for involving greeting
+        inputs.insert(0, {"messages": []})
+
+    streamed_message_ids = set()
+    for graph_input in inputs:
+        async for mode, chunk in get_graph().astream(graph_input, config=config, stream_mode=["messages", "updates"]):
+            if mode == "messages":
+                message, metadata = chunk
+                if metadata.get("langgraph_node") in STREAMED_NODES and message.content:
+                    streamed_message_ids.add(message.id)
+                    yield message.id, message.content
+                continue
+            for value in chunk.values():
+                if not value or not value.get("messages"):
+                    continue
+                message = value["messages"][-1]
+                if isinstance(message, AIMessage) and message.content and message.id not in streamed_message_ids:
+                    streamed_message_ids.add(message.id)
+                    yield message.id, message.content
+
+
+def clear_thread(thread_id) -> None:
+    """Delete the conversation state of a thread, e.g. when its session ends"""
+    get_graph().checkpointer.delete_thread(thread_id)
+
+
+async def aclear_thread(thread_id) -> None:
+    """Async version of clear_thread"""
+    await get_graph().checkpointer.adelete_thread(thread_id)
+
+
 # for development
 def print_buddy_response(input_message_list: list, config: dict):
-    for event in graph.stream({"messages": input_message_list}, config=config):
+    for event in get_graph().stream({"messages": input_message_list}, config=config):
         for value in event.values():
             logger.debug(value)
-            if len(value["messages"]) > 0 and isinstance(value["messages"][-1], AIMessage):
+            if value and value.get("messages") and isinstance(value["messages"][-1], AIMessage):
                 if value["messages"][-1].type != "tool_call":
                     print("Shopping Buddy:", value["messages"][-1].content)
                 if value["messages"][-1].tool_calls:
@@ -302,7 +735,11 @@ Type "clear" to clear memory and start a new thread.""")
             print("Shopping Buddy: Goodbye!")
             break
         if user_input.lower() in ["clear"]:
+            clear_thread(thread_id)
             thread_id += 1
+            config = {"configurable": {"thread_id": thread_id}}
+            print(f"Starting thread {thread_id}")
+            print_buddy_response(first_input, config)
         else:
             input_msg_list = [("user", user_input)]
             print_buddy_response(input_msg_list, config)
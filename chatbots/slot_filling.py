@@ -0,0 +1,181 @@
+import re
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+import polars as pl
+from langchain_core.messages import AIMessage, SystemMessage
+
+from chatbots.utils.environment import scan_dataset
+from chatbots.vectorstore.hybrid_search import parse_budget, tokenize
+
+# CustomerPreference fields, in the order they are asked
+SLOTS = ("product_category", "brand", "budget", "features")
+SLOT_NAMES = {
+    "product_category": "Product Category",
+    "brand": "Brand Preferences",
+    "budget": "Budget Range",
+    "features": "Features",
+}
+# answers meaning the customer has no preference for the slot that was asked
+NO_PREFERENCE_PATTERN = re.compile(r"^\W*(no|none|nope|any|anything|whatever|no preference|not really|"
+                                   r"doesn'?t matter|don'?t care|no idea)\W*$", re.IGNORECASE)
+NO_PREFERENCE = "None"
+# category words too generic to identify a category on their own, e.g. "home" in "Smart Home, Security & Wi-Fi"
+CATEGORY_STOPWORDS = {"and", "accessories", "home", "other", "more", "all", "smart", "security", "wi", "fi"}
+# other names of the catalog root categories, recognized in addition to the full names and their parts
+CATEGORY_ALIASES = {
+    "television": "TV & Home Theater",
+    "headphones": "Audio",
+    "speakers": "Audio",
+    "smartphone": "Cell Phones",
+    "smartwatch": "Wearable Technology",
+    "game console": "Video Games",
+}
+# questions back to the assistant, rather than answers to the slot it asked
+QUESTION_PATTERN = re.compile(r"\?\s*$|^\W*(what|which|why|how|can|could|do|does|is|are|should|would)\b",
+                              re.IGNORECASE)
+# longer answers to the features question are left to the LLM
+FEATURES_MAX_WORDS = 12
+
+
+def _singular(token: str) -> str:
+    return token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token
+
+
+def format_budget(low: Optional[float], high: Optional[float]) -> Optional[str]:
+    if low is not None and high is not None:
+        return f"${low:g} - ${high:g}"
+    if high is not None:
+        return f"under ${high:g}"
+    if low is not None:
+        return f"over ${low:g}"
+    return None
+
+
+class SlotExtractor:
+    """Rule-based extraction of budget ranges, catalog brands and catalog root categories from a customer message"""
+
+    def __init__(self, brands: Iterable[str], categories: Iterable[str], aliases: Optional[Dict[str, str]] = None):
+        self.brands = {tuple(tokenize(brand)): brand for brand in brands if brand and tokenize(brand)}
+        # a category is recognized by its full name, one of the parts of a compound name, e.g. "tablets" for
+        # "Computers & Tablets", or an alias; single generic words and names shared by categories are not used
+        categories = [category for category in categories if category]
+        names = [(name, category) for category in categories
+                 for name in {category, *re.split(r"\s*[,&]\s*", category)}]
+        names += [(alias, category) for alias, category in (CATEGORY_ALIASES if aliases is None else aliases).items()
+                  if category in categories]
+        self.categories: Dict[tuple, str] = {}
+        ambiguous = set()
+        for name, category in names:
+            phrase = tuple(_singular(token) for token in tokenize(name))
+            if not phrase or (len(phrase) == 1 and (phrase[0] in CATEGORY_STOPWORDS or len(phrase[0]) < 2)):
+                continue
+            if self.categories.setdefault(phrase, category) != category:
+                ambiguous.add(phrase)
+        for phrase in ambiguous:
+            del self.categories[phrase]
+
+    @classmethod
+    def from_catalog(cls, catalog: pl.LazyFrame) -> "SlotExtractor":
+        """Extractor of the brands and root categories of a catalog with title and root_category columns"""
+        # brands are the title prefixes before " - ", as in "Apple - MacBook Air 13" Laptop"
+        brands = (catalog.filter(pl.col("title").str.contains(" - ", literal=True))
+                  .select(pl.col("title").str.split(" - ").list.first().str.strip_chars().unique())
+                  .collect().to_series().to_list())
+        categories = catalog.select(pl.col("root_category").unique()).collect().to_series().to_list()
+        return cls(brands, categories)
+
+    @staticmethod
+    def _contains(tokens: List[str], phrase: tuple) -> bool:
+        return any(tuple(tokens[i:i + len(phrase)]) == phrase for i in range(len(tokens) - len(phrase) + 1))
+
+    def extract(self, text: str) -> Dict[str, str]:
+        """Slots found in the text, longest brand match first"""
+        slots = {}
+        budget = format_budget(*parse_budget(text)) if re.search(r"\d", text) else None
+        if budget and re.search(r"\$|budget|price|under|below|over|above|less|more|max|between|around", text,
+                                re.IGNORECASE):
+            slots["budget"] = budget
+        tokens = tokenize(text)
+        for phrase in sorted(self.brands, key=len, reverse=True):
+            if self._contains(tokens, phrase):
+                slots["brand"] = self.brands[phrase]
+                break
+        singular_tokens = [_singular(token) for token in tokens]
+        for phrase in sorted(self.categories, key=len, reverse=True):
+            if self._contains(singular_tokens, phrase):
+                slots["product_category"] = self.categories[phrase]
+                break
+        return slots
+
+
+def missing_slots(slots: Dict[str, str]) -> List[str]:
+    return [slot for slot in SLOTS if not slots.get(slot)]
+
+
+def fill_slots(slots: Dict[str, str], text: str, extractor: SlotExtractor,
+               pending_slot: Optional[str] = None) -> Dict[str, str]:
+    """
+    Slots given by a customer message: rule-based extraction, plus the answer to the slot asked last turn
+    when it is a free-text one (features) or a "no preference" answer. Only confident matches are returned,
+    the LLM is asked about the rest: a features answer is taken as is only when it is short, not a question,
+    and gives no other slot, e.g. "actually a Sony one" is a change of brand.
+    """
+    new_slots = extractor.extract(text)
+    if pending_slot and pending_slot not in new_slots:
+        if NO_PREFERENCE_PATTERN.match(text):
+            new_slots[pending_slot] = NO_PREFERENCE
+        elif (pending_slot == "features" and not new_slots and not QUESTION_PATTERN.search(text.strip())
+              and len(text.split()) <= FEATURES_MAX_WORDS):
+            new_slots[pending_slot] = text.strip()
+    return {slot: value for slot, value in new_slots.items() if value != slots.get(slot)}
+
+
+def known_slots_prompt(slots: Dict[str, str]) -> Optional[SystemMessage]:
+    """Tell the LLM the preferences already gathered, so that it only asks for the missing ones"""
+    known = [f"- {SLOT_NAMES[slot]}: {slots[slot]}" for slot in SLOTS if slots.get(slot)]
+    if not known:
+        return None
+    missing = [SLOT_NAMES[slot] for slot in missing_slots(slots)]
+    text = "Preferences already gathered from the customer, do not ask for them again:\n" + "\n".join(known)
+    if missing:
+        text += f"\nOnly ask for the missing ones: {', '.join(missing)}."
+    return SystemMessage(content=text)
+
+
+def merge_tool_call_slots(response: AIMessage, slots: Dict[str, str]) -> Dict[str, str]:
+    """
+    Complete the CustomerPreference tool call of the LLM with the known slots it left empty,
+    and return the slots it gathered
+    """
+    if not response.tool_calls:
+        return {}
+    args = response.tool_calls[0]["args"]
+    for slot in SLOTS:
+        if slots.get(slot) and (not args.get(slot) or args.get(slot) == NO_PREFERENCE):
+            args[slot] = slots[slot]
+    return {slot: args[slot] for slot in SLOTS if args.get(slot)}
+
+
+def preference_message(slots: Dict[str, str]) -> AIMessage:
+    """Summary and CustomerPreference tool call built from the slots, in place of an LLM response"""
+    summary = "\n".join(f"- {SLOT_NAMES[slot]}: {slots[slot]}" for slot in SLOTS)
+    return AIMessage(content=f"Thanks! Here is a summary of your preferences:\n{summary}",
+                     tool_calls=[{"name": "CustomerPreference", "args": {slot: slots[slot] for slot in SLOTS},
+                                  "id": f"call_{uuid.uuid4().hex}"}])
+
+
+_slot_extractor = None
+
+
+def get_slot_extractor() -> SlotExtractor:
+    """Get the slot extractor, with the brands and root categories of the catalog loaded on first use"""
+    global _slot_extractor
+    if _slot_extractor is None:
+        _slot_extractor = SlotExtractor.from_catalog(scan_dataset(["title", "root_category"]))
+    return _slot_extractor
+
+
+def set_slot_extractor(slot_extractor: SlotExtractor):
+    global _slot_extractor
+    _slot_extractor = slot_extractor
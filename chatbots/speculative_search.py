@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from chatbots.cache import TTLCache
+from chatbots.customer_preference import CustomerPreference, format_customer_preference
+from chatbots.metrics import metrics
+from chatbots.slot_filling import NO_PREFERENCE, SLOTS
+from chatbots.utils.environment import (
+    HYBRID_SEARCH,
+    SPECULATIVE_SEARCH_RESULTS,
+    VECTOR_SEARCH_MAX_CONCURRENCY,
+)
+from chatbots.vectorstore.hybrid_search import rerank_speculative_result, speculative_search_args
+from chatbots.vectorstore.vector_search import vector_search_product
+
+logger = logging.getLogger("chatbots")
+
+# slots that say what to search for, a budget alone is not worth a search
+SEARCHABLE_SLOTS = ("product_category", "brand", "features")
+# speculative searches of conversations that never reach match_products are dropped after this time
+SPECULATIVE_SEARCH_TTL_SECONDS = 10 * 60
+
+
+class SpeculativeSearches:
+    """
+    Vector searches started from the partial preferences while the customer is still answering, run in the
+    background and picked up by key once the final CustomerPreference is known. Futures stay out of the graph
+    state, which only holds the key. No search is started while all the workers are busy.
+    """
+
+    def __init__(self, max_workers: int = VECTOR_SEARCH_MAX_CONCURRENCY, max_size: int = 1024):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative-search")
+        self.searches = TTLCache(max_size=max_size, ttl_seconds=SPECULATIVE_SEARCH_TTL_SECONDS)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _done(self, future: Optional[Future]):
+        with self._lock:
+            self._in_flight -= 1
+
+    def start(self, customer_preference: CustomerPreference, replaces: Optional[str] = None) -> Optional[str]:
+        """
+        Start a search for the given partial preferences, returning its key, or None when the workers are busy.
+        The search it replaces, started from fewer preferences, is dropped.
+        """
+        previous = self.searches.pop(replaces) if replaces else None
+        if previous is not None:
+            previous[1].cancel()
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                return None
+            self._in_flight += 1
+        try:
+            if HYBRID_SEARCH:
+                search_args = speculative_search_args(customer_preference, SPECULATIVE_SEARCH_RESULTS)
+            else:
+                search_args = {"query_text": format_customer_preference(customer_preference),
+                               "columns": ["product_id", "title", "text"]}
+            future = self.executor.submit(vector_search_product, **search_args)
+        except Exception as e:
+            # speculation must not fail the turn, match_products searches as usual
+            logger.warning(f"could not start speculative search: {e}")
+            self._done(None)
+            return None
+        future.add_done_callback(self._done)
+        key = uuid.uuid4().hex
+        self.searches.set(key, (customer_preference, future))
+        return key
+
+    def pop(self, key: Optional[str]) -> Optional[tuple]:
+        return self.searches.pop(key) if key else None
+
+
+def partial_customer_preference(slots: Dict[str, str]) -> Optional[CustomerPreference]:
+    """CustomerPreference of the slots gathered so far, None if they do not say what to search for"""
+    if not any(slots.get(slot) and slots[slot] != NO_PREFERENCE for slot in SEARCHABLE_SLOTS):
+        return None
+    return CustomerPreference(**{slot: slots.get(slot) or "" for slot in SLOTS})
+
+
+def _reuse(speculative_preference: CustomerPreference, search_result: dict, customer_preference: CustomerPreference,
+           columns: List[str]) -> Optional[dict]:
+    if HYBRID_SEARCH:
+        return rerank_speculative_result(customer_preference, search_result, columns)
+    # a plain vector search result only answers the query it was made for
+    if format_customer_preference(speculative_preference) == format_customer_preference(customer_preference):
+        return search_result
+    return None
+
+
+def speculative_search_result(key: Optional[str], customer_preference: CustomerPreference,
+                              columns: List[str], timeout: Optional[float] = None) -> Optional[dict]:
+    """
+    Search result for the final preferences from the speculative search, None to search again, also when it is
+    not done within timeout seconds
+    """
+    speculation = get_speculative_searches().pop(key)
+    if speculation is None:
+        return None
+    speculative_preference, future = speculation
+    start = time.perf_counter()
+    try:
+        search_result = future.result(timeout=timeout)
+    except Exception as e:
+        logger.warning(f"speculative search failed: {e}")
+        return None
+    result = _reuse(speculative_preference, search_result, customer_preference, columns)
+    metrics.observe("speculative_search_wait_seconds", time.perf_counter() - start,
+                    outcome="miss" if result is None else "hit")
+    return result
+
+
+async def aspeculative_search_result(key: Optional[str], customer_preference: CustomerPreference,
+                                     columns: List[str], timeout: Optional[float] = None) -> Optional[dict]:
+    """Async version of speculative_search_result"""
+    speculation = get_speculative_searches().pop(key)
+    if speculation is None:
+        return None
+    speculative_preference, future = speculation
+    start = time.perf_counter()
+    try:
+        search_result = await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+    except Exception as e:
+        logger.warning(f"speculative search failed: {e}")
+        return None
+    result = _reuse(speculative_preference, search_result, customer_preference, columns)
+    metrics.observe("speculative_search_wait_seconds", time.perf_counter() - start,
+                    outcome="miss" if result is None else "hit")
+    return result
+
+
+_speculative_searches = None
+
+
+def get_speculative_searches() -> SpeculativeSearches:
+    global _speculative_searches
+    if _speculative_searches is None:
+        _speculative_searches = SpeculativeSearches()
+    return _speculative_searches
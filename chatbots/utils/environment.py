@@ -1,5 +1,9 @@
 from dotenv import load_dotenv
+import hashlib
+import json
 import os
+from typing import List, Optional
+
 import polars as pl
 
 load_dotenv()  # Load environment variables from .env file
@@ -10,12 +14,164 @@ if IS_DATABRICKS:
     from databricks.sdk.runtime import spark
 
 DATA_DIRECTORY = os.environ.get("DATA_DIRECTORY")
+# directory of the binary dataset snapshots, defaults to DATA_DIRECTORY/.snapshots
+DATASET_CACHE_DIRECTORY = os.environ.get("DATASET_CACHE_DIRECTORY")
+# "databricks" queries the remote vector search endpoint, "local" searches an in-process index
+VECTOR_SEARCH_BACKEND = os.environ.get("VECTOR_SEARCH_BACKEND", "databricks")
+VECTOR_INDEX_DIRECTORY = os.environ.get("VECTOR_INDEX_DIRECTORY")
+# filter products on budget, brand and category and fuse lexical and vector rankings in match_products
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "true").lower() == "true"
+# start a vector search from the partial preferences while gathering them, re-ranked for the final ones
+SPECULATIVE_SEARCH = os.environ.get("SPECULATIVE_SEARCH", "true").lower() == "true"
+SPECULATIVE_SEARCH_RESULTS = int(os.environ.get("SPECULATIVE_SEARCH_RESULTS", 100))
+# "memory" keeps conversation state in process, "sqlite" persists it to CHECKPOINT_DB_PATH
+CHECKPOINTER_BACKEND = os.environ.get("CHECKPOINTER_BACKEND", "memory")
+CHECKPOINT_DB_PATH = os.environ.get("CHECKPOINT_DB_PATH", "checkpoints.sqlite")
+CHECKPOINT_TTL_SECONDS = float(os.environ.get("CHECKPOINT_TTL_SECONDS", 24 * 60 * 60))
+CHECKPOINT_MAX_MESSAGES = int(os.environ.get("CHECKPOINT_MAX_MESSAGES", 100))
+# cache of LLM-generated related product categories, persisted to RELATED_PRODUCT_CACHE_PATH when set
+RELATED_PRODUCT_CACHE_PATH = os.environ.get("RELATED_PRODUCT_CACHE_PATH")
+RELATED_PRODUCT_CACHE_TTL_SECONDS = float(os.environ.get("RELATED_PRODUCT_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+RELATED_PRODUCT_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("RELATED_PRODUCT_CACHE_SIMILARITY_THRESHOLD", 0.9))
+# precomputed related product graph, looked up from the recommended products before falling back to the LLM
+RELATED_PRODUCT_GRAPH_DIRECTORY = os.environ.get("RELATED_PRODUCT_GRAPH_DIRECTORY")
+# conversation messages kept in the graph state, older customer messages are folded into a bounded summary
+HISTORY_WINDOW_MESSAGES = int(os.environ.get("HISTORY_WINDOW_MESSAGES", 10))
+HISTORY_SUMMARY_MAX_CHARS = int(os.environ.get("HISTORY_SUMMARY_MAX_CHARS", 1000))
+# frontend concurrency: chats handled at once by a worker, and turns handled at once per session
+MAX_CONCURRENT_CHATS = int(os.environ.get("MAX_CONCURRENT_CHATS", 64))
+MAX_CONCURRENT_TURNS_PER_SESSION = int(os.environ.get("MAX_CONCURRENT_TURNS_PER_SESSION", 1))
+# endpoint clients: request timeouts, retries of throttled, failed or timed out requests, and calls in flight
+VECTOR_SEARCH_TIMEOUT_SECONDS = float(os.environ.get("VECTOR_SEARCH_TIMEOUT_SECONDS", 10))
+VECTOR_SEARCH_MAX_RETRIES = int(os.environ.get("VECTOR_SEARCH_MAX_RETRIES", 3))
+VECTOR_SEARCH_MAX_CONCURRENCY = int(os.environ.get("VECTOR_SEARCH_MAX_CONCURRENCY", 32))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 60))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+BACKOFF_BASE_SECONDS = float(os.environ.get("BACKOFF_BASE_SECONDS", 0.2))
+BACKOFF_MAX_SECONDS = float(os.environ.get("BACKOFF_MAX_SECONDS", 5))
+# timeout and retries of the model serving requests: the Databricks deployment client reuses a pooled session and
+# retries throttling and server errors with jittered backoff, configured from these variables when mlflow is
+# imported; MLFLOW_* variables set explicitly take precedence
+os.environ.setdefault("MLFLOW_HTTP_REQUEST_TIMEOUT", str(int(LLM_TIMEOUT_SECONDS)))
+os.environ.setdefault("MLFLOW_DEPLOYMENT_PREDICT_TIMEOUT", str(int(LLM_TIMEOUT_SECONDS)))
+os.environ.setdefault("MLFLOW_HTTP_REQUEST_MAX_RETRIES", str(LLM_MAX_RETRIES))
+os.environ.setdefault("MLFLOW_HTTP_REQUEST_BACKOFF_FACTOR", "1")
+# results of repeated vector search queries, cached per worker; a size of 0 disables the cache
+VECTOR_SEARCH_CACHE_SIZE = int(os.environ.get("VECTOR_SEARCH_CACHE_SIZE", 4096))
+VECTOR_SEARCH_CACHE_TTL_SECONDS = float(os.environ.get("VECTOR_SEARCH_CACHE_TTL_SECONDS", 10 * 60))
+# latency budget of a turn, after which nodes answer from local fallbacks instead of waiting; 0 disables it
+TURN_DEADLINE_SECONDS = float(os.environ.get("TURN_DEADLINE_SECONDS", 30))
+# port of the /metrics (Prometheus text) and /metrics.json endpoints, not served when unset
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# interface the metrics endpoints listen on, loopback only unless set, e.g. to 0.0.0.0 for a remote scraper
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+DATASET_TABLE_NAME = "bright_data_best_buy_products_dataset.datasets.best_buy_products"
+DATASET_FILE_NAME = "best_buy_products.csv"
+SNAPSHOT_INFO_FILE = "snapshot.json"
+
+
+def _file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_snapshot_info(info_path: str) -> dict:
+    if not os.path.exists(info_path):
+        return {}
+    with open(info_path) as f:
+        return json.load(f)
+
+
+def _remove_stale_snapshots(cache_directory: str, name: str, keep: str):
+    """
+    Remove the snapshots of a CSV file other than keep that the info file does not point to (any more).
+    Readers that memory-mapped a removed snapshot keep reading it until they close it.
+    """
+    current = _read_snapshot_info(os.path.join(cache_directory, SNAPSHOT_INFO_FILE)).get("snapshot")
+    for file_name in os.listdir(cache_directory):
+        if (file_name.startswith(f"{name}-") and file_name.endswith(".arrow")
+                and file_name not in (keep, current)):
+            try:
+                os.remove(os.path.join(cache_directory, file_name))
+            except FileNotFoundError:
+                # removed by another process
+                pass
+
 
+def snapshot_dataset(csv_path: str, cache_directory: str) -> str:
+    """
+    Get the Arrow IPC snapshot of a CSV file, writing it on first read.
+    The snapshot is keyed by the CSV content hash; the hash is only recomputed when the CSV mtime or size changes.
+    Snapshots and the info file pointing to the current one are replaced atomically, so that concurrent readers
+    never see a partial file.
+    :return: path to the snapshot
+    """
+    stat = os.stat(csv_path)
+    info_path = os.path.join(cache_directory, SNAPSHOT_INFO_FILE)
+    info = _read_snapshot_info(info_path)
+    previous_snapshot_path = os.path.join(cache_directory, info.get("snapshot", ""))
+    if (info.get("mtime_ns") == stat.st_mtime_ns and info.get("size") == stat.st_size
+            and os.path.isfile(previous_snapshot_path)):
+        return previous_snapshot_path
 
-def read_dataset() -> pl.DataFrame:
+    content_hash = _file_hash(csv_path)
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    snapshot_name = f"{name}-{content_hash}.arrow"
+    snapshot_path = os.path.join(cache_directory, snapshot_name)
+    os.makedirs(cache_directory, exist_ok=True)
+    if not os.path.exists(snapshot_path):
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        # uncompressed IPC can be memory-mapped on later reads
+        pl.scan_csv(csv_path, ignore_errors=True).sink_ipc(tmp_path, compression="uncompressed")
+        os.replace(tmp_path, snapshot_path)
+    tmp_info_path = f"{info_path}.{os.getpid()}.tmp"
+    with open(tmp_info_path, "w") as f:
+        json.dump({"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "hash": content_hash,
+                   "snapshot": snapshot_name}, f)
+    os.replace(tmp_info_path, info_path)
+    _remove_stale_snapshots(cache_directory, name, keep=snapshot_name)
+    return snapshot_path
+
+
+_dataset_version = (None, None)
+
+
+def dataset_version() -> Optional[str]:
+    """Content hash of the current product dataset snapshot, None when it is not read from a snapshot"""
+    global _dataset_version
+    if IS_DATABRICKS or not DATA_DIRECTORY:
+        return None
+    info_path = os.path.join(DATASET_CACHE_DIRECTORY or os.path.join(DATA_DIRECTORY, ".snapshots"),
+                             SNAPSHOT_INFO_FILE)
+    try:
+        mtime_ns = os.stat(info_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    # the info file is only read again when it is rewritten
+    if _dataset_version[0] != mtime_ns:
+        with open(info_path) as f:
+            _dataset_version = (mtime_ns, json.load(f).get("hash"))
+    return _dataset_version[1]
+
+
+def scan_dataset(columns: Optional[List[str]] = None) -> pl.LazyFrame:
+    """Lazily scan the product dataset, projecting only the given columns"""
     if IS_DATABRICKS:
-        spark_df = spark.table("bright_data_best_buy_products_dataset.datasets.best_buy_products").toPandas()
-        df = pl.from_pandas(spark_df)
-    else:
-        df = pl.read_csv(os.path.join(DATA_DIRECTORY, "best_buy_products.csv"), ignore_errors=True)
-    return df
+        spark_df = spark.table(DATASET_TABLE_NAME)
+        if columns is not None:
+            spark_df = spark_df.select(*columns)
+        return pl.from_pandas(spark_df.toPandas()).lazy()
+    cache_directory = DATASET_CACHE_DIRECTORY or os.path.join(DATA_DIRECTORY, ".snapshots")
+    lf = pl.scan_ipc(snapshot_dataset(os.path.join(DATA_DIRECTORY, DATASET_FILE_NAME), cache_directory))
+    if columns is not None:
+        lf = lf.select(columns)
+    return lf
+
+
+def read_dataset(columns: Optional[List[str]] = None) -> pl.DataFrame:
+    return scan_dataset(columns).collect()
@@ -1,10 +1,12 @@
-import matplotlib.pyplot as plt
-from PIL import Image as PILImage
 import io
 
 
 def display_langgraph(graph):
     """Visualize the graphs"""
+    # imported here, plotting is only needed in notebooks
+    import matplotlib.pyplot as plt
+    from PIL import Image as PILImage
+
     image_bytes = graph.get_graph().draw_mermaid_png()
     image = PILImage.open(io.BytesIO(image_bytes))
 
@@ -0,0 +1,177 @@
+"""
+Offline batch embedding of the product catalog into a local vector index directory.
+Re-running the pipeline only re-embeds products whose text changed since the previous run:
+vectors of unchanged products are copied over, keyed by product_id and content hash.
+Each run writes a new version of the index directory and publishes it once complete, serving processes keep
+reading the version they loaded.
+
+Usage: python -m chatbots.vectorstore.embed_products --output data/vector_index
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+from langchain_core.embeddings import Embeddings
+
+from chatbots.utils.environment import scan_dataset
+from chatbots.vectorstore.embeddings import build_embedding_function, embed_texts
+from chatbots.vectorstore.local_index import (
+    EMBEDDINGS_FILE,
+    INDEX_INFO_FILE,
+    METADATA_FILE,
+    PRODUCT_IDS_FILE,
+    LocalVectorIndex,
+    normalize_embeddings,
+    build_ivf,
+    new_version_directory,
+    publish_version,
+    resolve_index_directory,
+)
+from chatbots.vectorstore.preprocess_data import MAX_FIELD_TOKENS, product_text_expr
+
+logger = logging.getLogger("chatbots")
+
+CONTENT_HASHES_FILE = "content_hashes.npy"
+
+
+def content_hashes(texts: List[str]) -> np.ndarray:
+    """Stable 64-bit content hash of each text"""
+    return np.array([int.from_bytes(hashlib.blake2b((text or "").encode("utf-8"), digest_size=8).digest(), "little")
+                     for text in texts], dtype=np.uint64)
+
+
+def _load_previous(directory: str, model_name: str):
+    """Previous product ids (sorted), their hashes and embeddings, if the store was built with the same model"""
+    directory = resolve_index_directory(directory)
+    info_path = os.path.join(directory, INDEX_INFO_FILE)
+    hashes_path = os.path.join(directory, CONTENT_HASHES_FILE)
+    if not (os.path.exists(info_path) and os.path.exists(hashes_path)):
+        return None
+    with open(info_path) as f:
+        if json.load(f).get("embedding_model") != model_name:
+            return None
+    product_ids = np.load(os.path.join(directory, PRODUCT_IDS_FILE))
+    order = np.argsort(product_ids, kind="stable")
+    hashes = np.load(hashes_path)
+    embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode="r")
+    return product_ids[order], hashes[order], order, embeddings
+
+
+def embed_catalog(catalog: pl.LazyFrame,
+                  directory: str,
+                  embedding_function: Embeddings,
+                  chunk_size: int = 10_000,
+                  metadata_columns: Sequence[str] = ("title", "text"),
+                  n_lists: int = 0) -> dict:
+    """
+    Stream the catalog in chunks and write product embeddings to a memory-mapped local index directory.
+    The catalog needs a product_id and a text column; only rows whose text changed are embedded again.
+    :return: counts of written, re-embedded and reused rows
+    """
+    model_name = getattr(embedding_function, "model_name", None)
+    previous = _load_previous(directory, model_name) if os.path.isdir(directory) else None
+    version_directory = new_version_directory(directory)
+    catalog = catalog.select(["product_id", *dict.fromkeys(["text", *metadata_columns])])
+    total = catalog.select(pl.len()).collect().item()
+
+    embeddings_path = os.path.join(version_directory, EMBEDDINGS_FILE)
+    tmp_embeddings_path = f"{embeddings_path}.tmp"
+    embeddings = None
+    product_ids = np.empty(total, dtype=np.int64)
+    hashes = np.empty(total, dtype=np.uint64)
+    metadata_chunks = []
+    seen = set()
+    count = embedded = 0
+    for offset in range(0, total, chunk_size):
+        chunk = catalog.slice(offset, chunk_size).collect()
+        # keep the first row of duplicated product ids
+        keep = []
+        for product_id in chunk["product_id"].to_list():
+            keep.append(product_id is not None and product_id not in seen)
+            seen.add(product_id)
+        chunk = chunk.filter(pl.Series(keep, dtype=pl.Boolean))
+        if not chunk.height:
+            continue
+        chunk_ids = chunk["product_id"].to_numpy().astype(np.int64)
+        texts = chunk["text"].to_list()
+        chunk_hashes = content_hashes(texts)
+
+        changed = np.ones(len(chunk_ids), dtype=bool)
+        vectors = None
+        if previous is not None:
+            previous_ids, previous_hashes, previous_order, previous_embeddings = previous
+            positions = np.clip(np.searchsorted(previous_ids, chunk_ids), 0, len(previous_ids) - 1)
+            unchanged = (previous_ids[positions] == chunk_ids) & (previous_hashes[positions] == chunk_hashes)
+            changed = ~unchanged
+            vectors = np.empty((len(chunk_ids), previous_embeddings.shape[1]), dtype=np.float32)
+            vectors[unchanged] = previous_embeddings[previous_order[positions[unchanged]]]
+        if changed.any():
+            changed_texts = [text for text, is_changed in zip(texts, changed) if is_changed]
+            new_vectors = normalize_embeddings(embed_texts(embedding_function, changed_texts))
+            if vectors is None:
+                vectors = np.empty((len(chunk_ids), new_vectors.shape[1]), dtype=np.float32)
+            vectors[changed] = new_vectors
+            embedded += int(changed.sum())
+
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(tmp_embeddings_path, mode="w+", dtype=np.float32,
+                                                   shape=(total, vectors.shape[1]))
+        embeddings[count:count + len(chunk_ids)] = vectors
+        product_ids[count:count + len(chunk_ids)] = chunk_ids
+        hashes[count:count + len(chunk_ids)] = chunk_hashes
+        metadata_chunks.append(chunk.select(metadata_columns))
+        count += len(chunk_ids)
+        logger.info(f"embedded {count}/{total} products")
+
+    if embeddings is None:
+        shutil.rmtree(version_directory)
+        raise ValueError("The catalog has no products to embed")
+    embeddings.flush()
+    if count < total:
+        np.save(embeddings_path, embeddings[:count])
+        del embeddings
+        os.remove(tmp_embeddings_path)
+    else:
+        del embeddings
+        os.replace(tmp_embeddings_path, embeddings_path)
+    np.save(os.path.join(version_directory, PRODUCT_IDS_FILE), product_ids[:count])
+    np.save(os.path.join(version_directory, CONTENT_HASHES_FILE), hashes[:count])
+    if metadata_columns:
+        pl.concat(metadata_chunks).write_ipc(os.path.join(version_directory, METADATA_FILE))
+
+    index = LocalVectorIndex(np.load(embeddings_path, mmap_mode="r"), product_ids[:count], embedding_function)
+    if n_lists:
+        index.ivf = build_ivf(np.asarray(index.embeddings), n_lists)
+        index.save_ivf(version_directory)
+    index.save_info(version_directory)
+    # readers switch to the new files all at once
+    publish_version(directory, version_directory)
+    return {"rows": count, "embedded": embedded, "reused": count - embedded}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Embed the product catalog into a local vector index")
+    parser.add_argument("--output", required=True, help="local vector index directory")
+    parser.add_argument("--model", default="hashing-512", help="local embedding model name")
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--n-lists", type=int, default=0, help="number of IVF lists, 0 for brute-force search")
+    parser.add_argument("--max-field-tokens", type=int, default=MAX_FIELD_TOKENS,
+                        help="tokens kept of features and product_specifications, 0 keeps them all")
+    parser.add_argument("--raw", action="store_true", help="embed the JSON-ish columns as they are")
+    args = parser.parse_args(argv)
+
+    catalog = scan_dataset().with_columns(product_text_expr(normalize=not args.raw,
+                                                            max_field_tokens=args.max_field_tokens or None))
+    stats = embed_catalog(catalog, args.output, build_embedding_function(args.model),
+                          chunk_size=args.chunk_size, n_lists=args.n_lists)
+    logger.info(f"embedding done: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import re
+import zlib
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic feature-hashing embeddings, usable offline as a stand-in for a served embedding model.
+
+    Unigrams and bigrams are hashed into a fixed number of signed buckets, weighted by sublinear term frequency
+    and L2-normalized, so cosine similarity reduces to a dot product.
+    """
+
+    def __init__(self, dimension: int = 512):
+        self.dimension = dimension
+        self._bucket_cache = {}
+
+    @property
+    def model_name(self) -> str:
+        return f"hashing-{self.dimension}"
+
+    def _bucket(self, token: str):
+        bucket = self._bucket_cache.get(token)
+        if bucket is None:
+            digest = zlib.crc32(token.encode("utf-8"))
+            bucket = (digest % self.dimension, 1.0 if (digest >> 31) & 1 else -1.0)
+            self._bucket_cache[token] = bucket
+        return bucket
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into a contiguous (len(texts), dimension) float32 matrix"""
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = TOKEN_PATTERN.findall((text or "").lower())
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for first, second in zip(tokens, tokens[1:]):
+                bigram = f"{first} {second}"
+                counts[bigram] = counts.get(bigram, 0) + 1
+            for token, count in counts.items():
+                column, sign = self._bucket(token)
+                vectors[row, column] += sign * (1.0 + np.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
+
+
+def embed_texts(embedding_function: Embeddings, texts: List[str]) -> np.ndarray:
+    """Embed texts with any langchain Embeddings into a float32 matrix, avoiding list round trips when possible"""
+    if hasattr(embedding_function, "embed_array"):
+        return embedding_function.embed_array(texts)
+    return np.asarray(embedding_function.embed_documents(texts), dtype=np.float32)
+
+
+def build_embedding_function(model_name: str) -> Embeddings:
+    """Build the embedding function recorded in a local index: "hashing-<dimension>" or a sentence-transformers model"""
+    if model_name is None:
+        raise ValueError("The local index does not record its embedding model")
+    if model_name.startswith("hashing-"):
+        return HashingEmbeddings(dimension=int(model_name.split("-", 1)[1]))
+    # requires the sentence-transformers package
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(model_name=model_name, encode_kwargs={"normalize_embeddings": True})
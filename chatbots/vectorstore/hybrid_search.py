@@ -0,0 +1,425 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import polars as pl
+
+from chatbots.customer_preference import CustomerPreference, format_customer_preference
+from chatbots.utils.environment import scan_dataset
+from chatbots.vectorstore.preprocess_data import product_text_expr
+from chatbots.vectorstore.vector_search import (
+    avector_search_product,
+    clear_search_cache,
+    process_search_result,
+    vector_search_product,
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# an amount, with its optional currency sign and unit: units other than "k" are product specifications
+AMOUNT_PATTERN = re.compile(r"(\$)?\s*(\d[\d,]*(?:\.\d+)?)\s*"
+                            r"(?:(k|inch(?:es)?|in|gb|tb|mb|mp|hz|mah|w|p|mm|cm|ft|hours?|gen)\b|(\"))?", re.IGNORECASE)
+# what follows a resolution such as 4K or precedes it, e.g. "4K TV" or "65 inch 4K", as opposed to a budget of 4000
+RESOLUTION_AFTER_PATTERN = re.compile(r"\W*(?:(?:ultra\s*hd|uhd|hdr\d*|oled|qled|led|tvs?|television|monitors?|"
+                                      r"displays?|screens?|resolution|video|cameras?|camcorders?|projectors?|"
+                                      r"streaming|gaming|blu-?ray|\d+\s*(?:hz|fps))\b|@)", re.IGNORECASE)
+RESOLUTION_BEFORE_PATTERN = re.compile(r"\d\s*(inch(es)?|in|\")\W*$", re.IGNORECASE)
+# candidates searched by each retriever before fusing, as a multiple of the number of results
+CANDIDATE_MULTIPLIER = 4
+# reciprocal rank fusion constant
+RRF_K = 60
+# with more candidates than this, the vector search is not pre-filtered but over-fetched and post-filtered
+MAX_FILTER_PRODUCT_IDS = 1000
+# vector search result without hits, to rank on the lexical ranking alone
+EMPTY_SEARCH_RESULT = {"result": {"row_count": 0, "data_array": []}}
+CATALOG_COLUMNS = ["product_id", "title", "final_price", "initial_price", "discount", "root_category",
+                   "features_summary", "features", "product_specifications"]
+# "around $500" is read as this fraction below and above the amount
+AROUND_BUDGET_TOLERANCE = 0.2
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+
+def parse_price_expr(column: str) -> pl.Expr:
+    """Parse a price string such as "$1,299.99" into a float column"""
+    return pl.col(column).cast(pl.String).str.replace_all(r"[^\d.]", "").cast(pl.Float64, strict=False)
+
+
+def numeric_price_exprs(columns: List[str]) -> List[pl.Expr]:
+    """
+    Numeric price, list_price and discount_amount columns parsed from the final_price, initial_price and discount
+    strings present in the catalog, e.g. 100.0 from "Save $100"; a missing discount is list_price - price
+    """
+    price = parse_price_expr("final_price")
+    exprs = [price.alias("price")]
+    if "initial_price" in columns:
+        exprs.append(parse_price_expr("initial_price").alias("list_price"))
+    discount = parse_price_expr("discount") if "discount" in columns else pl.lit(None, dtype=pl.Float64)
+    if "initial_price" in columns:
+        discount = discount.fill_null(parse_price_expr("initial_price") - price)
+    exprs.append(discount.alias("discount_amount"))
+    return exprs
+
+
+def brand_expr() -> pl.Expr:
+    """Brand of a product: the title prefix before " - ", as in "Apple - MacBook Air 13" Laptop" """
+    return pl.col("title").str.split(" - ").list.first().str.to_lowercase().str.strip_chars().alias("brand")
+
+
+def _is_resolution(text: str, match: re.Match) -> bool:
+    return bool(RESOLUTION_AFTER_PATTERN.match(text, match.end())
+                or RESOLUTION_BEFORE_PATTERN.search(text, 0, match.start()))
+
+
+def parse_amounts(text: str) -> List[float]:
+    """
+    Money amounts in a text, e.g. 1000 in "$1k 4K TV" or "under 1k" but not 4 or 65 in "65 inch 4K TV":
+    a "k" amount without a dollar sign is a resolution when it is next to a display word or a screen size
+    """
+    amounts = []
+    for match in AMOUNT_PATTERN.finditer(text):
+        dollar, number, unit, inches = match.groups()
+        unit = (unit or "").lower() or inches
+        if unit == "k" and (dollar or not _is_resolution(text, match)):
+            amounts.append(float(number.replace(",", "")) * 1000)
+        elif not unit:
+            amounts.append(float(number.replace(",", "")))
+    return amounts
+
+
+def parse_budget(budget: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Parse a free-text budget such as "under $500", "over 200", "300-600" or "around $500" into a (low, high)
+    price range, None for an open end
+    """
+    text = (budget or "").lower()
+    numbers = parse_amounts(text)
+    if not numbers:
+        return None, None
+    if len(numbers) >= 2 and re.search(r"\d\s*k?\s*(-|to|and)\s*\$?\s*\d", text):
+        return min(numbers[:2]), max(numbers[:2])
+    if re.search(r"\b(over|above|more than|at least|min(imum)?|from)\b|\+", text):
+        return numbers[0], None
+    if re.search(r"\b(around|about|approximately|roughly)\b|~", text):
+        return numbers[0] * (1 - AROUND_BUDGET_TOLERANCE), numbers[0] * (1 + AROUND_BUDGET_TOLERANCE)
+    return None, numbers[0]
+
+
+class BM25Index:
+    """Okapi BM25 over tokenized documents, with postings stored as CSR arrays"""
+
+    def __init__(self, documents: List[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: Dict[str, int] = {}
+        term_ids, doc_ids, term_frequencies = [], [], []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            doc_lengths[doc_id] = len(tokens)
+            for token, count in Counter(tokens).items():
+                term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                doc_ids.append(doc_id)
+                term_frequencies.append(count)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)[order]
+        self.term_frequencies = np.asarray(term_frequencies, dtype=np.float32)[order]
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(self.vocabulary)))
+        self.n_documents = len(documents)
+        self.length_norm = 1 - b + b * doc_lengths / max(float(doc_lengths.mean()) if len(documents) else 1.0, 1.0)
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_documents, dtype=np.float32)
+        for token in set(tokenize(query)):
+            term_id = self.vocabulary.get(token)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, tf = self.doc_ids[start:end], self.term_frequencies[start:end]
+            idf = math.log(1 + (self.n_documents - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self.k1 * self.length_norm[docs])
+        return scores
+
+
+class PriceIndex:
+    """
+    Rows sorted by price, overall and grouped by category, so that a budget range is two binary searches
+    instead of a scan of the catalog. Rows without a price are left out.
+    """
+
+    def __init__(self, prices: np.ndarray, categories: List[Optional[str]]):
+        self.n_rows = len(prices)
+        priced = np.flatnonzero(~np.isnan(prices))
+        order = priced[np.argsort(prices[priced], kind="stable")]
+        self.rows, self.prices = order, prices[order]
+        # category segments of rows sorted by (category, price), as CSR offsets
+        self.categories, codes = np.unique(np.asarray([c or "" for c in categories], dtype=object)[priced],
+                                           return_inverse=True)
+        self.category_ids = {category: i for i, category in enumerate(self.categories.tolist())}
+        category_order = np.lexsort((prices[priced], codes))
+        self.category_sorted_rows = priced[category_order]
+        self.category_sorted_prices = prices[self.category_sorted_rows]
+        self.offsets = np.zeros(len(self.categories) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(codes, minlength=len(self.categories)))
+
+    @staticmethod
+    def _range(prices: np.ndarray, low: Optional[float], high: Optional[float]) -> Tuple[int, int]:
+        start = np.searchsorted(prices, low, side="left") if low is not None else 0
+        end = np.searchsorted(prices, high, side="right") if high is not None else len(prices)
+        return int(start), int(end)
+
+    def range_rows(self, low: Optional[float], high: Optional[float],
+                   categories: Optional[List[str]] = None) -> np.ndarray:
+        """Sorted rows priced within [low, high], in the given categories if any"""
+        if categories is None:
+            start, end = self._range(self.prices, low, high)
+            return sorted_rows(self.rows[start:end], self.n_rows)
+        segments = []
+        for category in categories:
+            i = self.category_ids.get(category)
+            if i is None:
+                continue
+            offset = self.offsets[i]
+            start, end = self._range(self.category_sorted_prices[offset:self.offsets[i + 1]], low, high)
+            segments.append(self.category_sorted_rows[offset + start:offset + end])
+        if not segments:
+            return np.array([], dtype=np.int64)
+        return sorted_rows(np.concatenate(segments), self.n_rows)
+
+
+def sorted_rows(rows: np.ndarray, n_rows: int) -> np.ndarray:
+    """Sort distinct row ids: by comparison when they are few, with a bitmap over the n_rows rows otherwise"""
+    if len(rows) * 16 < n_rows:
+        return np.sort(rows)
+    mask = np.zeros(n_rows, dtype=bool)
+    mask[rows] = True
+    return np.flatnonzero(mask)
+
+
+class ProductFilterIndex:
+    """
+    Structured and lexical retrieval over the catalog: a numeric price column, inverted indexes on
+    brand and root_category, and BM25 over the product text. Candidates are filtered on budget, brand and
+    category before vector scoring, then lexical and vector rankings are fused.
+    """
+
+    def __init__(self, catalog: pl.DataFrame):
+        catalog = catalog.with_columns(numeric_price_exprs(catalog.columns))
+        if "brand" in catalog.columns:
+            catalog = catalog.with_columns(pl.col("brand").str.to_lowercase().str.strip_chars())
+        else:
+            catalog = catalog.with_columns(brand_expr())
+        if "text" not in catalog.columns:
+            catalog = catalog.with_columns(product_text_expr())
+        self.product_ids = catalog["product_id"].to_numpy().astype(np.int64)
+        # sorted ids with the first row of each, to find the rows of vector search hits
+        self.sorted_product_ids, self.sorted_product_id_rows = np.unique(self.product_ids, return_index=True)
+        self.prices = catalog["price"].fill_null(np.nan).to_numpy()
+        # numeric columns that search results can return, NaN when unknown
+        self.numeric_columns = {"price": self.prices,
+                                "discount_amount": catalog["discount_amount"].fill_null(np.nan).to_numpy()}
+        # kept as Arrow buffers rather than millions of Python strings, only the returned rows are read
+        self.columns = {"title": catalog["title"], "text": catalog["text"]}
+        categories = [(c or "").lower() for c in catalog["root_category"].to_list()]
+        self.brand_rows = self._inverted_index(catalog["brand"].to_list())
+        self.category_rows = self._inverted_index(categories)
+        self.price_index = PriceIndex(self.prices, categories)
+        self.n_rows = len(self.product_ids)
+        self.bm25 = BM25Index(catalog["text"].to_list())
+
+    @staticmethod
+    def _inverted_index(values: List[Optional[str]]) -> Dict[str, np.ndarray]:
+        rows = {}
+        for row, value in enumerate(values):
+            if value:
+                rows.setdefault(value, []).append(row)
+        return {value: np.asarray(value_rows, dtype=np.int64) for value, value_rows in rows.items()}
+
+    def _match_keys(self, index: Dict[str, np.ndarray], text: str) -> List[str]:
+        """Index keys matching a free-text preference, e.g. "Apple or Samsung" matches "apple" and "samsung" """
+        tokens = set(tokenize(text))
+        return [key for key in index if key and set(tokenize(key)) and set(tokenize(key)) <= tokens]
+
+    def _union(self, index: Dict[str, np.ndarray], keys: List[str]) -> np.ndarray:
+        if len(keys) == 1:
+            return index[keys[0]]
+        return sorted_rows(np.concatenate([index[key] for key in keys]), self.n_rows)
+
+    def _intersect(self, rows: Optional[np.ndarray], other_rows: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if rows is None or other_rows is None:
+            return other_rows if rows is None else rows
+        if len(rows) > len(other_rows):
+            rows, other_rows = other_rows, rows
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[other_rows] = True
+        return rows[mask[rows]]
+
+    def candidate_rows(self, customer_preference: CustomerPreference) -> np.ndarray:
+        """
+        Sorted rows within budget and of the preferred category and brand, relaxing constraints that match nothing.
+        The budget is a range lookup in the price index, of the preferred categories when there are some.
+        """
+        low, high = parse_budget(customer_preference.budget)
+        has_budget = low is not None or high is not None
+        category_keys = self._match_keys(self.category_rows, customer_preference.product_category)
+        brand_keys = self._match_keys(self.brand_rows, customer_preference.brand)
+        budget_rows = self.price_index.range_rows(low, high) if has_budget else None
+        category_rows = None
+        if category_keys:
+            category_rows = (self.price_index.range_rows(low, high, category_keys) if has_budget
+                             else self._union(self.category_rows, category_keys))
+        brand_rows = self._union(self.brand_rows, brand_keys) if brand_keys else None
+        # drop the least important constraints (brand, then category, then budget) until something matches
+        base_rows = category_rows if category_rows is not None else budget_rows
+        for rows in (self._intersect(base_rows, brand_rows), category_rows, budget_rows):
+            if rows is not None and len(rows):
+                return rows
+        return np.arange(self.n_rows)
+
+    def candidate_mask(self, customer_preference: CustomerPreference) -> np.ndarray:
+        """Boolean mask of the candidate rows"""
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.candidate_rows(customer_preference)] = True
+        return mask
+
+    def lexical_ranking(self, query_text: str, candidate_rows: np.ndarray, num_results: int) -> np.ndarray:
+        scores = self.bm25.scores(query_text)[candidate_rows]
+        top = np.argsort(-scores, kind="stable")[:num_results]
+        return candidate_rows[top[scores[top] > 0]]
+
+    def vector_search_args(self, query_text: str, candidate_rows: np.ndarray, num_results: int) -> dict:
+        """Arguments of the pre-filtered vector search over the candidates"""
+        if len(candidate_rows) <= MAX_FILTER_PRODUCT_IDS:
+            return {"query_text": query_text, "columns": ["product_id"], "num_results": num_results,
+                    "filters": {"product_id": self.product_ids[candidate_rows].tolist()}}
+        # too many candidates to send as a filter, over-fetch and post-filter instead
+        return {"query_text": query_text, "columns": ["product_id"], "num_results": num_results * 10}
+
+    def vector_rows(self, vector_result: dict, candidate_rows: np.ndarray) -> np.ndarray:
+        """Rows of the vector search hits that are among the sorted candidate rows, in rank order"""
+        vector_product_ids, _ = process_search_result(vector_result)
+        if not vector_product_ids or not len(candidate_rows):
+            return np.empty(0, dtype=np.int64)
+        product_ids = np.asarray(vector_product_ids, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_product_ids, product_ids).clip(max=len(self.sorted_product_ids) - 1)
+        rows = self.sorted_product_id_rows[positions][self.sorted_product_ids[positions] == product_ids]
+        if len(candidate_rows) < self.n_rows:
+            positions = np.searchsorted(candidate_rows, rows).clip(max=len(candidate_rows) - 1)
+            rows = rows[candidate_rows[positions] == rows]
+        return rows
+
+    def fuse(self, lexical_rows: np.ndarray, vector_result: dict, candidate_rows: np.ndarray,
+             columns: List[str], num_results: int) -> dict:
+        """Reciprocal rank fusion of the lexical and vector rankings, formatted as a similarity_search result"""
+        fused = Counter()
+        for ranking in (lexical_rows.tolist(), self.vector_rows(vector_result, candidate_rows).tolist()):
+            for rank, row in enumerate(ranking):
+                fused[row] += 1 / (RRF_K + rank + 1)
+        ranked = fused.most_common(num_results)
+        data_array = [[self._value(column, row) for column in columns] + [score] for row, score in ranked]
+        return {
+            "manifest": {"column_count": len(columns) + 1,
+                         "columns": [{"name": column} for column in columns] + [{"name": "score"}]},
+            "result": {"row_count": len(data_array), "data_array": data_array},
+        }
+
+    def _value(self, column: str, row: int):
+        if column == "product_id":
+            return int(self.product_ids[row])
+        if column in self.numeric_columns:
+            value = float(self.numeric_columns[column][row])
+            return None if math.isnan(value) else value
+        return self.columns[column][row]
+
+
+_product_filter_index = None
+
+
+def get_product_filter_index() -> ProductFilterIndex:
+    """Get the product filter index, built from the catalog on first use"""
+    global _product_filter_index
+    if _product_filter_index is None:
+        _product_filter_index = ProductFilterIndex(scan_dataset(CATALOG_COLUMNS).collect())
+    return _product_filter_index
+
+
+def set_product_filter_index(product_filter_index: ProductFilterIndex):
+    """Replace the product filter index, dropping the search results cached for the previous catalog"""
+    global _product_filter_index
+    _product_filter_index = product_filter_index
+    clear_search_cache()
+
+
+def _plan(customer_preference: CustomerPreference, num_results: int):
+    index = get_product_filter_index()
+    query_text = format_customer_preference(customer_preference)
+    candidate_rows = index.candidate_rows(customer_preference)
+    lexical_rows = index.lexical_ranking(query_text, candidate_rows, num_results * CANDIDATE_MULTIPLIER)
+    vector_args = index.vector_search_args(query_text, candidate_rows, num_results * CANDIDATE_MULTIPLIER)
+    return index, candidate_rows, lexical_rows, vector_args
+
+
+def hybrid_search_products(customer_preference: CustomerPreference, columns: List[str], num_results: int = 5) -> dict:
+    """Search products matching the customer preference, returned like a similarity_search result"""
+    index, candidate_rows, lexical_rows, vector_args = _plan(customer_preference, num_results)
+    vector_result = vector_search_product(**vector_args)
+    return index.fuse(lexical_rows, vector_result, candidate_rows, columns, num_results)
+
+
+async def ahybrid_search_products(customer_preference: CustomerPreference, columns: List[str],
+                                  num_results: int = 5) -> dict:
+    """Async version of hybrid_search_products"""
+    index, candidate_rows, lexical_rows, vector_args = _plan(customer_preference, num_results)
+    vector_result = await avector_search_product(**vector_args)
+    return index.fuse(lexical_rows, vector_result, candidate_rows, columns, num_results)
+
+
+def local_search_products(customer_preference: CustomerPreference, columns: List[str], num_results: int = 5) -> dict:
+    """
+    Search products with the filters and the lexical ranking only, without calling the vector search endpoint,
+    e.g. when it is too slow for the turn deadline
+    """
+    index = get_product_filter_index()
+    candidate_rows = index.candidate_rows(customer_preference)
+    lexical_rows = index.lexical_ranking(format_customer_preference(customer_preference), candidate_rows, num_results)
+    return index.fuse(lexical_rows, EMPTY_SEARCH_RESULT, candidate_rows, columns, num_results)
+
+
+def local_search_products_batch(queries: List[str], columns: List[str], num_results: int = 5) -> List[dict]:
+    """Lexical search of free-text queries over the whole catalog, a local stand-in for vector_search_products_batch"""
+    index = get_product_filter_index()
+    rows = np.arange(index.n_rows)
+    return [index.fuse(index.lexical_ranking(query, rows, num_results), EMPTY_SEARCH_RESULT, rows, columns,
+                       num_results) for query in queries]
+
+
+def speculative_search_args(customer_preference: CustomerPreference, num_results: int) -> dict:
+    """
+    Arguments of a wide vector search over the candidates of partial preferences, to be narrowed down to the final
+    preferences by rerank_speculative_result
+    """
+    index = get_product_filter_index()
+    candidate_rows = index.candidate_rows(customer_preference)
+    args = {"query_text": format_customer_preference(customer_preference), "columns": ["product_id"],
+            "num_results": num_results}
+    if len(candidate_rows) <= MAX_FILTER_PRODUCT_IDS:
+        args["filters"] = {"product_id": index.product_ids[candidate_rows].tolist()}
+    return args
+
+
+def rerank_speculative_result(customer_preference: CustomerPreference, vector_result: dict, columns: List[str],
+                              num_results: int = 5) -> Optional[dict]:
+    """
+    Hybrid search result for the final preferences from a speculative vector search: its hits are filtered to the
+    final candidates and fused with the lexical ranking. None when fewer than num_results hits are candidates,
+    e.g. when the customer changed their mind, so that the caller searches again.
+    """
+    index, candidate_rows, lexical_rows, _ = _plan(customer_preference, num_results)
+    if len(index.vector_rows(vector_result, candidate_rows)) < num_results:
+        return None
+    return index.fuse(lexical_rows, vector_result, candidate_rows, columns, num_results)
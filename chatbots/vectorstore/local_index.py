@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+from langchain_core.embeddings import Embeddings
+
+from chatbots.vectorstore.embeddings import build_embedding_function, embed_texts
+
+EMBEDDINGS_FILE = "embeddings.npy"
+PRODUCT_IDS_FILE = "product_ids.npy"
+METADATA_FILE = "metadata.arrow"
+INDEX_INFO_FILE = "index.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+IVF_ROWS_FILE = "ivf_rows.npy"
+# an index directory holds versions of the index files, the current one named in CURRENT_VERSION_FILE, so that
+# a new version is published at once and files memory-mapped by serving processes are never rewritten in place
+VERSIONS_DIRECTORY = "versions"
+CURRENT_VERSION_FILE = "CURRENT"
+# the async API scores up to this many embeddings inline, a fraction of a millisecond at 128 dimensions; larger
+# searches run in a thread, numpy releasing the GIL, not to block the event loop for several milliseconds
+INLINE_SEARCH_MAX_ROWS = 5_000
+
+
+def current_version(directory: str) -> Optional[str]:
+    """Name of the current version of an index directory, None for an index saved directly in it"""
+    path = os.path.join(directory, CURRENT_VERSION_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def resolve_index_directory(directory: str) -> str:
+    """Directory of the files of the current version of an index"""
+    version = current_version(directory)
+    return directory if version is None else os.path.join(directory, VERSIONS_DIRECTORY, version)
+
+
+def new_version_directory(directory: str) -> str:
+    """Create the directory of a new, not yet published, version of an index"""
+    path = os.path.join(directory, VERSIONS_DIRECTORY, f"v{time.time_ns()}")
+    os.makedirs(path)
+    return path
+
+
+def publish_version(directory: str, version_directory: str, keep: int = 2):
+    """
+    Make a version written with new_version_directory the current one, atomically, and remove all but the keep
+    latest versions. Removed files stay readable by the processes that memory-mapped them.
+    """
+    version = os.path.basename(version_directory)
+    tmp_path = os.path.join(directory, f"{CURRENT_VERSION_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(directory, CURRENT_VERSION_FILE))
+    versions_path = os.path.join(directory, VERSIONS_DIRECTORY)
+    # names are creation timestamps, a newer version being written by another process is kept
+    versions = sorted(os.listdir(versions_path), key=lambda name: int(name[1:]) if name[1:].isdigit() else 0)
+    for name in versions[:-keep]:
+        if name != version:
+            shutil.rmtree(os.path.join(versions_path, name), ignore_errors=True)
+
+
+def normalize_embeddings(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows, so that cosine similarity is a dot product"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, highest first"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def build_ivf(embeddings: np.ndarray, n_lists: int, n_iter: int = 10, seed: int = 0):
+    """Cluster embeddings with spherical k-means into an inverted file: centroids plus rows grouped by list"""
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists, len(embeddings))
+    centroids = np.array(embeddings[rng.choice(len(embeddings), n_lists, replace=False)], dtype=np.float32)
+    for _ in range(n_iter):
+        assignment = np.argmax(embeddings @ centroids.T, axis=1)
+        for list_id in range(n_lists):
+            members = embeddings[assignment == list_id]
+            if len(members):
+                centroids[list_id] = members.mean(axis=0)
+        centroids = normalize_embeddings(centroids)
+    assignment = np.argmax(embeddings @ centroids.T, axis=1)
+    rows = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+    return centroids, offsets, rows
+
+
+class LocalVectorIndex:
+    """
+    In-process vector index over precomputed product embeddings.
+    Embeddings are kept in a contiguous float32 matrix (memory-mapped when loaded from disk) and searched
+    either brute force or, when an inverted file was built, by probing the closest IVF lists only.
+    Results follow the shape of the Databricks `similarity_search` response.
+    """
+
+    def __init__(self,
+                 embeddings: np.ndarray,
+                 product_ids: np.ndarray,
+                 embedding_function: Embeddings,
+                 metadata: Optional[pl.DataFrame] = None,
+                 ivf: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                 n_probe: int = 8,
+                 version: Optional[str] = None):
+        if len(embeddings) != len(product_ids):
+            raise ValueError("embeddings and product_ids must have the same length")
+        self.embeddings = embeddings
+        self.product_ids = product_ids
+        self.embedding_function = embedding_function
+        self.metadata = metadata
+        self.ivf = ivf
+        self.n_probe = n_probe
+        # version of the files the index was loaded from, None when built in memory
+        self.version = version
+        self._product_id_order = None
+
+    @classmethod
+    def from_texts(cls,
+                   product_ids: Sequence[int],
+                   texts: List[str],
+                   embedding_function: Embeddings,
+                   metadata: Optional[pl.DataFrame] = None,
+                   n_lists: int = 0):
+        """Embed the product texts and build an index, optionally with an IVF of n_lists lists"""
+        embeddings = normalize_embeddings(embed_texts(embedding_function, texts))
+        ivf = build_ivf(embeddings, n_lists) if n_lists else None
+        return cls(np.ascontiguousarray(embeddings), np.asarray(product_ids, dtype=np.int64),
+                   embedding_function, metadata=metadata, ivf=ivf)
+
+    @classmethod
+    def load(cls, directory: str, embedding_function: Optional[Embeddings] = None, mmap: bool = True):
+        """Load the current version of an index saved with `save`, memory-mapping the embedding matrix"""
+        version = current_version(directory)
+        directory = resolve_index_directory(directory)
+        info_path = os.path.join(directory, INDEX_INFO_FILE)
+        if version is None:
+            version = str(os.stat(info_path).st_mtime_ns)
+        with open(info_path) as f:
+            info = json.load(f)
+        if embedding_function is None:
+            embedding_function = build_embedding_function(info["embedding_model"])
+        mmap_mode = "r" if mmap else None
+        embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode=mmap_mode)
+        product_ids = np.load(os.path.join(directory, PRODUCT_IDS_FILE), mmap_mode=mmap_mode)
+        metadata_path = os.path.join(directory, METADATA_FILE)
+        metadata = pl.read_ipc(metadata_path) if os.path.exists(metadata_path) else None
+        ivf = None
+        if os.path.exists(os.path.join(directory, IVF_CENTROIDS_FILE)):
+            ivf = tuple(np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+                        for name in (IVF_CENTROIDS_FILE, IVF_OFFSETS_FILE, IVF_ROWS_FILE))
+        return cls(embeddings, product_ids, embedding_function, metadata=metadata, ivf=ivf,
+                   n_probe=info.get("n_probe", 8), version=version)
+
+    def save(self, directory: str):
+        """Save the index as a new version of the directory"""
+        version_directory = new_version_directory(directory)
+        np.save(os.path.join(version_directory, EMBEDDINGS_FILE),
+                np.ascontiguousarray(self.embeddings, dtype=np.float32))
+        np.save(os.path.join(version_directory, PRODUCT_IDS_FILE), np.asarray(self.product_ids, dtype=np.int64))
+        if self.metadata is not None:
+            self.metadata.write_ipc(os.path.join(version_directory, METADATA_FILE))
+        self.save_ivf(version_directory)
+        self.save_info(version_directory)
+        publish_version(directory, version_directory)
+
+    def save_ivf(self, directory: str):
+        """Save the inverted file, or remove a stale one when the index has none"""
+        for name, array in zip((IVF_CENTROIDS_FILE, IVF_OFFSETS_FILE, IVF_ROWS_FILE), self.ivf or [None] * 3):
+            path = os.path.join(directory, name)
+            if array is not None:
+                np.save(path, array)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def save_info(self, directory: str):
+        info = {
+            "embedding_model": getattr(self.embedding_function, "model_name", None),
+            "dimension": int(self.embeddings.shape[1]),
+            "row_count": int(len(self.product_ids)),
+            "n_probe": self.n_probe,
+        }
+        with open(os.path.join(directory, INDEX_INFO_FILE), "w") as f:
+            json.dump(info, f)
+
+    def _candidate_rows(self, query_vector: np.ndarray) -> Optional[np.ndarray]:
+        """Rows in the n_probe IVF lists closest to the query, or None to scan everything"""
+        if self.ivf is None:
+            return None
+        centroids, offsets, rows = self.ivf
+        lists = top_k(centroids @ query_vector, self.n_probe)
+        return np.concatenate([rows[offsets[i]:offsets[i + 1]] for i in lists])
+
+    def search_vectors(self, query_vectors: np.ndarray, num_results: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top-k (rows, scores) for each query vector"""
+        query_vectors = normalize_embeddings(np.atleast_2d(query_vectors))
+        if self.ivf is None:
+            # a single matrix multiply scores every query against the whole catalog
+            results = []
+            for scores in query_vectors @ self.embeddings.T:
+                top = top_k(scores, num_results)
+                results.append((top, scores[top]))
+            return results
+        results = []
+        for query_vector in query_vectors:
+            rows = self._candidate_rows(query_vector)
+            scores = self.embeddings[rows] @ query_vector
+            top = top_k(scores, num_results)
+            results.append((rows[top], scores[top]))
+        return results
+
+    def _column_values(self, column: str, rows: np.ndarray) -> list:
+        if column == "product_id":
+            return self.product_ids[rows].tolist()
+        if self.metadata is None or column not in self.metadata.columns:
+            raise ValueError(f"Column {column} is not stored in the local vector index")
+        return self.metadata[column].gather(rows).to_list()
+
+    def format_result(self, rows: np.ndarray, scores: np.ndarray, columns: List[str]) -> dict:
+        """Format rows and scores like a Databricks similarity_search response"""
+        values = [self._column_values(column, rows) for column in columns]
+        data_array = [list(row) + [float(score)] for row, score in zip(zip(*values), scores)] if columns else \
+            [[float(score)] for score in scores]
+        return {
+            "manifest": {
+                "column_count": len(columns) + 1,
+                "columns": [{"name": column} for column in columns] + [{"name": "score"}],
+            },
+            "result": {"row_count": len(data_array), "data_array": data_array},
+        }
+
+    def rows_for_product_ids(self, product_ids: Sequence[int]) -> np.ndarray:
+        """Rows of the given product ids, skipping ids not in the index"""
+        if self._product_id_order is None:
+            self._product_id_order = np.argsort(self.product_ids, kind="stable")
+        sorted_ids = self.product_ids[self._product_id_order]
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        positions = np.clip(np.searchsorted(sorted_ids, product_ids), 0, len(sorted_ids) - 1)
+        return self._product_id_order[positions[sorted_ids[positions] == product_ids]]
+
+    def search_rows(self, query_vector: np.ndarray, rows: np.ndarray,
+                    num_results: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (rows, scores) among the given rows only, brute force over the pre-filtered subset"""
+        query_vector = normalize_embeddings(np.atleast_2d(query_vector))[0]
+        scores = self.embeddings[rows] @ query_vector
+        top = top_k(scores, num_results)
+        return rows[top], scores[top]
+
+    def similarity_search(self, query_text: str, columns: List[str], num_results: int = 5,
+                          filters: Optional[dict] = None) -> dict:
+        """Search the index; filters only support {"product_id": [...]} to restrict the searched products"""
+        query_vector = embed_texts(self.embedding_function, [query_text])
+        if filters:
+            if set(filters) != {"product_id"}:
+                raise ValueError(f"Unsupported filters for the local vector index: {sorted(filters)}")
+            rows, scores = self.search_rows(query_vector, self.rows_for_product_ids(filters["product_id"]),
+                                            num_results)
+        else:
+            rows, scores = self.search_vectors(query_vector, num_results)[0]
+        return self.format_result(rows, scores, columns)
+
+    def similarity_search_batch(self, query_texts: List[str], columns: List[str], num_results: int = 5) -> List[dict]:
+        """Embed and score all queries in one call, returning one similarity_search result per query"""
+        query_vectors = embed_texts(self.embedding_function, query_texts)
+        return [self.format_result(rows, scores, columns)
+                for rows, scores in self.search_vectors(query_vectors, num_results)]
+
+    def rows_per_query(self) -> int:
+        """Embeddings scored per query: the whole matrix, or the rows of the probed lists of the IVF"""
+        if self.ivf is None:
+            return len(self.product_ids)
+        n_lists = len(self.ivf[0])
+        return len(self.product_ids) * min(self.n_probe, n_lists) // max(n_lists, 1)
+
+    async def asimilarity_search(self, query_text: str, columns: List[str], num_results: int = 5,
+                                 filters: Optional[dict] = None) -> dict:
+        if self.rows_per_query() <= INLINE_SEARCH_MAX_ROWS:
+            return self.similarity_search(query_text, columns, num_results, filters=filters)
+        return await asyncio.to_thread(self.similarity_search, query_text, columns, num_results, filters=filters)
+
+    async def asimilarity_search_batch(self, query_texts: List[str], columns: List[str],
+                                       num_results: int = 5) -> List[dict]:
+        if self.rows_per_query() * len(query_texts) <= INLINE_SEARCH_MAX_ROWS:
+            return self.similarity_search_batch(query_texts, columns, num_results)
+        return await asyncio.to_thread(self.similarity_search_batch, query_texts, columns, num_results)
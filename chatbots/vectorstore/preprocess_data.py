@@ -1,22 +1,137 @@
-import pyspark.sql.functions as f
-from pyspark.sql import DataFrame
-
-
-def preprocess_product_data(data: DataFrame) -> DataFrame:
-    """Preprocess the Best Buy product data by adding a text column to the dataframe"""
-    data = data.withColumn(
-        "text",
-        f.format_string(
-            "Product Name: %s \n Product Category: %s \n Features Summary: %s \n"
-            "Features: %s \n Product Specifications: %s \n Final Price: %s",
-            f.col("title"),
-            f.col("root_category"),
-            f.col("features_summary"),
-            f.col("features"),
-            f.col("product_specifications"),
-            f.col("final_price"),
-        )
-    )
-    return data
-    
-    
\ No newline at end of file
+"""
+Build the `text` column embedded for vector search, from a Spark DataFrame on Databricks or a polars frame locally.
+The JSON-ish features and product_specifications columns are flattened to "name: value; ..." text and truncated
+to a token budget, with the same regular expressions in both engines so that they produce the same text.
+
+Usage: python -m chatbots.vectorstore.preprocess_data --output data/best_buy_products_processed.arrow
+"""
+import argparse
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import polars as pl
+
+if TYPE_CHECKING:
+    import pyspark.sql
+
+from chatbots.utils.environment import DATA_DIRECTORY, DATASET_FILE_NAME
+
+logger = logging.getLogger("chatbots")
+
+TEXT_TEMPLATE = ("Product Name: {} \n Product Category: {} \n Features Summary: {} \n"
+                 "Features: {} \n Product Specifications: {} \n Final Price: {}")
+TEXT_COLUMNS = ["title", "root_category", "features_summary", "features", "product_specifications", "final_price"]
+JSON_COLUMNS = ["features", "product_specifications"]
+# whitespace-separated tokens kept of each JSON-ish column, None keeps them all
+MAX_FIELD_TOKENS = 128
+# escaped quotes are inch marks in values such as 13.3\", kept aside while quotes are used as delimiters
+ESCAPED_QUOTE = "″"
+# the raw column is cut to this many characters per kept token before it is flattened, not to process long
+# specifications that are truncated anyway
+MAX_CHARS_PER_TOKEN = 32
+# flatten lists of objects and lists of strings in the same passes, e.g.
+# [{"specification_name":"Brand","specification_value":"Apple"}] -> Brand: Apple
+# ["Bluetooth","Wi-Fi"] -> Bluetooth; Wi-Fi
+JSON_REPLACEMENTS = [
+    (r'"\s*\}\s*,\s*\{\s*"\w+"\s*:\s*"', "; "),  # between objects, up to the first key of the next one
+    (r'"\s*,\s*"\w+"\s*:\s*"', ": "),  # between the values of an object
+    (r'"\w+"\s*:\s*"', ""),  # first key
+    (r'"\s*,\s*"', "; "),  # between strings
+    (r'[\[\]{}"]', ""),
+    (r"\s{2,}|[^\S ]", " "),  # like \s+, without replacing single spaces
+    (r" ([;:])", "$1"),
+]
+
+
+def normalize_json_text_expr(column: str, max_tokens: Optional[int] = MAX_FIELD_TOKENS) -> pl.Expr:
+    """Flatten a JSON-ish list column to "name: value; ..." text of at most max_tokens tokens"""
+    text = pl.col(column).cast(pl.String)
+    if max_tokens is not None:
+        text = text.str.slice(0, max_tokens * MAX_CHARS_PER_TOKEN)
+    text = text.str.replace_all('\\"', ESCAPED_QUOTE, literal=True)
+    for pattern, replacement in JSON_REPLACEMENTS:
+        text = text.str.replace_all(pattern, replacement)
+    text = text.str.strip_chars(" ")
+    if max_tokens is not None:
+        text = text.str.split(" ").list.head(max_tokens).list.join(" ").str.strip_chars_end(";")
+    return text.str.replace_all(ESCAPED_QUOTE, '"', literal=True).alias(column)
+
+
+def product_text_expr(normalize: bool = False, max_field_tokens: Optional[int] = MAX_FIELD_TOKENS) -> pl.Expr:
+    """
+    The `text` column of a product, nulls formatted as "null" like Spark's format_string.
+    With normalize, the JSON-ish columns are flattened and truncated to max_field_tokens tokens.
+    """
+    columns = [normalize_json_text_expr(column, max_field_tokens) if normalize and column in JSON_COLUMNS
+               else pl.col(column).cast(pl.String) for column in TEXT_COLUMNS]
+    return pl.format(TEXT_TEMPLATE, *[column.fill_null("null") for column in columns]).alias("text")
+
+
+def _preprocess_spark(data, normalize: bool, max_field_tokens: Optional[int]):
+    import pyspark.sql.functions as f
+
+    def normalize_json_text(column: str):
+        text = f.col(column)
+        if max_field_tokens is not None:
+            text = f.substring(text, 1, max_field_tokens * MAX_CHARS_PER_TOKEN)
+        text = f.regexp_replace(text, r'\\"', ESCAPED_QUOTE)
+        for pattern, replacement in JSON_REPLACEMENTS:
+            text = f.regexp_replace(text, pattern, replacement)
+        text = f.trim(text)
+        if max_field_tokens is not None:
+            text = f.regexp_replace(f.array_join(f.slice(f.split(text, " "), 1, max_field_tokens), " "), ";+$", "")
+        return f.regexp_replace(text, ESCAPED_QUOTE, '"')
+
+    columns = [normalize_json_text(column) if normalize and column in JSON_COLUMNS else f.col(column)
+               for column in TEXT_COLUMNS]
+    return data.withColumn("text", f.format_string(TEXT_TEMPLATE.replace("{}", "%s"), *columns))
+
+
+def preprocess_product_data(data: Union[pl.LazyFrame, pl.DataFrame, "pyspark.sql.DataFrame"],
+                            normalize: bool = False,
+                            max_field_tokens: Optional[int] = MAX_FIELD_TOKENS):
+    """
+    Preprocess the Best Buy product data by adding a text column to the dataframe.
+    Polars frames are processed natively, anything else as a Spark DataFrame.
+    """
+    if isinstance(data, (pl.LazyFrame, pl.DataFrame)):
+        return data.with_columns(product_text_expr(normalize, max_field_tokens))
+    return _preprocess_spark(data, normalize, max_field_tokens)
+
+
+def preprocess_csv(csv_path: str, output_path: str, normalize: bool = True,
+                   max_field_tokens: Optional[int] = MAX_FIELD_TOKENS,
+                   columns: Optional[List[str]] = None) -> str:
+    """
+    Preprocess the catalog CSV into an uncompressed Arrow IPC file with the text column, with the polars
+    streaming engine: the CSV is read in batches, processed on all cores and written out without being loaded.
+    """
+    catalog = pl.scan_csv(csv_path, ignore_errors=True)
+    if columns is not None:
+        catalog = catalog.select(columns)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    preprocess_product_data(catalog, normalize, max_field_tokens).sink_ipc(tmp_path, compression="uncompressed",
+                                                                             engine="streaming")
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Add the text column embedded for vector search to the catalog")
+    parser.add_argument("--input", help="catalog CSV, defaults to the dataset in DATA_DIRECTORY")
+    parser.add_argument("--output", required=True, help="Arrow IPC file to write")
+    parser.add_argument("--max-field-tokens", type=int, default=MAX_FIELD_TOKENS,
+                        help="tokens kept of features and product_specifications, 0 keeps them all")
+    parser.add_argument("--raw", action="store_true", help="keep the JSON-ish columns as they are")
+    args = parser.parse_args(argv)
+
+    csv_path = args.input or os.path.join(DATA_DIRECTORY, DATASET_FILE_NAME)
+    start = time.perf_counter()
+    preprocess_csv(csv_path, args.output, normalize=not args.raw, max_field_tokens=args.max_field_tokens or None)
+    logger.info(f"preprocessed {csv_path} into {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Offline precomputation of related products: for each product, its top neighbors in a local vector index,
+boosted by how often their root categories co-occur among nearest neighbors across the catalog.
+The graph is stored as CSR arrays so that related products are looked up without an LLM call or a search.
+
+Usage: python -m chatbots.vectorstore.related_graph --index data/vector_index --output data/related_graph
+"""
+import argparse
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from chatbots.utils.environment import RELATED_PRODUCT_GRAPH_DIRECTORY, scan_dataset
+from chatbots.vectorstore.local_index import LocalVectorIndex, top_k
+
+logger = logging.getLogger("chatbots")
+
+GRAPH_PRODUCT_IDS_FILE = "graph_product_ids.npy"
+GRAPH_OFFSETS_FILE = "graph_offsets.npy"
+GRAPH_NEIGHBORS_FILE = "graph_neighbors.npy"
+GRAPH_SCORES_FILE = "graph_scores.npy"
+
+
+def category_affinity(neighbor_rows: np.ndarray, category_codes: np.ndarray, n_categories: int) -> np.ndarray:
+    """
+    Row-normalized co-occurrence of categories among nearest neighbors, ignoring same-category pairs,
+    so that a category is boosted by the other categories its products are usually close to
+    """
+    counts = np.zeros((n_categories, n_categories), dtype=np.float64)
+    sources = np.repeat(category_codes, neighbor_rows.shape[1])
+    np.add.at(counts, (sources, category_codes[neighbor_rows.ravel()]), 1)
+    np.fill_diagonal(counts, 0)
+    totals = counts.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1
+    return (counts / totals).astype(np.float32)
+
+
+class RelatedProductGraph:
+    """Top related products of each product, as CSR arrays: the neighbors of row i are offsets[i]:offsets[i + 1]"""
+
+    def __init__(self, product_ids: np.ndarray, offsets: np.ndarray, neighbors: np.ndarray, scores: np.ndarray):
+        self.product_ids = product_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.scores = scores
+        self.row_by_product_id = {product_id: row for row, product_id in enumerate(product_ids.tolist())}
+
+    @classmethod
+    def build(cls,
+              product_ids: Sequence[int],
+              embeddings: np.ndarray,
+              categories: Sequence[Optional[str]],
+              n_neighbors: int = 10,
+              n_candidates: int = 50,
+              category_weight: float = 0.5,
+              duplicate_threshold: float = 0.98,
+              chunk_size: int = 1024) -> "RelatedProductGraph":
+        """
+        Build the graph from L2-normalized embeddings: candidates are the nearest products, near-duplicates
+        are dropped and each candidate is scored by similarity + category_weight * category affinity
+        """
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        n_candidates = min(n_candidates, len(product_ids) - 1)
+        category_names, category_codes = np.unique([category or "" for category in categories], return_inverse=True)
+
+        candidate_rows = np.zeros((len(product_ids), max(n_candidates, 0)), dtype=np.int64)
+        candidate_scores = np.zeros(candidate_rows.shape, dtype=np.float32)
+        for start in range(0, len(product_ids), chunk_size):
+            similarities = np.asarray(embeddings[start:start + chunk_size] @ np.asarray(embeddings).T)
+            for offset, row_similarities in enumerate(similarities):
+                row_similarities[start + offset] = -np.inf
+                top = top_k(row_similarities, n_candidates)
+                candidate_rows[start + offset] = top
+                candidate_scores[start + offset] = row_similarities[top]
+
+        affinity = category_affinity(candidate_rows, category_codes, len(category_names))
+        offsets = np.zeros(len(product_ids) + 1, dtype=np.int64)
+        neighbors, scores = [], []
+        for row in range(len(product_ids)):
+            keep = candidate_scores[row] < duplicate_threshold
+            rows = candidate_rows[row][keep]
+            row_scores = candidate_scores[row][keep] + category_weight * affinity[category_codes[row],
+                                                                                  category_codes[rows]]
+            top = top_k(row_scores, n_neighbors)
+            neighbors.append(product_ids[rows[top]])
+            scores.append(row_scores[top])
+            offsets[row + 1] = offsets[row] + len(top)
+        return cls(product_ids, offsets,
+                   np.concatenate(neighbors) if neighbors else np.zeros(0, dtype=np.int64),
+                   np.concatenate(scores).astype(np.float32) if scores else np.zeros(0, dtype=np.float32))
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, GRAPH_PRODUCT_IDS_FILE), self.product_ids)
+        np.save(os.path.join(directory, GRAPH_OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(directory, GRAPH_NEIGHBORS_FILE), self.neighbors)
+        np.save(os.path.join(directory, GRAPH_SCORES_FILE), self.scores)
+
+    @classmethod
+    def load(cls, directory: str) -> "RelatedProductGraph":
+        return cls(np.load(os.path.join(directory, GRAPH_PRODUCT_IDS_FILE)),
+                   np.load(os.path.join(directory, GRAPH_OFFSETS_FILE)),
+                   np.load(os.path.join(directory, GRAPH_NEIGHBORS_FILE), mmap_mode="r"),
+                   np.load(os.path.join(directory, GRAPH_SCORES_FILE), mmap_mode="r"))
+
+    def neighbors_of(self, product_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Related product ids and scores of a product, empty if the product is not in the graph"""
+        row = self.row_by_product_id.get(product_id)
+        if row is None:
+            return self.neighbors[:0], self.scores[:0]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.neighbors[start:end], self.scores[start:end]
+
+    def related_products(self, product_ids: Sequence[int], num_results: int = 3) -> Tuple[List[int], List[float]]:
+        """Best related products of several products, excluding the products themselves"""
+        excluded = set(product_ids)
+        best = {}
+        for product_id in product_ids:
+            for neighbor, score in zip(*(array.tolist() for array in self.neighbors_of(product_id))):
+                if neighbor not in excluded and score > best.get(neighbor, -np.inf):
+                    best[neighbor] = score
+        ranked = sorted(best.items(), key=lambda pair: pair[1], reverse=True)[:num_results]
+        return [product_id for product_id, _ in ranked], [score for _, score in ranked]
+
+
+_related_product_graph = None
+
+
+def get_related_product_graph() -> Optional[RelatedProductGraph]:
+    """Get the precomputed related product graph, loaded on first use, None if not configured"""
+    global _related_product_graph
+    if _related_product_graph is None and RELATED_PRODUCT_GRAPH_DIRECTORY:
+        _related_product_graph = RelatedProductGraph.load(RELATED_PRODUCT_GRAPH_DIRECTORY)
+    return _related_product_graph
+
+
+def set_related_product_graph(related_product_graph: Optional[RelatedProductGraph]):
+    global _related_product_graph
+    _related_product_graph = related_product_graph
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Precompute the related products of each product")
+    parser.add_argument("--index", required=True, help="local vector index directory")
+    parser.add_argument("--output", required=True, help="related product graph directory")
+    parser.add_argument("--neighbors", type=int, default=10, help="related products kept per product")
+    parser.add_argument("--candidates", type=int, default=50, help="nearest products considered per product")
+    parser.add_argument("--category-weight", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    index = LocalVectorIndex.load(args.index)
+    catalog = scan_dataset(["product_id", "root_category"]).unique("product_id", keep="first").collect()
+    category_by_product_id = dict(zip(catalog["product_id"].to_list(), catalog["root_category"].to_list()))
+    categories = [category_by_product_id.get(product_id) for product_id in index.product_ids.tolist()]
+    graph = RelatedProductGraph.build(index.product_ids, index.embeddings, categories, n_neighbors=args.neighbors,
+                                      n_candidates=args.candidates, category_weight=args.category_weight)
+    graph.save(args.output)
+    logger.info(f"related product graph: {len(graph.product_ids)} products, {len(graph.neighbors)} edges")
+
+
+if __name__ == "__main__":
+    main()
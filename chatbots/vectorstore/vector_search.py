@@ -1,21 +1,282 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Optional
-from databricks.vector_search.client import VectorSearchClient
 
-vsc = VectorSearchClient()
+from chatbots.cache import TTLCache
+from chatbots.clients import ConcurrencyLimiter, acall_with_retry, call_with_retry, configure_session
+from chatbots.metrics import metrics, timed
+from chatbots.utils.environment import (
+    dataset_version,
+    VECTOR_SEARCH_BACKEND,
+    VECTOR_INDEX_DIRECTORY,
+    VECTOR_SEARCH_CACHE_SIZE,
+    VECTOR_SEARCH_CACHE_TTL_SECONDS,
+    VECTOR_SEARCH_MAX_CONCURRENCY,
+    VECTOR_SEARCH_MAX_RETRIES,
+    VECTOR_SEARCH_TIMEOUT_SECONDS,
+)
+
 vector_search_endpoint_name = "vector-search-products-endpoint"
 vs_index = "best_buy_products_index"
 vs_index_fullname = f"main.default.{vs_index}"
 
 
-def vector_search_product(query_text: str, columns: List[str], num_results: int=5):
-    index = vsc.get_index(endpoint_name=vector_search_endpoint_name, index_name=vs_index_fullname)
-    results = index.similarity_search(
+class DatabricksVectorIndex:
+    """
+    Vector search backend querying the Databricks vector search endpoint. The index handle is fetched once
+    and reused, queries share a pool of keep-alive connections, time out, are retried with jittered backoff,
+    and at most VECTOR_SEARCH_MAX_CONCURRENCY of them are in flight.
+    """
+
+    def __init__(self, vsc=None):
+        from databricks.vector_search.client import VectorSearchClient
+        from databricks.vector_search.utils import RequestUtils
+
+        # the SDK sends all its requests through this session, without a timeout
+        configure_session(RequestUtils.session, VECTOR_SEARCH_TIMEOUT_SECONDS, VECTOR_SEARCH_MAX_CONCURRENCY)
+        self.vsc = vsc or VectorSearchClient()
+        self.limiter = ConcurrencyLimiter(VECTOR_SEARCH_MAX_CONCURRENCY)
+        self.executor = ThreadPoolExecutor(max_workers=VECTOR_SEARCH_MAX_CONCURRENCY,
+                                           thread_name_prefix="vector-search")
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def index(self):
+        """Index handle, looked up on first use instead of before every query"""
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = call_with_retry(
+                        lambda: self.vsc.get_index(endpoint_name=vector_search_endpoint_name,
+                                                   index_name=vs_index_fullname),
+                        VECTOR_SEARCH_MAX_RETRIES,
+                    )
+        return self._index
+
+    def _query(self, query_text: str, columns: List[str], num_results: int, filters: Optional[dict]) -> dict:
+        return self.index.similarity_search(
+            query_text=query_text,
+            columns=columns,
+            num_results=num_results,
+            filters=filters,
+        )
+
+    def similarity_search(self, query_text: str, columns: List[str], num_results: int = 5,
+                          filters: Optional[dict] = None) -> dict:
+        return call_with_retry(lambda: self._query(query_text, columns, num_results, filters),
+                               VECTOR_SEARCH_MAX_RETRIES, limiter=self.limiter)
+
+    def similarity_search_batch(self, query_texts: List[str], columns: List[str], num_results: int = 5) -> List[dict]:
+        """Send the queries to the endpoint concurrently, one similarity_search result per query"""
+        return list(self.executor.map(
+            lambda query_text: self.similarity_search(query_text, columns=columns, num_results=num_results),
+            query_texts,
+        ))
+
+    async def asimilarity_search(self, query_text: str, columns: List[str], num_results: int = 5,
+                                 filters: Optional[dict] = None) -> dict:
+        # the vector search SDK is blocking, run it off the event loop; queued queries wait on the loop
+        return await acall_with_retry(
+            lambda: asyncio.to_thread(self._query, query_text, columns, num_results, filters),
+            VECTOR_SEARCH_MAX_RETRIES, limiter=self.limiter,
+        )
+
+    async def asimilarity_search_batch(self, query_texts: List[str], columns: List[str],
+                                       num_results: int = 5) -> List[dict]:
+        return list(await asyncio.gather(*[self.asimilarity_search(query_text, columns, num_results)
+                                           for query_text in query_texts]))
+
+
+def build_vector_index(backend: str = VECTOR_SEARCH_BACKEND):
+    """Build the vector search backend, "databricks" or "local" """
+    if backend == "databricks":
+        return DatabricksVectorIndex()
+    if backend == "local":
+        from chatbots.vectorstore.local_index import LocalVectorIndex
+
+        if not VECTOR_INDEX_DIRECTORY:
+            raise ValueError("VECTOR_INDEX_DIRECTORY must be set to use the local vector search backend")
+        return LocalVectorIndex.load(VECTOR_INDEX_DIRECTORY)
+    raise ValueError(f"Unknown vector search backend: {backend}")
+
+
+_vector_index = None
+
+
+def get_vector_index():
+    """Get the vector search backend, built on first use"""
+    global _vector_index
+    if _vector_index is None:
+        _vector_index = build_vector_index()
+    return _vector_index
+
+
+def set_vector_index(index):
+    """Replace the vector search backend, e.g. with a LocalVectorIndex built in memory, dropping cached results"""
+    global _vector_index
+    _vector_index = index
+    clear_search_cache()
+
+
+_search_cache = None
+
+
+def get_search_cache() -> TTLCache:
+    """
+    Results of recent searches, keyed on the normalized query text, columns, number of results and filters.
+    Entries expire after VECTOR_SEARCH_CACHE_TTL_SECONDS, for the updates synced into the remote index, and are
+    dropped when the index or the catalog is replaced. Cached results are shared, callers must not modify them.
+    """
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = TTLCache(max_size=VECTOR_SEARCH_CACHE_SIZE, ttl_seconds=VECTOR_SEARCH_CACHE_TTL_SECONDS)
+    return _search_cache
+
+
+def clear_search_cache():
+    """Drop the cached search results, e.g. when the catalog or the index version changed"""
+    if _search_cache is not None:
+        _search_cache.clear()
+
+
+def _observe_results(search_results: List[dict], operation: str):
+    for search_result in search_results:
+        metrics.observe("vector_search_results", search_result["result"]["row_count"], operation=operation)
+
+
+@timed("vector_search_seconds", operation="search")
+def _search(query_text: str, columns: List[str], num_results: int, filters: Optional[dict]) -> dict:
+    results = get_vector_index().similarity_search(
         query_text=query_text,
         columns=columns,
         num_results=num_results,
+        filters=filters,
     )
+    _observe_results([results], "search")
     return results
-    
+
+
+@timed("vector_search_seconds", operation="batch")
+def _search_batch(queries: List[str], columns: List[str], num_results: int) -> List[dict]:
+    results = get_vector_index().similarity_search_batch(
+        query_texts=queries,
+        columns=columns,
+        num_results=num_results,
+    )
+    _observe_results(results, "batch")
+    return results
+
+
+@timed("vector_search_seconds", operation="search")
+async def _asearch(query_text: str, columns: List[str], num_results: int, filters: Optional[dict]) -> dict:
+    results = await get_vector_index().asimilarity_search(
+        query_text=query_text,
+        columns=columns,
+        num_results=num_results,
+        filters=filters,
+    )
+    _observe_results([results], "search")
+    return results
+
+
+@timed("vector_search_seconds", operation="batch")
+async def _asearch_batch(queries: List[str], columns: List[str], num_results: int) -> List[dict]:
+    results = await get_vector_index().asimilarity_search_batch(
+        query_texts=queries,
+        columns=columns,
+        num_results=num_results,
+    )
+    _observe_results(results, "batch")
+    return results
+
+
+def normalize_query(query_text: str) -> str:
+    """Case and whitespace-insensitive form of a query, the cache key of its results"""
+    return " ".join(query_text.lower().split())
+
+
+def search_version() -> tuple:
+    """
+    Version of the searched data: the files the local index was loaded from and the catalog snapshot hash.
+    Part of the cache keys, so that results of a previous index or catalog are never served.
+    """
+    return getattr(get_vector_index(), "version", None), dataset_version()
+
+
+def _cache_key(version: tuple, query_text: str, columns: List[str], num_results: int,
+               filters: Optional[dict] = None) -> tuple:
+    filters_key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                               for name, value in (filters or {}).items()))
+    return version, normalize_query(query_text), tuple(columns), num_results, filters_key
+
+
+def _cached_results(keys: List[tuple]) -> List[Optional[dict]]:
+    """Cached result of each key, None for misses"""
+    if not VECTOR_SEARCH_CACHE_SIZE:
+        return [None] * len(keys)
+    results = [get_search_cache().get(key) for key in keys]
+    for result in results:
+        metrics.increment("vector_search_cache_lookups", outcome="miss" if result is None else "hit")
+    return results
+
+
+def _cache_results(keys: List[tuple], results: List[dict]):
+    if VECTOR_SEARCH_CACHE_SIZE:
+        for key, result in zip(keys, results):
+            get_search_cache().set(key, result)
+
+
+def vector_search_product(query_text: str, columns: List[str], num_results: int = 5, filters: Optional[dict] = None):
+    """Search the products closest to the query, from the cache for repeated queries"""
+    key = _cache_key(search_version(), query_text, columns, num_results, filters)
+    results = _cached_results([key])[0]
+    if results is None:
+        results = _search(query_text, columns, num_results, filters)
+        _cache_results([key], [results])
+    return results
+
+
+def vector_search_products_batch(queries: List[str], columns: List[str], num_results: int = 5) -> List[dict]:
+    """Search several queries in one call, returning one similarity_search result per query"""
+    version = search_version()
+    keys = [_cache_key(version, query, columns, num_results) for query in queries]
+    results = _cached_results(keys)
+    missing = [position for position, result in enumerate(results) if result is None]
+    if missing:
+        # one call for the queries not in the cache
+        missing_results = _search_batch([queries[position] for position in missing], columns, num_results)
+        _cache_results([keys[position] for position in missing], missing_results)
+        for position, result in zip(missing, missing_results):
+            results[position] = result
+    return results
+
+
+async def avector_search_product(query_text: str, columns: List[str], num_results: int = 5,
+                                filters: Optional[dict] = None):
+    """Async version of vector_search_product"""
+    key = _cache_key(search_version(), query_text, columns, num_results, filters)
+    results = _cached_results([key])[0]
+    if results is None:
+        results = await _asearch(query_text, columns, num_results, filters)
+        _cache_results([key], [results])
+    return results
+
+
+async def avector_search_products_batch(queries: List[str], columns: List[str], num_results: int = 5) -> List[dict]:
+    """Async version of vector_search_products_batch"""
+    version = search_version()
+    keys = [_cache_key(version, query, columns, num_results) for query in queries]
+    results = _cached_results(keys)
+    missing = [position for position, result in enumerate(results) if result is None]
+    if missing:
+        missing_results = await _asearch_batch([queries[position] for position in missing], columns, num_results)
+        _cache_results([keys[position] for position in missing], missing_results)
+        for position, result in zip(missing, missing_results):
+            results[position] = result
+    return results
+
 
 def process_search_result(search_results) -> Tuple[Optional[List[str]], Optional[List[float]]]:
     """Process search result from similarity_search, return only product ids and similarity scores"""
@@ -26,3 +287,17 @@ def process_search_result(search_results) -> Tuple[Optional[List[str]], Optional
     result_ids = [result[0] for result in search_results["data_array"]]
     result_similarity = [result[-1] for result in search_results["data_array"]]
     return result_ids, result_similarity
+
+
+def select_unique_top_products(search_results: List[dict]) -> Tuple[List[int], List[float]]:
+    """Pick the best product of each search result that was not already picked for a previous one"""
+    product_id_list = []
+    similarity_list = []
+    for search_result in search_results:
+        product_ids, similarities = process_search_result(search_result)
+        for product_id, similarity in zip(product_ids or [], similarities or []):
+            if product_id not in product_id_list:
+                product_id_list.append(product_id)
+                similarity_list.append(similarity)
+                break
+    return product_id_list, similarity_list
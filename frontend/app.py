@@ -1,8 +1,19 @@
 # frontend.py
 
+import asyncio
+
 import gradio as gr
-import time
-from chatbots.shopping_buddy import shopping_buddy  # Import the shopping_buddy function
+from chatbots.shopping_buddy import astream_shopping_buddy, aclear_thread, warmup  # Import the streaming shopping_buddy
+from chatbots.metrics import start_metrics_server
+from chatbots.utils.environment import MAX_CONCURRENT_CHATS, MAX_CONCURRENT_TURNS_PER_SESSION, METRICS_PORT
+
+session_semaphores = {}  # Session hash -> semaphore bounding the concurrent turns of the session
+
+
+async def end_session(request: gr.Request):  # Drop the state of a session when it ends or is cleared
+    session_semaphores.pop(request.session_hash, None)
+    await aclear_thread(request.session_hash)
+
 
 # Create the Gradio Blocks interface
 with gr.Blocks() as demo:
@@ -10,14 +21,27 @@ with gr.Blocks() as demo:
     msg = gr.Textbox()  # Create a textbox for user input
     clear = gr.ClearButton([msg, chatbot])  # Create a clear button
 
-    def respond(message, chat_history):  # Define the respond function
-        bot_message = next(shopping_buddy(message))  # Use shopping_buddy to get the assistant's message
-        chat_history.append({"role": "assistant", "content": bot_message})  # Append bot message to history
-        time.sleep(1)  # Simulate processing time
-        return "", chat_history  # Return empty string for the message and updated chat history
+    async def respond(message, chat_history, request: gr.Request):  # Define the async respond function
+        thread_id = request.session_hash  # Each browser session gets its own conversation thread
+        semaphore = session_semaphores.setdefault(thread_id, asyncio.Semaphore(MAX_CONCURRENT_TURNS_PER_SESSION))
+        chat_history.append({"role": "user", "content": message})  # Show the user message right away
+        yield "", chat_history
+        async with semaphore:
+            current_message_id = None
+            async for message_id, text in astream_shopping_buddy(message, thread_id=thread_id):  # Stream messages
+                if message_id != current_message_id:  # Start a new bubble for each assistant message
+                    chat_history.append({"role": "assistant", "content": ""})
+                    current_message_id = message_id
+                chat_history[-1]["content"] += text  # Append streamed tokens to the current bubble
+                yield "", chat_history  # Return empty string for the message and updated chat history
 
-    msg.submit(respond, [msg, chatbot], [msg, chatbot])  # Set up the submit action
+    msg.submit(respond, [msg, chatbot], [msg, chatbot], concurrency_limit=MAX_CONCURRENT_CHATS)  # Submit action
+    clear.click(end_session)  # Clearing the chat also starts a new conversation thread
+    demo.unload(end_session)  # Clean up the session state when the user leaves
 
 # Launch the interface
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))  # Serve latency and token metrics next to the app
+    warmup()  # Build the LLM clients and load the catalog indexes before the first user arrives
     demo.launch()  # Launch the Blocks interface
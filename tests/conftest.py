@@ -0,0 +1,31 @@
+import pytest
+
+import chatbots.recommend as recommend
+import chatbots.shopping_buddy as shopping_buddy
+import chatbots.slot_filling as slot_filling
+import chatbots.vectorstore.hybrid_search as hybrid_search
+import chatbots.vectorstore.related_graph as related_graph
+import chatbots.vectorstore.vector_search as vector_search
+
+
+@pytest.fixture(autouse=True)
+def restore_globals():
+    """Put back the global models, indexes and stores replaced by a test, e.g. through setup_benchmark"""
+    llms = (shopping_buddy._llm_with_preference_tools, shopping_buddy._llm_with_product_tools)
+    related_product_cache = shopping_buddy._related_product_cache
+    graph = shopping_buddy._graph
+    vector_index = vector_search._vector_index
+    product_filter_index = hybrid_search._product_filter_index
+    product_store = recommend._product_store
+    slot_extractor = slot_filling._slot_extractor
+    related_product_graph = related_graph._related_product_graph
+    yield
+    shopping_buddy.set_llms(*llms)
+    shopping_buddy._related_product_cache = related_product_cache
+    shopping_buddy.set_graph(graph)
+    # also drops the search results cached by the test
+    vector_search.set_vector_index(vector_index)
+    hybrid_search.set_product_filter_index(product_filter_index)
+    recommend.set_product_store(product_store)
+    slot_filling.set_slot_extractor(slot_extractor)
+    related_graph.set_related_product_graph(related_product_graph)
@@ -0,0 +1,25 @@
+from langchain_core.messages import HumanMessage
+
+from benchmarks.fakes import respond_customer_preference, scripted_conversation, synthetic_catalog
+from benchmarks.run_benchmark import check_regression, run_benchmark
+
+
+def test_synthetic_catalog_and_script():
+    catalog = synthetic_catalog(100)
+    assert catalog.height == 100
+    assert catalog["product_id"].n_unique() == 100
+    assert catalog["final_price"][0].startswith("$")
+    first_turn, last_turn = scripted_conversation(3)
+    assert not respond_customer_preference([HumanMessage(content=first_turn)]).tool_calls
+    assert respond_customer_preference([HumanMessage(content=last_turn)]).tool_calls[0]["name"] == "CustomerPreference"
+
+
+def test_run_benchmark_end_to_end():
+    report = run_benchmark(catalog_size=1000, n_conversations=4, concurrency=2, dimension=32)
+    assert report["turns_per_second"] > 0
+    assert report["turn_seconds"]["p99"] >= report["turn_seconds"]["p50"]
+    # every conversation reached the recommendation and related-product nodes
+    assert report["node_seconds"]["recommend"]["count"] == 4
+    assert report["node_seconds"]["recommend_related_products"]["count"] == 4
+    assert report["peak_rss_mb"] > 0
+    assert check_regression(report, report, max_regression=0.2) == []
@@ -0,0 +1,34 @@
+from chatbots.cache import SemanticCache, TTLCache
+from chatbots.get_related_product import RelatedProductPreference
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+
+
+def test_ttl_cache_lru_eviction_and_expiry():
+    cache = TTLCache(max_size=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.set("d", 4, stored_at=0)
+    assert cache.get("d") is None
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 2}
+
+
+def test_semantic_cache_similar_key_and_persistence(tmp_path):
+    path = str(tmp_path / "cache.json")
+    related = RelatedProductPreference(product_category_1="Laptop Bags", product_category_2="Mice",
+                                       product_category_3="Monitors")
+    cache = SemanticCache(HashingEmbeddings(), similarity_threshold=0.8, path=path,
+                          dumps=lambda value: value.model_dump(),
+                          loads=lambda data: RelatedProductPreference(**data))
+    cache.set("laptop | any brand | under $1000 | lightweight long battery life", related)
+    assert cache.get("laptop | any brand | under $1000 | lightweight long battery") == related
+    assert cache.get("television | samsung | under $500 | 4k") is None
+    cache.save()
+
+    reloaded = SemanticCache(HashingEmbeddings(), path=path,
+                             dumps=lambda value: value.model_dump(),
+                             loads=lambda data: RelatedProductPreference(**data))
+    assert reloaded.get("laptop | any brand | under $1000 | lightweight long battery life") == related
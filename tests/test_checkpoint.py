@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from typing import Annotated
+
+from langchain_core.messages import AIMessage, AnyMessage
+from langgraph.graph import StateGraph, START, END, add_messages
+from typing_extensions import TypedDict
+
+from chatbots.checkpoint import SQLiteCheckpointSaver
+from chatbots.metrics import metrics
+
+
+class EchoState(TypedDict):
+    messages: Annotated[list[AnyMessage], add_messages]
+
+
+def echo(state: EchoState) -> dict:
+    return {"messages": [AIMessage(content=f"echo: {state['messages'][-1].content}")]}
+
+
+def build_echo_graph(checkpointer):
+    builder = StateGraph(EchoState)
+    builder.add_node("echo", echo)
+    builder.add_edge(START, "echo")
+    builder.add_edge("echo", END)
+    return builder.compile(checkpointer=checkpointer)
+
+
+def test_state_persists_across_savers(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite")
+    config = {"configurable": {"thread_id": "a"}}
+    build_echo_graph(SQLiteCheckpointSaver(path)).invoke({"messages": [("user", "hi")]}, config)
+
+    graph = build_echo_graph(SQLiteCheckpointSaver(path))
+    messages = graph.invoke({"messages": [("user", "again")]}, config)["messages"]
+    assert [m.content for m in messages] == ["hi", "echo: hi", "again", "echo: again"]
+
+
+def test_message_cap_and_checkpoint_pruning(tmp_path, caplog):
+    caplog.set_level(logging.INFO, logger="chatbots")
+    saver = SQLiteCheckpointSaver(str(tmp_path / "checkpoints.sqlite"), max_messages=3, max_checkpoints_per_thread=2)
+    graph = build_echo_graph(saver)
+    config = {"configurable": {"thread_id": "a"}}
+    for i in range(4):
+        graph.invoke({"messages": [("user", str(i))]}, config)
+    assert [m.content for m in graph.get_state(config).values["messages"]] == ["echo: 2", "3", "echo: 3"]
+    assert len(list(saver.list(config))) == 2
+    assert "dropped the 1 oldest messages" in caplog.text
+    assert metrics.summary()["checkpoint_dropped_messages"][""] > 0
+
+
+def test_idle_threads_are_evicted(tmp_path):
+    saver = SQLiteCheckpointSaver(str(tmp_path / "checkpoints.sqlite"), ttl_seconds=3600)
+    graph = build_echo_graph(saver)
+    asyncio.run(graph.ainvoke({"messages": [("user", "hi")]}, {"configurable": {"thread_id": "a"}}))
+    assert saver.evict_idle_threads() == 0
+    assert saver.evict_idle_threads(ttl_seconds=-1) == 1
+    assert saver.get_tuple({"configurable": {"thread_id": "a"}}) is None
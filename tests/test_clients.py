@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from chatbots.clients import ConcurrencyLimiter, acall_with_retry, backoff_delay, call_with_retry, is_retryable
+from chatbots.vectorstore.vector_search import DatabricksVectorIndex
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    delays = [backoff_delay(attempt, base=0.1, maximum=1.0) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 1.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retryable_errors():
+    assert is_retryable(requests.Timeout())
+    assert is_retryable(Exception("Response content b'', status_code 429"))
+    assert not is_retryable(Exception("Response content b'', status_code 400"))
+    assert not is_retryable(ValueError("bad input"))
+
+
+def test_call_with_retry_retries_only_retryable_errors():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise requests.ConnectionError()
+        return "ok"
+
+    assert call_with_retry(flaky, max_retries=3, base=0.001) == "ok"
+    assert len(attempts) == 3
+
+    def failing():
+        attempts.append(1)
+        raise ValueError("bad input")
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        call_with_retry(failing, max_retries=3, base=0.001)
+    assert len(attempts) == 1
+
+
+def test_limiter_bounds_calls_in_flight():
+    limiter = ConcurrencyLimiter(2)
+    in_flight = []
+
+    async def call():
+        in_flight.append(1)
+        peak = len(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return peak
+
+    async def run():
+        return await asyncio.gather(*[acall_with_retry(call, max_retries=0, limiter=limiter) for _ in range(6)])
+
+    assert max(asyncio.run(run())) == 2
+    # the limiter also works on a new event loop
+    assert max(asyncio.run(run())) == 2
+
+
+def test_limiter_is_shared_by_threads_and_coroutines():
+    limiter = ConcurrencyLimiter(2)
+    lock = threading.Lock()
+    in_flight = [0]
+    peaks = []
+
+    def enter():
+        with lock:
+            in_flight[0] += 1
+            peaks.append(in_flight[0])
+
+    def leave():
+        with lock:
+            in_flight[0] -= 1
+
+    def call():
+        with limiter:
+            enter()
+            time.sleep(0.01)
+            leave()
+
+    async def acall():
+        async with limiter:
+            enter()
+            await asyncio.sleep(0.01)
+            leave()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            await asyncio.gather(*[acall() for _ in range(6)],
+                                 *[loop.run_in_executor(executor, call) for _ in range(6)])
+
+    asyncio.run(run())
+    assert len(peaks) == 12 and max(peaks) == 2
+    # a thread waiting for a slot gives up at its timeout
+    with limiter, limiter:
+        assert not limiter.acquire(timeout=0.01)
+    assert limiter.acquire(timeout=0) and limiter.acquire(timeout=0)
+
+    # a cancelled coroutine does not keep the slot it was waiting for
+    limiter = ConcurrencyLimiter(1)
+
+    async def cancel_waiter():
+        async with limiter:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(limiter.aacquire(), timeout=0.01)
+
+    asyncio.run(cancel_waiter())
+    assert limiter.acquire(timeout=0)
+
+
+class FakeIndex:
+    def similarity_search(self, query_text, columns, num_results, filters):
+        return {"result": {"row_count": 0, "data_array": []}, "query": query_text}
+
+
+class FakeVectorSearchClient:
+    def __init__(self):
+        self.get_index_calls = 0
+
+    def get_index(self, endpoint_name, index_name):
+        self.get_index_calls += 1
+        return FakeIndex()
+
+
+def test_databricks_index_handle_is_reused():
+    vsc = FakeVectorSearchClient()
+    index = DatabricksVectorIndex(vsc=vsc)
+    index.similarity_search("tv", columns=["product_id"])
+    results = index.similarity_search_batch(["a", "b", "c"], columns=["product_id"])
+    assert [result["query"] for result in results] == ["a", "b", "c"]
+    asyncio.run(index.asimilarity_search_batch(["d", "e"], columns=["product_id"]))
+    assert vsc.get_index_calls == 1
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import AIMessage
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import ScriptedChatModel, respond_related_product_preference, scripted_conversation
+from benchmarks.run_benchmark import setup_benchmark
+from chatbots.clients import ConcurrencyLimiter
+from chatbots.customer_preference import CustomerPreference
+from chatbots.deadline import DeadlineExceeded, acall_with_deadline, call_with_deadline, turn_config
+from chatbots.metrics import metrics
+from chatbots.recommend import NO_RECOMMENDATION_MESSAGE
+from chatbots.vectorstore.vector_search import set_vector_index
+
+
+class SlowChatModel(ScriptedChatModel):
+    delay: float
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return self._generate(messages, stop=stop, **kwargs)
+
+
+class FailingVectorIndex:
+    def similarity_search(self, **kwargs):
+        raise Exception("Response content b'', status_code 503")
+
+    async def asimilarity_search(self, **kwargs):
+        raise Exception("Response content b'', status_code 503")
+
+
+@pytest.fixture
+def benchmark_setup():
+    setup_benchmark(1000, dimension=32)
+
+
+def test_call_with_deadline():
+    assert call_with_deadline(lambda: 1, None) == 1
+    assert call_with_deadline(lambda: 1, turn_config("t", 1)) == 1
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline(lambda: time.sleep(0.5), turn_config("t", 0.05))
+    with pytest.raises(ValueError):
+        call_with_deadline(lambda: int("a"), turn_config("t", 1))
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(acall_with_deadline(lambda: asyncio.sleep(0.5), turn_config("t", 0.05)))
+
+
+def test_abandoned_call_releases_its_limiter_slot():
+    limiter = ConcurrencyLimiter(1)
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline(lambda: time.sleep(0.3), turn_config("t", 0.05), limiter=limiter)
+    # the next turn gets the slot while the abandoned call is still running
+    assert call_with_deadline(lambda: 1, turn_config("t", 0.05), limiter=limiter) == 1
+    time.sleep(0.4)
+    # and the abandoned call did not release it a second time
+    assert limiter.acquire(timeout=0)
+    assert not limiter.acquire(timeout=0)
+    limiter.release()
+    # waiting for a slot is bounded by the deadline too
+    with limiter:
+        with pytest.raises(DeadlineExceeded):
+            call_with_deadline(lambda: 1, turn_config("t", 0.05), limiter=limiter)
+
+    async def wait_for_slot():
+        async with limiter:
+            await acall_with_deadline(lambda: asyncio.sleep(0), turn_config("t", 0.05), limiter=limiter)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(wait_for_slot())
+
+
+def test_recommend_without_recommendation():
+    state = shopping_buddy.recommend({"messages": []})
+    assert state["messages"][-1].content == NO_RECOMMENDATION_MESSAGE
+
+
+def test_slow_related_products_do_not_delay_the_turn(benchmark_setup):
+    preference_llm = shopping_buddy.get_llm_with_preference_tools()
+    shopping_buddy.set_llms(preference_llm, SlowChatModel(respond=respond_related_product_preference, delay=5))
+    metrics.reset()
+    graph = shopping_buddy.get_graph()
+
+    async def run():
+        for message in scripted_conversation(0):
+            await graph.ainvoke({"messages": [("user", message)]}, config=turn_config("deadline-test", 0.5))
+        return await graph.aget_state({"configurable": {"thread_id": "deadline-test"}})
+
+    start = time.perf_counter()
+    snapshot = asyncio.run(run())
+    assert time.perf_counter() - start < 2
+    assert "recommendation" in snapshot.values
+    assert snapshot.values.get("related_product_recommendation") is None
+    assert "fallbacks" in metrics.summary()
+    asyncio.run(shopping_buddy.aclear_thread("deadline-test"))
+
+
+def test_match_products_falls_back_to_the_local_catalog(benchmark_setup):
+    set_vector_index(FailingVectorIndex())
+    preference = CustomerPreference(product_category="Audio", brand="Sony", budget="", features="wireless")
+    update = shopping_buddy.match_products({"customer_preference": preference, "messages": [AIMessage(content="")]})
+    assert update["recommendation"].product_ids
+
+
+def test_skipped_related_products_are_not_shown_from_the_previous_turn(benchmark_setup, monkeypatch):
+    graph = shopping_buddy.get_graph()
+    config = turn_config("stale-test", 30)
+    for message in scripted_conversation(0):
+        graph.invoke({"messages": [("user", message)]}, config=config)
+    assert graph.get_state(config).values.get("related_product_recommendation") is not None
+
+    # the next search has no time for the related-product LLM call
+    monkeypatch.setattr(shopping_buddy, "RELATED_PRODUCTS_MIN_SECONDS", 1000)
+    shopping_buddy.get_related_product_cache().clear()
+    graph.invoke({"messages": [("user", scripted_conversation(1)[1])]}, config=config)
+    values = graph.get_state(config).values
+    assert values["recommendation"] is not None
+    assert values.get("related_product_recommendation") is None
+    assert values.get("related_product_data") is None
+    related_messages = [m for m in values["messages"] if m.content.startswith("Here are the related products")]
+    assert len(related_messages) == 1
+    shopping_buddy.clear_thread("stale-test")
@@ -0,0 +1,52 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import ScriptedChatModel, respond_customer_preference
+from chatbots.history import compact_messages, summarize_messages
+from chatbots.recommend import RELATED_PRODUCTS_REQUEST
+from chatbots.slot_filling import SlotExtractor, set_slot_extractor
+
+
+def test_compact_messages_drops_stale_and_old_messages():
+    messages = [
+        AIMessage(content="Hello", id="1"),
+        HumanMessage(content="I want a laptop", id="2"),
+        AIMessage(content="Budget?", tool_calls=[{"name": "CustomerPreference", "args": {}, "id": "call"}], id="3"),
+        ToolMessage(content="Customer preferences gathered", tool_call_id="call", id="4"),
+        HumanMessage(content=RELATED_PRODUCTS_REQUEST, id="5"),
+        AIMessage(content="Related products", id="6"),
+        HumanMessage(content="Something cheaper", id="7"),
+    ]
+    removals, summary = compact_messages(messages, window=3)
+    assert all(isinstance(removal, RemoveMessage) for removal in removals)
+    assert sorted(removal.id for removal in removals) == ["1", "2", "4", "5"]
+    assert summary == "Customer: I want a laptop"
+
+
+def test_summary_is_bounded():
+    summary = None
+    for i in range(100):
+        summary = summarize_messages([HumanMessage(content=f"message number {i}")], summary, max_chars=100)
+    assert len(summary) <= 100
+    assert summary.endswith("Customer: message number 99")
+    assert summary.startswith("Customer: ")
+
+
+def test_long_conversation_keeps_state_bounded():
+    shopping_buddy.set_llms(ScriptedChatModel(respond=respond_customer_preference))
+    set_slot_extractor(SlotExtractor(brands=[], categories=[]))
+    config = {"configurable": {"thread_id": "test-history"}}
+
+    async def chat():
+        for i in range(30):
+            async for _ in shopping_buddy.astream_shopping_buddy(f"I am looking for a laptop {i}", "test-history"):
+                pass
+
+    asyncio.run(chat())
+    values = shopping_buddy.get_graph().get_state(config).values
+    # the window of the last turn plus its reply
+    assert len(values["messages"]) == 11
+    assert "laptop 19" in values["conversation_summary"]
+    shopping_buddy.clear_thread("test-history")
@@ -0,0 +1,83 @@
+import numpy as np
+import polars as pl
+
+from chatbots.customer_preference import CustomerPreference
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+from chatbots.vectorstore.hybrid_search import (
+    PriceIndex,
+    ProductFilterIndex,
+    hybrid_search_products,
+    parse_budget,
+    set_product_filter_index,
+)
+from chatbots.vectorstore.local_index import LocalVectorIndex
+from chatbots.vectorstore.vector_search import process_search_result, set_vector_index
+
+CATALOG = pl.DataFrame({
+    "product_id": [1, 2, 3, 4],
+    "title": ["Apple - MacBook Air 13 laptop", "Apple - MacBook Pro 16 laptop", "Dell - XPS 13 laptop",
+              "Samsung - 65 inch 4K TV"],
+    "final_price": ["$999.00", "$2,499.00", "$899.00", "$1,199.99"],
+    "initial_price": ["$1,099.00", "$2,499.00", None, "$1,299.99"],
+    "discount": ["Save $100", None, None, None],
+    "root_category": ["Computers", "Computers", "Computers", "TV & Home Theater"],
+    "features_summary": ["light laptop", "powerful laptop", "compact laptop", "smart tv"],
+    "features": [None, None, None, None],
+    "product_specifications": [None, None, None, None],
+})
+
+
+def test_parse_budget():
+    assert parse_budget("under $1,000") == (None, 1000.0)
+    assert parse_budget("over 200") == (200.0, None)
+    assert parse_budget("$300 - $600") == (300.0, 600.0)
+    assert parse_budget("no budget") == (None, None)
+    assert parse_budget("around $500") == (400.0, 600.0)
+    # screen sizes and resolutions are not amounts
+    assert parse_budget("65 inch 4K TV under $1k") == (None, 1000.0)
+    assert parse_budget("under 1k") == (None, 1000.0)
+    assert parse_budget("budget 2k") == (None, 2000.0)
+    assert parse_budget("1.5k-2k") == (1500.0, 2000.0)
+    assert parse_budget("a 4K TV under 1.5k") == (None, 1500.0)
+    assert parse_budget("65 inch 4K under 800") == (None, 800.0)
+    assert parse_budget("8K 120Hz") == (None, None)
+    assert parse_budget("something in 2k") == (None, 2000.0)
+
+
+def test_candidates_respect_budget_and_brand_with_relaxation():
+    index = ProductFilterIndex(CATALOG)
+    preference = CustomerPreference(product_category="laptop", brand="Apple", budget="under $1000", features="")
+    assert index.product_ids[index.candidate_mask(preference)].tolist() == [1]
+    # no Sony products: the brand constraint is relaxed, the budget is kept
+    preference = CustomerPreference(product_category="laptop", brand="Sony", budget="under $1000", features="")
+    assert index.product_ids[index.candidate_mask(preference)].tolist() == [1, 3]
+
+
+def test_price_index_range_queries():
+    prices = np.array([30.0, 10.0, np.nan, 20.0, 40.0])
+    index = PriceIndex(prices, ["audio", "tv", "tv", "audio", "tv"])
+    assert index.range_rows(15, 35).tolist() == [0, 3]
+    assert index.range_rows(None, 20).tolist() == [1, 3]
+    assert index.range_rows(10, None, ["tv"]).tolist() == [1, 4]
+    assert index.range_rows(None, None, ["audio", "unknown"]).tolist() == [0, 3]
+
+
+def test_numeric_price_columns():
+    index = ProductFilterIndex(CATALOG)
+    assert index.prices.tolist() == [999.0, 2499.0, 899.0, 1199.99]
+    discounts = index.numeric_columns["discount_amount"]
+    assert discounts[0] == 100.0 and discounts[1] == 0.0 and np.isnan(discounts[2])
+    assert round(discounts[3], 2) == 100.0
+
+
+def test_hybrid_search_products_returns_filtered_fused_results():
+    index = ProductFilterIndex(CATALOG)
+    set_product_filter_index(index)
+    set_vector_index(LocalVectorIndex.from_texts(index.product_ids, index.columns["text"],
+                                                 HashingEmbeddings(dimension=256)))
+    preference = CustomerPreference(product_category="laptop", brand="any", budget="below 1000", features="compact")
+    result = hybrid_search_products(preference, columns=["product_id", "title"], num_results=5)
+    product_ids, scores = process_search_result(result)
+    assert product_ids[0] == 3
+    assert set(product_ids) == {1, 3}
+    assert scores == sorted(scores, reverse=True)
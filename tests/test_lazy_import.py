@@ -0,0 +1,17 @@
+import subprocess
+import sys
+
+
+def test_import_builds_no_client():
+    # importing the graph module must not import the Databricks client nor build the LLM and the graph
+    code = ("import sys, chatbots.shopping_buddy as sb; "
+            "assert 'langchain_databricks' not in sys.modules; "
+            "assert sb._graph is None and sb._llm_with_preference_tools is None")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_warmup_builds_the_graph():
+    code = ("import chatbots.shopping_buddy as sb, benchmarks.run_benchmark as rb; "
+            "rb.setup_benchmark(100, dimension=16); sb.warmup(freeze=True); "
+            "assert sb._graph is not None")
+    subprocess.run([sys.executable, "-c", code], check=True)
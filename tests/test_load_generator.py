@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+from benchmarks.load_generator import (
+    InProcessTarget,
+    generate_load,
+    read_corpus,
+    scripted_corpus,
+    write_corpus,
+)
+from benchmarks.run_benchmark import setup_benchmark
+
+
+def test_corpus_round_trip(tmp_path):
+    path = str(tmp_path / "corpus.jsonl")
+    write_corpus(path, scripted_corpus(3))
+    with open(path, "a") as f:
+        f.write(json.dumps({"turns": ["hi", "a laptop please"]}) + "\n")
+    conversations = read_corpus(path)
+    assert len(conversations) == 4
+    assert [turn["type"] for turn in conversations[0]["turns"]] == ["opening", "preferences"]
+    assert conversations[3]["conversation_id"] == "3"
+    assert [turn["type"] for turn in conversations[3]["turns"]] == ["turn_0", "turn_1"]
+
+
+class FailingTarget(InProcessTarget):
+    async def turn(self, thread_id, message):
+        if message.startswith("category"):
+            raise RuntimeError("endpoint down")
+        return await super().turn(thread_id, message)
+
+
+def test_generate_load_in_process():
+    setup_benchmark(1000, dimension=32)
+    report = asyncio.run(generate_load(InProcessTarget(), scripted_corpus(6), concurrency=3, rate=100))
+    assert report["turns"] == 12
+    assert report["completed_conversations"] == 6
+    assert report["error_rate"] == 0
+    assert report["turn_seconds"]["preferences"]["p99"] >= report["turn_seconds"]["preferences"]["p50"]
+
+    report = asyncio.run(generate_load(FailingTarget(), scripted_corpus(4), concurrency=2))
+    assert report["error_rates"] == {"opening": 0.0, "preferences": 1.0}
+    assert report["completed_conversations"] == 0
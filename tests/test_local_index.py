@@ -0,0 +1,144 @@
+import asyncio
+import threading
+
+import numpy as np
+import polars as pl
+
+from chatbots.metrics import metrics
+from chatbots.vectorstore.embed_products import embed_catalog
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+import chatbots.vectorstore.local_index as local_index
+from chatbots.vectorstore.local_index import LocalVectorIndex
+from chatbots.vectorstore.vector_search import (
+    get_search_cache,
+    process_search_result,
+    select_unique_top_products,
+    set_vector_index,
+    vector_search_product,
+    vector_search_products_batch,
+)
+
+PRODUCT_IDS = [101, 102, 103, 104]
+TEXTS = [
+    "Apple MacBook Air 13 inch laptop with M2 chip",
+    "Samsung 65 inch 4K smart TV",
+    "Laptop sleeve bag for 13 inch MacBook",
+    "Sony wireless noise cancelling headphones",
+]
+
+
+def test_similarity_search_result_shape():
+    index = LocalVectorIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256))
+    result = index.similarity_search(query_text="macbook laptop", columns=["product_id"], num_results=2)
+    product_ids, scores = process_search_result(result)
+    assert result["result"]["row_count"] == 2
+    assert product_ids[0] in (101, 103)
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_save_and_load_memory_mapped(tmp_path):
+    index = LocalVectorIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256), n_lists=2)
+    index.save(str(tmp_path))
+    loaded = LocalVectorIndex.load(str(tmp_path))
+    assert isinstance(loaded.embeddings, np.memmap)
+    assert loaded.embeddings.dtype == np.float32
+    loaded.n_probe = 2
+    result = loaded.similarity_search(query_text="4K TV", columns=["product_id"], num_results=1)
+    assert process_search_result(result)[0] == [102]
+
+
+def test_batch_search_matches_single_queries():
+    index = LocalVectorIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256))
+    queries = ["macbook laptop", "smart TV", "headphones"]
+    batch = index.similarity_search_batch(queries, columns=["product_id"], num_results=2)
+    single = [index.similarity_search(query, columns=["product_id"], num_results=2) for query in queries]
+    assert [process_search_result(r)[0] for r in batch] == [process_search_result(r)[0] for r in single]
+
+
+class ThreadRecordingIndex(LocalVectorIndex):
+    """Local index recording the threads its searches run on"""
+
+    def similarity_search(self, query_text, columns, num_results=5, filters=None):
+        self.search_thread = threading.get_ident()
+        return super().similarity_search(query_text, columns, num_results, filters=filters)
+
+
+def test_async_search_of_a_large_index_does_not_block_the_event_loop(monkeypatch):
+    index = ThreadRecordingIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256))
+    asyncio.run(index.asimilarity_search("4K TV", columns=["product_id"], num_results=1))
+    assert index.search_thread == threading.get_ident()
+
+    monkeypatch.setattr(local_index, "INLINE_SEARCH_MAX_ROWS", 2)
+    result = asyncio.run(index.asimilarity_search("4K TV", columns=["product_id"], num_results=1))
+    assert index.search_thread != threading.get_ident()
+    assert process_search_result(result)[0] == [102]
+
+
+class CountingIndex(LocalVectorIndex):
+    """Local index counting the queries it answers"""
+
+    queries = 0
+
+    def similarity_search(self, query_text, columns, num_results=5, filters=None):
+        self.queries += 1
+        return super().similarity_search(query_text, columns, num_results, filters=filters)
+
+    def similarity_search_batch(self, query_texts, columns, num_results=5):
+        self.queries += len(query_texts)
+        return super().similarity_search_batch(query_texts, columns, num_results)
+
+
+def test_repeated_queries_are_answered_from_the_cache():
+    index = CountingIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256))
+    set_vector_index(index)
+    hits = get_search_cache().stats()["hits"]
+    first = vector_search_product("Sony  headphones", columns=["product_id"], num_results=2)
+    assert vector_search_product("sony headphones ", columns=["product_id"], num_results=2) is first
+    vector_search_product("sony headphones", columns=["product_id"], num_results=3)
+    assert index.queries == 2
+    results = vector_search_products_batch(["smart TV", "Sony headphones"], columns=["product_id"],
+                                           num_results=2)
+    assert results[1] is first
+    assert index.queries == 3
+    assert get_search_cache().stats()["hits"] - hits == 2
+    assert metrics.summary()["vector_search_cache_lookups"]["outcome=hit"] >= 2
+    # replacing the index drops the results of the previous one
+    set_vector_index(index)
+    vector_search_product("sony headphones", columns=["product_id"], num_results=2)
+    assert index.queries == 4
+    # as does a new version of the index files, even when the index is not replaced through set_vector_index
+    index.version = "v2"
+    vector_search_product("sony headphones", columns=["product_id"], num_results=2)
+    assert index.queries == 5
+
+
+def test_select_unique_top_products_skips_seen_products():
+    index = LocalVectorIndex.from_texts(PRODUCT_IDS, TEXTS, HashingEmbeddings(dimension=256))
+    batch = index.similarity_search_batch(["macbook laptop 13 inch", "macbook laptop 13 inch"],
+                                          columns=["product_id"], num_results=2)
+    product_ids, _ = select_unique_top_products(batch)
+    assert len(product_ids) == 2 and len(set(product_ids)) == 2
+
+
+def test_embed_catalog_only_reembeds_changed_rows(tmp_path):
+    catalog = pl.DataFrame({"product_id": PRODUCT_IDS, "text": TEXTS, "title": TEXTS})
+    directory = str(tmp_path / "index")
+    stats = embed_catalog(catalog.lazy(), directory, HashingEmbeddings(dimension=256), chunk_size=3)
+    assert stats == {"rows": 4, "embedded": 4, "reused": 0}
+    first = LocalVectorIndex.load(directory)
+
+    changed = catalog.with_columns(
+        pl.when(pl.col("product_id") == 102).then(pl.lit("Sony 55 inch OLED TV")).otherwise(pl.col("text"))
+        .alias("text"))
+    stats = embed_catalog(changed.lazy(), directory, HashingEmbeddings(dimension=256), chunk_size=3)
+    assert stats == {"rows": 4, "embedded": 1, "reused": 3}
+
+    index = LocalVectorIndex.load(directory)
+    # the new version is published next to the one still memory-mapped by the first reader
+    assert index.version != first.version
+    assert first.similarity_search(query_text="4K TV", columns=["product_id"], num_results=1)["result"]["row_count"]
+    assert not np.allclose(first.embeddings, index.embeddings)
+    rebuilt = LocalVectorIndex.from_texts(PRODUCT_IDS, changed["text"].to_list(), HashingEmbeddings(dimension=256))
+    assert np.allclose(index.embeddings, rebuilt.embeddings)
+    result = index.similarity_search(query_text="OLED TV", columns=["product_id", "title"], num_results=1)
+    assert result["result"]["data_array"][0][:2] == [102, TEXTS[1]]
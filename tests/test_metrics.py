@@ -0,0 +1,84 @@
+import asyncio
+import json
+import urllib.request
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from chatbots.metrics import (
+    Histogram,
+    LLMMetricsCallbackHandler,
+    MetricsRegistry,
+    instrument_node,
+    metrics,
+    start_metrics_server,
+)
+
+
+def test_histogram_quantiles():
+    histogram = Histogram((1, 2, 5))
+    for value in (0.5, 1.5, 1.5, 4, 10):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    registry.observe("node_seconds", 0.003, node="recommend")
+    registry.observe("node_seconds", 0.2, node="recommend")
+    text = registry.render_prometheus()
+    assert "# TYPE shopping_buddy_node_seconds histogram" in text
+    assert 'shopping_buddy_node_seconds_bucket{node="recommend",le="0.005"} 1' in text
+    assert 'shopping_buddy_node_seconds_bucket{node="recommend",le="+Inf"} 2' in text
+    assert 'shopping_buddy_node_seconds_count{node="recommend"} 2' in text
+
+
+def test_counters():
+    registry = MetricsRegistry()
+    registry.increment("vector_search_cache_lookups", outcome="hit")
+    registry.increment("vector_search_cache_lookups", outcome="hit")
+    registry.increment("vector_search_cache_lookups", outcome="miss")
+    assert registry.summary()["vector_search_cache_lookups"] == {"outcome=hit": 2, "outcome=miss": 1}
+    text = registry.render_prometheus()
+    assert "# TYPE shopping_buddy_vector_search_cache_lookups_total counter" in text
+    assert 'shopping_buddy_vector_search_cache_lookups_total{outcome="hit"} 2' in text
+
+
+def test_instrumented_node_and_llm_callbacks():
+    metrics.reset()
+    llm = GenericFakeChatModel(
+        messages=iter([AIMessage(content="hi", usage_metadata={"input_tokens": 7, "output_tokens": 2,
+                                                                "total_tokens": 9})]),
+        callbacks=[LLMMetricsCallbackHandler()],
+    )
+
+    async def anode(state):
+        await llm.ainvoke("hello")
+        return state
+
+    node = instrument_node("gather_preference", lambda state: state, anode)
+    assert asyncio.run(node.ainvoke({"messages": []})) == {"messages": []}
+    assert node.invoke({"messages": []}) == {"messages": []}
+    summary = metrics.summary()
+    assert summary["node_seconds"]["node=gather_preference"]["count"] == 2
+    assert summary["llm_seconds"]["node=none"]["count"] == 1
+    assert summary["llm_tokens"]["node=none,type=input"]["sum"] == 7
+    assert summary["llm_tokens"]["node=none,type=output"]["sum"] == 2
+
+
+def test_metrics_server():
+    metrics.reset()
+    metrics.observe("vector_search_results", 5, operation="search")
+    server = start_metrics_server(0)
+    try:
+        # loopback only unless METRICS_HOST says otherwise
+        assert server.server_address[0] == "127.0.0.1"
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        with urllib.request.urlopen(f"{base_url}/metrics") as response:
+            assert "shopping_buddy_vector_search_results_count" in response.read().decode()
+        with urllib.request.urlopen(f"{base_url}/metrics.json") as response:
+            assert json.load(response)["vector_search_results"]["operation=search"]["count"] == 1
+    finally:
+        server.shutdown()
@@ -0,0 +1,40 @@
+import polars as pl
+
+from chatbots.vectorstore.preprocess_data import normalize_json_text_expr, preprocess_csv, preprocess_product_data
+
+CATALOG = pl.DataFrame({
+    "product_id": [1, 2],
+    "title": ['Apple - MacBook Air 13" Laptop', "Sony - WH-1000XM5 Headphones"],
+    "final_price": ["$999.99", None],
+    "root_category": ["Computers & Tablets", "Audio"],
+    "features_summary": ["Light laptop", "ANC"],
+    "features": ['[{"type":"Display","value":"13.3\\" Retina"},{"type":"Battery","value":"18 hours"}]',
+                 '["Bluetooth", "Noise Cancelling"]'],
+    "product_specifications": ['[{"specification_name":"Brand","specification_value":"Apple"}]', "[]"],
+})
+
+
+def test_normalize_json_text():
+    features = CATALOG.select(normalize_json_text_expr("features", max_tokens=None))["features"].to_list()
+    assert features == ['Display: 13.3" Retina; Battery: 18 hours', "Bluetooth; Noise Cancelling"]
+    features = CATALOG.select(normalize_json_text_expr("features", max_tokens=3))["features"].to_list()
+    assert features == ['Display: 13.3" Retina', "Bluetooth; Noise Cancelling"]
+
+
+def test_preprocess_product_data():
+    raw = preprocess_product_data(CATALOG.lazy()).collect()["text"]
+    assert raw[0].startswith('Product Name: Apple - MacBook Air 13" Laptop \n Product Category: Computers & Tablets')
+    assert '[{"type":"Display"' in raw[0]
+    assert raw[1].endswith("Final Price: null")
+    text = preprocess_product_data(CATALOG, normalize=True)["text"]
+    assert "Features: Display: 13.3\" Retina; Battery: 18 hours \n Product Specifications: Brand: Apple" in text[0]
+    assert len(text[0]) < len(raw[0])
+
+
+def test_preprocess_csv(tmp_path):
+    csv_path, output_path = str(tmp_path / "products.csv"), str(tmp_path / "products.arrow")
+    CATALOG.write_csv(csv_path)
+    preprocess_csv(csv_path, output_path)
+    processed = pl.read_ipc(output_path)
+    assert processed["product_id"].to_list() == [1, 2]
+    assert processed["text"].to_list() == preprocess_product_data(CATALOG, normalize=True)["text"].to_list()
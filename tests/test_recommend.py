@@ -0,0 +1,60 @@
+import os
+
+import polars as pl
+
+from chatbots.recommend import ProductStore, Recommendation, retrieve_recommended_product_data, set_product_store
+from chatbots.utils.environment import _remove_stale_snapshots, snapshot_dataset
+
+CATALOG = pl.DataFrame({
+    "product_id": [1, 2, 3],
+    "title": ["Laptop", "TV", "Headphones"],
+    "final_price": ["$999.99", "$499.99", "$199.99"],
+    "root_category": ["Computers & Tablets", "TV & Home Theater", "Audio"],
+})
+
+
+def test_retrieve_recommended_product_data_keeps_score_order():
+    set_product_store(ProductStore(CATALOG))
+    recommendation = Recommendation(product_ids=[3, 42, 1], score=[0.2, 0.9, 0.8])
+    result = retrieve_recommended_product_data(recommendation)
+    assert result == {
+        "product_id": [1, 3],
+        "title": ["Laptop", "Headphones"],
+        "final_price": ["$999.99", "$199.99"],
+        "score": [0.8, 0.2],
+    }
+
+
+def test_snapshot_is_reused_until_csv_changes(tmp_path):
+    csv_path = str(tmp_path / "best_buy_products.csv")
+    cache_directory = str(tmp_path / "snapshots")
+    CATALOG.write_csv(csv_path)
+    snapshot_path = snapshot_dataset(csv_path, cache_directory)
+    assert snapshot_dataset(csv_path, cache_directory) == snapshot_path
+    assert pl.read_ipc(snapshot_path).equals(CATALOG)
+
+    CATALOG.head(2).write_csv(csv_path)
+    os.utime(csv_path, ns=(0, 0))
+    new_snapshot_path = snapshot_dataset(csv_path, cache_directory)
+    assert new_snapshot_path != snapshot_path
+    assert not os.path.exists(snapshot_path)
+    assert pl.read_ipc(new_snapshot_path).height == 2
+
+
+def test_only_snapshots_no_info_file_points_to_are_removed(tmp_path):
+    csv_path = str(tmp_path / "best_buy_products.csv")
+    cache_directory = str(tmp_path / "snapshots")
+    CATALOG.write_csv(csv_path)
+    snapshot_path = snapshot_dataset(csv_path, cache_directory)
+    stale_path = os.path.join(cache_directory, "best_buy_products-stale.arrow")
+    other_csv_path = os.path.join(cache_directory, "other-products.arrow")
+    for path in (stale_path, other_csv_path):
+        with open(path, "w"):
+            pass
+
+    # another process published a snapshot of the reverted CSV while this one wrote its own
+    _remove_stale_snapshots(cache_directory, "best_buy_products", keep="best_buy_products-new.arrow")
+    assert os.path.exists(snapshot_path)
+    assert not os.path.exists(stale_path)
+    assert os.path.exists(other_csv_path)
+    assert not [name for name in os.listdir(cache_directory) if name.endswith(".tmp")]
@@ -0,0 +1,106 @@
+import asyncio
+
+import numpy as np
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import scripted_conversation, synthetic_catalog
+from benchmarks.run_benchmark import setup_benchmark
+from chatbots.recommend import NO_RECOMMENDATION_MESSAGE, Recommendation
+from chatbots.shopping_buddy import find_related_products, matched_router, matching_router
+from chatbots.vectorstore.embeddings import HashingEmbeddings
+from chatbots.vectorstore.related_graph import RelatedProductGraph, set_related_product_graph
+
+PRODUCT_IDS = [1, 2, 3, 4, 5]
+TEXTS = [
+    "Apple MacBook Air 13 inch laptop",
+    "Dell XPS 13 inch laptop",
+    "Laptop sleeve bag for 13 inch laptop",
+    "Wireless mouse for laptop",
+    "Samsung 65 inch 4K TV",
+]
+CATEGORIES = ["Computers", "Computers", "Accessories", "Accessories", "TV"]
+
+
+def build_graph(**kwargs) -> RelatedProductGraph:
+    embeddings = HashingEmbeddings(dimension=256).embed_array(TEXTS)
+    return RelatedProductGraph.build(PRODUCT_IDS, embeddings, CATEGORIES, **kwargs)
+
+
+def test_graph_is_csr_and_excludes_self():
+    graph = build_graph(n_neighbors=2)
+    assert graph.offsets.tolist() == [0, 2, 4, 6, 8, 10]
+    for product_id in PRODUCT_IDS:
+        neighbors, scores = graph.neighbors_of(product_id)
+        assert product_id not in neighbors.tolist()
+        assert scores.tolist() == sorted(scores.tolist(), reverse=True)
+    assert len(graph.neighbors_of(999)[0]) == 0
+
+
+def test_save_and_load(tmp_path):
+    graph = build_graph(n_neighbors=3)
+    graph.save(str(tmp_path))
+    loaded = RelatedProductGraph.load(str(tmp_path))
+    assert np.array_equal(loaded.neighbors, graph.neighbors)
+    assert loaded.related_products([1, 2]) == graph.related_products([1, 2])
+
+
+def test_find_related_products_uses_graph_without_llm():
+    graph = build_graph(n_neighbors=3)
+    set_related_product_graph(graph)
+    assert matching_router({}) == ["match_products"]
+    assert matched_router({}) == ["recommend", "find_related_products"]
+    update = find_related_products({"recommendation": Recommendation(product_ids=[1], score=[0.9])})
+    related = update["related_product_recommendation"]
+    assert 1 not in related.product_ids
+    assert related.product_ids == graph.related_products([1])[0]
+    # accessories co-occur with laptops, so they rank above the other laptop
+    assert related.product_ids[0] in (3, 4)
+    # without a graph, the related-product branch asks the LLM next to match_products
+    set_related_product_graph(None)
+    assert matching_router({}) == ["match_products", "find_related_products"]
+
+
+def catalog_graph(catalog) -> RelatedProductGraph:
+    embeddings = HashingEmbeddings(dimension=64).embed_array(catalog["title"].to_list())
+    return RelatedProductGraph.build(catalog["product_id"].to_list(), embeddings, catalog["root_category"].to_list(),
+                                     n_neighbors=5)
+
+
+def play_turns(messages, thread_id: str) -> dict:
+    async def run():
+        for message in messages:
+            async for _ in shopping_buddy.astream_shopping_buddy(message, thread_id=thread_id):
+                pass
+        return await shopping_buddy.get_graph().aget_state({"configurable": {"thread_id": thread_id}})
+
+    return asyncio.run(run()).values
+
+
+def test_graph_lookup_through_the_compiled_graph():
+    setup_benchmark(1000, dimension=32)
+    set_related_product_graph(catalog_graph(synthetic_catalog(1000)))
+    values = play_turns(scripted_conversation(0), "related-graph-test")
+    assert values["recommended_product_data"]
+    assert values["related_product_recommendation"].product_ids
+    assert values["messages"][-1].content.startswith("Here are the related products")
+    shopping_buddy.clear_thread("related-graph-test")
+
+
+def test_results_of_the_previous_turn_are_not_shown_again_with_a_graph(monkeypatch):
+    setup_benchmark(1000, dimension=32)
+    set_related_product_graph(catalog_graph(synthetic_catalog(1000)))
+    values = play_turns(scripted_conversation(0), "stale-graph-test")
+    assert values["recommended_product_data"] and values["related_product_recommendation"] is not None
+
+    # the next search finds no products, so there is nothing to look up in the graph, and no time for the LLM
+    monkeypatch.setattr(shopping_buddy, "_update_recommendation", lambda search_result: {})
+    monkeypatch.setattr(shopping_buddy, "RELATED_PRODUCTS_MIN_SECONDS", 1000)
+    shopping_buddy.get_related_product_cache().clear()
+    values = play_turns([scripted_conversation(1)[1]], "stale-graph-test")
+    assert values.get("recommendation") is None
+    assert values.get("recommended_product_data") is None
+    assert values.get("related_product_recommendation") is None
+    assert values["messages"][-1].content == NO_RECOMMENDATION_MESSAGE
+    related_messages = [m for m in values["messages"] if m.content.startswith("Here are the related products")]
+    assert len(related_messages) == 1
+    shopping_buddy.clear_thread("stale-graph-test")
@@ -1,7 +1,7 @@
-from langchain_ollama import ChatOllama
+from langchain_databricks import ChatDatabricks
 from chatbots.shopping_buddy import build_llm
 
 
 def test_build_llm():
     llm = build_llm()
-    assert isinstance(llm, ChatOllama)
+    assert isinstance(llm, ChatDatabricks)
@@ -0,0 +1,122 @@
+import asyncio
+
+from langchain_core.messages import AIMessage
+
+import chatbots.shopping_buddy as shopping_buddy
+from benchmarks.fakes import ScriptedChatModel
+from chatbots.slot_filling import SlotExtractor, fill_slots, merge_tool_call_slots, set_slot_extractor
+
+EXTRACTOR = SlotExtractor(brands=["Apple", "Samsung", "Bose"],
+                          categories=["Computers & Tablets", "TV & Home Theater", "Smart Home, Security & Wi-Fi",
+                                      "Video Games", "Toys, Games & Drones", "Cameras, Camcorders & Drones"])
+
+
+def test_extract_budget_brand_and_category():
+    assert EXTRACTOR.extract("A Samsung smart TV under $500 with 4K") == {
+        "budget": "under $500", "brand": "Samsung", "product_category": "TV & Home Theater"}
+    assert EXTRACTOR.extract("an apple tablet between 300 and 600") == {
+        "budget": "$300 - $600", "brand": "Apple", "product_category": "Computers & Tablets"}
+    assert EXTRACTOR.extract("a 13 inch laptop") == {}
+    assert EXTRACTOR.extract("video games for my son") == {"product_category": "Video Games"}
+    assert EXTRACTOR.extract("a new television") == {"product_category": "TV & Home Theater"}
+
+
+def test_category_needs_a_full_name_or_alias():
+    # single words of a category name, or names shared by categories, are not enough
+    assert EXTRACTOR.extract("a video doorbell") == {}
+    assert EXTRACTOR.extract("a desk for my home office") == {}
+    assert EXTRACTOR.extract("a drone") == {}
+    assert EXTRACTOR.extract("a smart speaker") == {}
+
+
+def test_fill_slots_answers_pending_slot():
+    slots = {"product_category": "TV & Home Theater", "brand": "Samsung", "budget": "under $500"}
+    assert fill_slots(slots, "OLED and HDR", EXTRACTOR, pending_slot="features") == {"features": "OLED and HDR"}
+    assert fill_slots(slots, "no preference", EXTRACTOR, pending_slot="brand") == {"brand": "None"}
+    # slots that did not change are not new
+    assert fill_slots(slots, "Samsung please", EXTRACTOR) == {}
+
+
+def test_fill_slots_leaves_unclear_features_answers_to_the_llm():
+    slots = {"product_category": "TV & Home Theater", "brand": "Samsung", "budget": "under $500"}
+    assert fill_slots(slots, "what do you mean?", EXTRACTOR, pending_slot="features") == {}
+    assert fill_slots(slots, "Which ones are popular", EXTRACTOR, pending_slot="features") == {}
+    assert fill_slots(slots, "actually an Apple tablet", EXTRACTOR, pending_slot="features") == {
+        "brand": "Apple", "product_category": "Computers & Tablets"}
+    assert fill_slots(slots, "well I am not sure, my old one broke last week and I would like something that "
+                             "lasts longer this time", EXTRACTOR, pending_slot="features") == {}
+
+
+def test_merge_tool_call_slots_keeps_known_slots():
+    response = AIMessage(content="", tool_calls=[{"name": "CustomerPreference", "id": "call", "args": {
+        "product_category": "laptop", "brand": "None", "budget": "", "features": "light"}}])
+    slots = merge_tool_call_slots(response, {"brand": "Apple", "budget": "under $1000"})
+    assert slots == {"product_category": "laptop", "brand": "Apple", "budget": "under $1000", "features": "light"}
+    assert response.tool_calls[0]["args"] == slots
+
+
+def test_llm_is_skipped_once_all_slots_are_known():
+    llm_calls = []
+
+    def respond(messages):
+        llm_calls.append(messages)
+        return AIMessage(content="Which features do you need?")
+
+    shopping_buddy.set_llms(ScriptedChatModel(respond=respond))
+    set_slot_extractor(EXTRACTOR)
+    state = {"messages": [], "preference_slots": {}}
+    for text in ["A Samsung TV under $500", "OLED"]:
+        state["messages"] = shopping_buddy.add_messages(state["messages"], [("user", text)])
+        state = asyncio.run(shopping_buddy.agather_preference(state))
+    assert len(llm_calls) == 1
+    # the LLM prompt lists the gathered slots
+    assert "Brand Preferences: Samsung" in llm_calls[0][-2].content
+    assert state["messages"][-1].tool_calls[0]["args"] == {
+        "product_category": "TV & Home Theater", "brand": "Samsung", "budget": "under $500", "features": "OLED"}
+
+
+def test_llm_answers_questions_to_the_features_question():
+    llm_calls = []
+
+    def respond(messages):
+        llm_calls.append(messages)
+        return AIMessage(content="Which features do you need?")
+
+    shopping_buddy.set_llms(ScriptedChatModel(respond=respond))
+    set_slot_extractor(EXTRACTOR)
+    state = {"messages": [], "preference_slots": {}}
+    for text in ["A Samsung TV under $500", "what features are there?"]:
+        state["messages"] = shopping_buddy.add_messages(state["messages"], [("user", text)])
+        state = asyncio.run(shopping_buddy.agather_preference(state))
+    assert len(llm_calls) == 2
+    assert "features" not in state["preference_slots"]
+
+
+def test_next_request_does_not_reuse_the_slots_of_the_previous_one():
+    llm_calls = []
+
+    def respond(messages):
+        llm_calls.append(messages)
+        return AIMessage(content="What is your budget?")
+
+    shopping_buddy.set_llms(ScriptedChatModel(respond=respond))
+    set_slot_extractor(SlotExtractor(brands=["Samsung", "Sony"],
+                                     categories=["TV & Home Theater", "Cameras, Camcorders & Drones"]))
+    state = {"messages": [], "preference_slots": {}, "pending_slot": "features"}
+    state["messages"] = shopping_buddy.add_messages(state["messages"], [("user", "A Samsung TV under $500")])
+    state["preference_slots"] = {"features": "OLED"}
+    state = asyncio.run(shopping_buddy.agather_preference(state))
+    assert not llm_calls
+    state = shopping_buddy.parse_preference(state)
+    assert state["preference_slots"] == {} and state["pending_slot"] is None
+
+    state["messages"] = shopping_buddy.add_messages(state["messages"], [("user", "now a Sony camera")])
+    state = asyncio.run(shopping_buddy.agather_preference(state))
+    # the LLM asks for the budget and features of the camera, it is not told the ones of the TV
+    assert len(llm_calls) == 1
+    assert state["preference_slots"] == {"brand": "Sony", "product_category": "Cameras, Camcorders & Drones"}
+    known_slots = [message.content for message in llm_calls[0]
+                   if str(message.content).startswith("Preferences already gathered")]
+    assert known_slots == ["Preferences already gathered from the customer, do not ask for them again:\n"
+                           "- Product Category: Cameras, Camcorders & Drones\n- Brand Preferences: Sony\n"
+                           "Only ask for the missing ones: Budget Range, Features."]
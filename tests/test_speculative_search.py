@@ -0,0 +1,45 @@
+from benchmarks.fakes import random_vector_index, synthetic_catalog
+from chatbots.customer_preference import CustomerPreference
+from chatbots.speculative_search import (
+    get_speculative_searches,
+    partial_customer_preference,
+    speculative_search_result,
+)
+from chatbots.vectorstore.hybrid_search import ProductFilterIndex, set_product_filter_index
+from chatbots.vectorstore.vector_search import process_search_result, set_vector_index
+
+CATALOG = synthetic_catalog(2000)
+
+
+def setup_module():
+    set_vector_index(random_vector_index(CATALOG, dimension=32))
+    set_product_filter_index(ProductFilterIndex(CATALOG))
+
+
+def teardown_module():
+    set_vector_index(None)
+    set_product_filter_index(None)
+
+
+def test_partial_preference_needs_something_to_search():
+    assert partial_customer_preference({"budget": "under $500"}) is None
+    assert partial_customer_preference({"brand": "None"}) is None
+    assert partial_customer_preference({"brand": "Sony"}).product_category == ""
+
+
+def test_speculative_search_is_reranked_for_the_final_preference():
+    key = get_speculative_searches().start(partial_customer_preference({"brand": "Sony"}))
+    final = CustomerPreference(product_category="Audio", brand="Sony", budget="under $300", features="wireless")
+    result = speculative_search_result(key, final, columns=["product_id", "title"])
+    product_ids, _ = process_search_result(result)
+    assert len(product_ids) == 5
+    products = CATALOG.filter(CATALOG["product_id"].is_in(product_ids))
+    assert products["title"].str.starts_with("Sony").all()
+    # the speculation is used once
+    assert speculative_search_result(key, final, columns=["product_id", "title"]) is None
+
+
+def test_speculative_search_is_dropped_when_the_customer_changed_their_mind():
+    key = get_speculative_searches().start(partial_customer_preference({"brand": "Sony"}))
+    final = CustomerPreference(product_category="Cameras", brand="Canon", budget="", features="")
+    assert speculative_search_result(key, final, columns=["product_id", "title"]) is None